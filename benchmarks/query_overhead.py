@@ -0,0 +1,60 @@
+"""Client-side overhead of `Client.query` on large generated queries.
+
+Compares the single-pass scanner with the sqlparse-based preprocessing it
+replaced. The requests themselves are mocked out, so only the client's own work
+is measured:
+
+    python benchmarks/query_overhead.py
+"""
+import timeit
+from unittest.mock import MagicMock
+
+import sqlparse
+from sqlparse.tokens import Keyword, Newline, Whitespace
+
+from clickhouse_cli.clickhouse.client import Client
+from clickhouse_cli.clickhouse.scanner import scan_query
+
+
+def generate_query(size=100000):
+    columns = []
+    length = 0
+    i = 0
+    while length < size:
+        column = "    sumIf(value_{0}, status = 'ok -- {0}') AS total_{0}, /* column {0} */\n".format(i)
+        columns.append(column)
+        length += len(column)
+        i += 1
+    return "SELECT\n" + "".join(columns) + "    count()\nFROM events\nWHERE date = today()\nINTO OUTFILE 'out.tsv';"
+
+
+def sqlparse_preprocess(query):
+    """The preprocessing `Client.query` used to do (without echoing the formatted query)."""
+    query = sqlparse.format(query, strip_comments=True).rstrip(";")
+    query_split = query.split()
+    if query_split[-2].upper() != "FORMAT":
+        query = query + " FORMAT PrettyCompact"
+    t_query = [
+        t.value.upper() if t.ttype == Keyword else t.value
+        for t in sqlparse.parse(query)[0]
+        if t.ttype not in (Whitespace, Newline)
+    ]
+    return " ".join(t_query[:-5] + t_query[-2:])
+
+
+def main():
+    query = generate_query()
+    client = Client("http://localhost:8123/", "default", "", "default", None)
+    client._query = MagicMock()
+
+    for name, func, number in (
+        ("sqlparse", lambda: sqlparse_preprocess(query), 1),
+        ("scan_query", lambda: scan_query(query), 20),
+        ("Client.query", lambda: client.query(query.replace("INTO OUTFILE 'out.tsv'", "")), 20),
+    ):
+        elapsed = min(timeit.repeat(func, number=number, repeat=3)) / number
+        print("{:<14} {:>10.2f} ms per {} KB query".format(name, elapsed * 1000, len(query) // 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import hashlib
+import json
+import re
+import time
+
+# Statements that only change the state of the session; they're executed again on resume
+SESSION_STATEMENT_RE = re.compile(r"(?:\s|--[^\n]*(?:\n|$)|/\*.*?\*/)*(?:USE|SET)\b", re.IGNORECASE | re.DOTALL)
+
+
+class Checkpoint(object):
+    """The progress of a script run, kept as JSON lines appended after each statement.
+
+    Every statement is identified by a hash chained over all the statements before
+    it, so editing the script invalidates the checkpoint from the first change on.
+    """
+
+    def __init__(self, path=None, resume=False):
+        self.path = path
+        self.digest = ""
+        self.completed = set()
+        self.skipped = 0
+        self.file = None
+
+        if path is None:
+            return
+
+        if resume:
+            self.completed = self.load(path)
+        self.file = open(path, "a" if resume else "w")
+
+    @staticmethod
+    def load(path):
+        """Return the hashes of the statements that succeeded, according to the file at `path`."""
+        completed = set()
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The run was interrupted in the middle of a line
+                        continue
+                    if entry.get("status") == "ok":
+                        completed.add(entry["hash"])
+                    else:
+                        completed.discard(entry.get("hash"))
+        except FileNotFoundError:
+            pass
+        return completed
+
+    def advance(self, statement):
+        """Return the hash of the next statement, and whether a previous run completed it."""
+        self.digest = hashlib.sha1((self.digest + "\0" + statement).encode("utf-8", "replace")).hexdigest()
+        completed = self.digest in self.completed and not SESSION_STATEMENT_RE.match(statement)
+        if completed:
+            self.skipped += 1
+        return self.digest, completed
+
+    def record(self, digest, number, lineno, name, ok):
+        if self.file is None:
+            return
+        entry = {
+            "hash": digest,
+            "statement": number,
+            "line": lineno,
+            "file": name,
+            "status": "ok" if ok else "failed",
+            "at": time.time(),
+        }
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -1,10 +1,16 @@
 import ast
+import concurrent.futures
+import hashlib
 import http.client
-import json
+import io
 import os
 import re
 import shutil
+import sqlite3
 import sys
+import threading
+import time
+from collections import deque
 from configparser import NoOptionError
 from datetime import datetime
 from urllib.parse import parse_qs, urlparse
@@ -13,25 +19,55 @@ from uuid import uuid4
 import click
 import pygments
 import sqlparse
-from prompt_toolkit import Application, PromptSession
+from prompt_toolkit import PromptSession
 from prompt_toolkit.completion import DynamicCompleter, ThreadedCompleter
-from prompt_toolkit.history import FileHistory
-from prompt_toolkit.layout.containers import Window
-from prompt_toolkit.layout.controls import BufferControl
-from prompt_toolkit.layout.layout import Layout
-from prompt_toolkit.lexers import PygmentsLexer
+from prompt_toolkit.history import FileHistory, ThreadedHistory
+from prompt_toolkit.lexers import DynamicLexer
 from pygments.formatters import TerminalFormatter, TerminalTrueColorFormatter
 
 import clickhouse_cli.helpers
 from clickhouse_cli import __version__
-from clickhouse_cli.clickhouse.client import Client, ConnectionError, DBException, TimeoutError
-from clickhouse_cli.clickhouse.definitions import EXIT_COMMANDS, PRETTY_FORMATS
+from clickhouse_cli.checkpoint import Checkpoint
+from clickhouse_cli.clickhouse.cache import ResultCache
+from clickhouse_cli.clickhouse.client import (
+    BINARY_FORMATS,
+    Client,
+    ConnectionError,
+    DBException,
+    QueryCancelled,
+    Response,
+    TimeoutError,
+)
+from clickhouse_cli.clickhouse.definitions import DESCRIBE_COLUMNS, EXIT_COMMANDS, FORMATTABLE_QUERIES, PRETTY_FORMATS
+from clickhouse_cli.clickhouse.dependencies import DependencyGraph
+from clickhouse_cli.clickhouse.scanner import iter_statements, scan_query, statement_verb
+from clickhouse_cli.clickhouse.sessions import SET_RE, SessionPool
 from clickhouse_cli.clickhouse.sqlparse_patch import KEYWORDS
-from clickhouse_cli.config import read_config
-from clickhouse_cli.helpers import numberunit_fmt, parse_headers_stream, sizeof_fmt
+from clickhouse_cli.config import get_cache_path, read_config
+from clickhouse_cli.helpers import (
+    find_parameters,
+    numberunit_fmt,
+    parse_headers_stream,
+    shorten_query,
+    sizeof_fmt,
+    split_insert_values,
+    unquote_identifier,
+)
+from clickhouse_cli.jobs import JobManager
+from clickhouse_cli.localdb import LocalDatabase
 from clickhouse_cli.ui.completer import CHCompleter
-from clickhouse_cli.ui.lexer import CHLexer, CHPrettyFormatLexer
-from clickhouse_cli.ui.prompt import CLIBuffer, get_continuation_tokens, get_prompt_tokens, is_multiline, kb
+from clickhouse_cli.ui.history import SQLiteHistory
+from clickhouse_cli.ui.lexer import CHLexer, CHPrettyFormatLexer, IncrementalLexer, make_lexer
+from clickhouse_cli.ui.progress import ProgressBar, parse_progress
+from clickhouse_cli.ui.prompt import get_continuation_tokens, get_prompt_tokens, is_multiline, kb
+from clickhouse_cli.ui.render import (
+    RENDERERS,
+    KeptResult,
+    can_render,
+    numeric_columns,
+    parse_tsv_with_names_and_types,
+    render,
+)
 from clickhouse_cli.ui.style import Echo, get_ch_pygments_style, get_ch_style
 
 # monkey-patch sqlparse
@@ -43,6 +79,18 @@ sqlparse.keywords.KEYWORDS_ORACLE = {}
 # monkey-patch http.client
 http.client.parse_headers = parse_headers_stream
 
+# The flat history file used before the SQLite one; it's imported once
+LEGACY_HISTORY_FILE = "~/.clickhouse-cli_history"
+# What interactive results are fetched in when they're rendered locally (the local_render option)
+LOCAL_RENDER_FORMAT = "TabSeparatedWithNamesAndTypes"
+# Results bigger than this aren't kept, they would stay in memory for the whole session
+MAX_KEPT_RESULT_SIZE = 16 << 20
+# The server's default for output_format_pretty_max_rows, and a SET of it
+DEFAULT_PRETTY_MAX_ROWS = 10000
+PRETTY_MAX_ROWS_RE = re.compile(r"\boutput_format_pretty_max_rows\s*=\s*(\d+)", re.IGNORECASE)
+# The arguments of \show and \local: the number of a kept result, then `as <format or table>`
+RESULT_ARGS_RE = re.compile(r"^(\d+)?\s*(?:\bas\s+(\w+))?$", re.IGNORECASE)
+
 
 def show_version():
     print("clickhouse-cli version: {version}".format(version=__version__))
@@ -65,6 +113,10 @@ class CLI:
         cookie,
         insecure,
         headers=None,
+        stop_on_error=False,
+        parallel=1,
+        checkpoint=None,
+        resume=False,
     ):
         self.config = None
 
@@ -83,11 +135,37 @@ class CLI:
         self.vi_mode = vi_mode
         self.server_version = None
         self.insecure = insecure
+        self.stop_on_error = stop_on_error
+        self.script_failures = 0
+        self.status_shown = False
+        self.parallel = parallel
+        self.checkpoint_path = checkpoint
+        self.resume = resume
+        self.checkpoint = Checkpoint()
+        # Statements of a parallel script print their results one at a time
+        self.output_lock = threading.RLock()
 
         self.query_ids = []
         self.client = None
+        self.sessions = None
+        self.jobs = JobManager()
+        self.completer = None
+        self.history = None
         self.echo = Echo(verbose=True, colors=True)
-        self.progress = None
+        self.progress_bar = ProgressBar(self.progress_print)
+        # Set while loading files with -q 'INSERT ...', to show their progress on stderr
+        self.loading = False
+        # The latest results rendered locally, newest first, for \show and \local
+        self.local_render = False
+        self.results = deque()
+        # How many rows the Pretty formats rendered here show
+        self.pretty_max_rows = DEFAULT_PRETTY_MAX_ROWS
+        # Where \local loads them, for \lq
+        self.local_db = None
+        # Set up on connecting when the result_cache option is on
+        self.result_cache = None
+        # The query parameters set with \set, by name
+        self.parameters = {}
 
         self.metadata = {}
 
@@ -115,9 +193,22 @@ class CLI:
 
         self.echo.print("Connecting to {host}:{port}".format(host=self.host, port=self.port))
 
+        # The queries that run alongside the main one (scripts with --parallel, background jobs) get their own sessions
+        self.sessions = SessionPool(self.client)
+
+        if self.config.getboolean("main", "result_cache"):
+            self.result_cache = ResultCache(
+                self.client,
+                size=self.config.getint("main", "result_cache_size"),
+                path=get_cache_path("results"),
+                disk_size=self.config.getint("main", "result_cache_disk_size") << 20,
+            )
+
         try:
             for key, value in self.settings.items():
-                self.client.query("SET {}={}".format(key, value), fmt="Null")
+                statement = "SET {}={}".format(key, value)
+                self.client.query(statement, fmt="Null")
+                self.sessions.add_setup(statement)
 
             response = self.client.query("SELECT version();", fmt="TabSeparated")
         except TimeoutError:
@@ -173,6 +264,9 @@ class CLI:
         )
         self.highlight_theme = self.config.get("main", "highlight_theme", fallback=None)
         self.complete_while_typing = self.config.getboolean("main", "complete_while_typing")
+        self.complete_column_values = self.config.getboolean("main", "complete_column_values")
+        self.column_values_ttl = self.config.getfloat("main", "column_values_ttl")
+        self.large_input_size = self.config.getint("main", "large_input_size")
 
         try:
             udf = self.config.get("main", "udf")
@@ -186,6 +280,11 @@ class CLI:
 
         self.refresh_metadata_on_start = self.config.getboolean("main", "refresh_metadata_on_start")
         self.refresh_metadata_on_query = self.config.getboolean("main", "refresh_metadata_on_query")
+        self.metadata_max_age = self.config.getfloat("main", "metadata_max_age")
+        self.history_file = self.config.get("main", "history_file")
+        self.history_size = self.config.getint("main", "history_size")
+        self.local_render = self.config.getboolean("main", "local_render")
+        self.results = deque(maxlen=self.config.getint("main", "local_render_results"))
 
         self.conn_timeout = self.config.getfloat("http", "conn_timeout")
         self.conn_timeout_retry = self.config.getint("http", "conn_timeout_retry")
@@ -215,6 +314,7 @@ class CLI:
         arg_settings = self.settings
         config_settings.update(arg_settings)
         self.settings = config_settings
+        self.pretty_max_rows = int(self.settings.get("output_format_pretty_max_rows", DEFAULT_PRETTY_MAX_ROWS))
 
         config_headers = {}
         if self.config.has_section("headers"):
@@ -254,10 +354,28 @@ class CLI:
         if data and query is None:
             # cat stuff.sql | clickhouse-cli
             # clickhouse-cli stuff.sql
-            for subdata in data:
-                self.handle_input(subdata.read(), verbose=False, refresh_metadata=False)
-
-            return
+            run_script = self.run_script_parallel if self.parallel > 1 else self.run_script
+            self.checkpoint = self.open_checkpoint(data)
+            try:
+                for subdata in data:
+                    if not run_script(subdata) and self.stop_on_error:
+                        break
+            except KeyboardInterrupt:
+                self.clear_status()
+                self.echo.error("\nScript was interrupted.")
+                self.cancel_queries()
+                self.script_failures += 1
+            finally:
+                self.checkpoint.close()
+
+            if self.checkpoint.skipped:
+                message = "Skipped {} statements completed by a previous run.".format(self.checkpoint.skipped)
+                click.secho(message, fg="yellow", err=True)
+            if self.script_failures and self.checkpoint.path:
+                message = "Progress saved to {}, run the script again with --resume to continue."
+                self.echo.error(message.format(self.checkpoint.path), err=True)
+
+            return self.script_failures == 0
 
         if not data and query is not None:
             # clickhouse-cli -q 'SELECT 1'
@@ -266,6 +384,7 @@ class CLI:
         if data and query is not None:
             # cat stuff.csv | clickhouse-cli -q 'INSERT INTO stuff'
             # clickhouse-cli -q 'INSERT INTO stuff' stuff.csv
+            self.loading = True
             for subdata in data:
                 compress = "gzip" if os.path.splitext(subdata.name)[1] == ".gz" else False
 
@@ -273,71 +392,409 @@ class CLI:
 
             return
 
-        buffer = CLIBuffer(
-            client=self.client,
-            multiline=self.multiline,
-            metadata=self.metadata,
-        )
-
-        root_container = Window(content=BufferControl(buffer=buffer))
-
-        layout = Layout(root_container)
+        # A single completer serves the prompt and owns the metadata refreshes,
+        # so the prevalence statistics and the refresh worker aren't split.
+        self.lexer = None
+        self.completer = CHCompleter(self.client, self.metadata, server_version=self.server_version)
+        self.completer.complete_column_values = self.complete_column_values
+        self.completer.max_text_size = self.large_input_size
+        self.completer.column_values.ttl = self.column_values_ttl
+        if self.highlight:
+            self.completer.on_catalogue = self.update_lexer
+            self.update_lexer(self.completer.catalogue)
 
-        hist = FileHistory(filename=os.path.expanduser("~/.clickhouse-cli_history"))
-        self.completer = CHCompleter(self.client, self.metadata)
+        hist = self.open_history()
 
         self.session = PromptSession(
             style=get_ch_style(self.highlight_theme) if self.highlight else None,
-            lexer=PygmentsLexer(CHLexer) if self.highlight else None,
+            lexer=DynamicLexer(lambda: self.lexer),
             message=get_prompt_tokens()[0][1],
             prompt_continuation=get_continuation_tokens()[0][1],
             multiline=is_multiline(self.multiline),
             vi_mode=self.vi_mode,
-            history=hist,
+            history=ThreadedHistory(hist),
             key_bindings=kb,
             complete_while_typing=self.complete_while_typing,
             completer=ThreadedCompleter(DynamicCompleter(lambda: self.completer)),
         )
 
-        self.app = Application(
-            layout=layout,
-            # buffer=buffer,
-        )
-
         if self.refresh_metadata_on_start:
-            self.app.current_buffer.completer.refresh_metadata()
+            self.completer.request_refresh()
 
         try:
             while True:
                 try:
+                    self.report_jobs()
                     cli_input = self.session.prompt()
                     self.handle_input(cli_input)
                 except KeyboardInterrupt:
-                    # Attempt to terminate queries
-                    for query_id in self.query_ids:
-                        self.client.kill_query(query_id)
-
+                    self.progress_reset()
                     self.echo.error("\nQuery was terminated.")
+                    self.cancel_queries(self.query_ids)
                 finally:
                     self.query_ids = []
         except EOFError:
+            running = self.jobs.running()
+            for job in running:
+                job.killed = True
+            if running:
+                self.cancel_queries([job.query_id for job in running])
+                self.echo.warning("Killed {} background job(s).".format(len(running)))
             self.echo.success("Bye.")
 
+    def open_history(self):
+        try:
+            self.history = SQLiteHistory(
+                os.path.expanduser(self.history_file),
+                server="{}@{}:{}".format(self.user, self.host, self.port),
+                size=self.history_size,
+            )
+        except sqlite3.Error as e:
+            self.echo.warning("Can't open the history database ({}), falling back to the flat file.".format(e))
+            return FileHistory(filename=os.path.expanduser(LEGACY_HISTORY_FILE))
+
+        try:
+            imported = self.history.import_file(os.path.expanduser(LEGACY_HISTORY_FILE))
+        except (IOError, OSError, sqlite3.Error) as e:
+            self.echo.warning("Failed to import {} ({}).".format(LEGACY_HISTORY_FILE, e))
+        else:
+            if imported:
+                self.echo.info("Imported {} queries from {}.".format(imported, LEGACY_HISTORY_FILE))
+
+        return self.history
+
+    def open_checkpoint(self, scripts):
+        """Start recording the progress of a script run, going on from the previous one with --resume."""
+        path = self.checkpoint_path
+        if path is None:
+            # One checkpoint per server and list of scripts
+            key = "\0".join([self.url, self.user or ""] + [getattr(script, "name", "<stdin>") for script in scripts])
+            path = get_cache_path("checkpoints", hashlib.sha1(key.encode()).hexdigest() + ".jsonl")
+
+        try:
+            return Checkpoint(path, resume=self.resume)
+        except (IOError, OSError) as e:
+            self.echo.error("Error: Failed to open the checkpoint file {} ({}).".format(path, e))
+            return Checkpoint()
+
+    def run_script(self, stream):
+        """Execute the statements of a script as they're read. Return False if any of them failed."""
+        name = getattr(stream, "name", "<stdin>")
+        failures = self.script_failures
+
+        for number, (lineno, statement) in enumerate(iter_statements(stream), 1):
+            digest, completed = self.checkpoint.advance(statement)
+            if completed:
+                continue
+
+            self.show_status("-- {} statement #{} (line {})".format(name, number, lineno))
+            result = self.handle_query(statement, verbose=False, query_id=str(uuid4()))
+            self.clear_status()
+            self.checkpoint.record(digest, number, lineno, name, result is not False)
+
+            if result is False:
+                self.script_failures += 1
+                self.echo.error("Statement #{} at {}:{} failed.".format(number, name, lineno))
+                if self.stop_on_error:
+                    return False
+
+        return self.script_failures == failures
+
+    def run_script_parallel(self, stream):
+        """Execute the statements of a script on `self.parallel` sessions at once.
+
+        Statements that touch the same table keep their order; barriers (USE, SET and
+        whatever can't be analyzed) run alone on the main session. Return False if any
+        statement failed.
+        """
+        name = getattr(stream, "name", "<stdin>")
+        failures = self.script_failures
+        graph = DependencyGraph(self.client.database)
+
+        def execute(statement):
+            try:
+                session_id = self.sessions.lease()
+            except (ConnectionError, DBException, TimeoutError) as e:
+                with self.output_lock:
+                    self.echo.error("Error: Failed to set up a session. ({})".format(getattr(e, "error", e)))
+                return False
+            try:
+                return self.handle_query(statement, verbose=False, query_id=str(uuid4()), session_id=session_id)
+            finally:
+                self.sessions.release(session_id)
+
+        statements = {}  # index -> (number, lineno, statement, digest)
+        waiting = {}  # index -> the indexes it still waits for
+        running = {}  # future -> index
+        done = set()
+        stopped = False
+
+        def finish(futures):
+            nonlocal stopped
+            for future in futures:
+                index = running.pop(future)
+                number, lineno, _, digest = statements.pop(index)
+                done.add(index)
+                result = future.result()
+                self.checkpoint.record(digest, number, lineno, name, result is not False)
+                if result is False:
+                    self.script_failures += 1
+                    with self.output_lock:
+                        self.echo.error("Statement #{} at {}:{} failed.".format(number, name, lineno))
+                    stopped = stopped or self.stop_on_error
+
+        def submit_ready(executor):
+            for index in sorted(waiting):
+                if not stopped and waiting[index] <= done:
+                    del waiting[index]
+                    running[executor.submit(execute, statements[index][2])] = index
+
+        def wait(executor, until_idle=False):
+            while running and (until_idle or len(running) + len(waiting) >= self.parallel * 8):
+                finish(concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)[0])
+                submit_ready(executor)
+                with self.output_lock:
+                    self.show_status("-- {}: {} running, {} done".format(name, len(running), len(done)))
+            if until_idle:
+                self.clear_status()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            try:
+                for index, (lineno, statement) in enumerate(iter_statements(stream)):
+                    if stopped:
+                        break
+                    digest, completed = self.checkpoint.advance(statement)
+                    if completed:
+                        continue
+
+                    statements[index] = (index + 1, lineno, statement, digest)
+                    deps, barrier = graph.add(statement)
+
+                    # Temporary tables only live in the main session, so the rest of the script runs there
+                    if barrier or graph.session_bound:
+                        wait(executor, until_idle=True)
+                        if stopped:
+                            break
+                        result = self.handle_query(statement, verbose=False, query_id=str(uuid4()))
+                        statements.pop(index)
+                        done.add(index)
+                        self.checkpoint.record(digest, index + 1, lineno, name, result is not False)
+                        if result is False:
+                            self.script_failures += 1
+                            self.echo.error("Statement #{} at {}:{} failed.".format(index + 1, name, lineno))
+                            stopped = self.stop_on_error
+                        continue
+
+                    waiting[index] = deps
+                    submit_ready(executor)
+                    wait(executor)
+
+                wait(executor, until_idle=True)
+            except KeyboardInterrupt:
+                # Cancel the statements in flight and the queued ones, or the executor would wait for them
+                for future in running:
+                    future.cancel()
+                self.cancel_queries()
+                raise
+
+        return self.script_failures == failures
+
+    def show_status(self, message):
+        # The status goes to stderr, so it doesn't mix with the output of the statements
+        if sys.stderr.isatty():
+            columns = shutil.get_terminal_size((80, 0)).columns
+            sys.stderr.write("\r\u001b[K" + message[: columns - 1])
+            sys.stderr.flush()
+            self.status_shown = True
+
+    def clear_status(self):
+        if self.status_shown:
+            sys.stderr.write("\r\u001b[K")
+            sys.stderr.flush()
+            self.status_shown = False
+
+    def update_lexer(self, catalogue):
+        # Runs on the refresh worker, so the (slow) regex compilation doesn't stall the prompt
+        self.lexer = IncrementalLexer(make_lexer(catalogue), plain_size=self.large_input_size)
+
     def handle_input(self, input_data, verbose=True, refresh_metadata=True):
         force_pager = False
         if input_data.endswith(r"\p" if isinstance(input_data, str) else rb"\p"):
             input_data = input_data[:-2]
             force_pager = True
 
-        # FIXME: A dirty dirty hack to make multiple queries (per one paste) work.
+        if isinstance(input_data, str):
+            stripped = input_data.rstrip()
+            for suffix in ("&", r"\bg"):
+                if stripped.endswith(suffix):
+                    self.start_job(stripped[: -len(suffix)])
+                    return
+
+        queries = self.split_input(input_data)
+
         self.query_ids = []
-        for query in sqlparse.split(input_data):
+        started_at = time.monotonic()
+        rows = None
+        for query, data in queries:
             query_id = str(uuid4())
             self.query_ids.append(query_id)
-            self.handle_query(query, verbose=verbose, query_id=query_id, force_pager=force_pager)
+            if data is not None:
+                data = io.BytesIO(data.encode())
+            response = self.handle_query(query, data=data, verbose=verbose, query_id=query_id, force_pager=force_pager)
+            if response is not None and response.rows is not None:
+                rows = (rows or 0) + response.rows
+
+        if self.history is not None:
+            self.history.record_result(duration=time.monotonic() - started_at, rows=rows)
 
         if refresh_metadata and input_data:
-            self.app.current_buffer.completer.refresh_metadata()
+            self.completer.request_refresh()
+
+    def split_input(self, input_data):
+        """Split the input into (query, data) pairs; only a huge INSERT has data."""
+        if isinstance(input_data, str) and len(input_data) > self.large_input_size:
+            insert = split_insert_values(input_data)
+            if insert is not None:
+                # Send the rows of a huge INSERT as data, instead of tokenizing them with sqlparse
+                return [insert]
+
+        # FIXME: A dirty dirty hack to make multiple queries (per one paste) work.
+        return [(query, None) for query in sqlparse.split(input_data)]
+
+    def start_job(self, input_data):
+        """Run the queries of the input one after another in the background, on a session of their own."""
+        queries = [(query, data) for query, data in self.split_input(input_data) if query.strip().rstrip(";")]
+        if not queries:
+            return
+        if any(query.lstrip().startswith("\\") or query.lower() in EXIT_COMMANDS for query, _ in queries):
+            self.echo.error("Error: Only queries can run in the background.")
+            return
+
+        def run(job):
+            session_id = self.sessions.lease()
+            try:
+                response = None
+                for query, data in queries:
+                    if job.killed:
+                        break
+                    job.query_id = str(uuid4())
+                    query = self.expand_udf(query)
+                    response = self.client.query(
+                        query,
+                        fmt=self.format,
+                        data=None if data is None else io.BytesIO(data.encode()),
+                        query_id=job.query_id,
+                        session_id=session_id,
+                        parameters=self.query_parameters(query),
+                        # For \jobs and \fg, whatever the session settings are
+                        settings={"send_progress_in_http_headers": 1},
+                    )
+                return response
+            finally:
+                self.sessions.release(session_id)
+
+        clickhouse_cli.helpers.trace_headers_stream = self.progress_update
+        job = self.jobs.start(input_data.strip(), str(uuid4()), run)
+        self.echo.info("[{}] Started in the background.".format(job.number))
+
+    def report_jobs(self):
+        for job in self.jobs.collect_finished():
+            self.echo.info(
+                "[{}] {} in {:.3f} sec, use \\fg {} to see the result: {}".format(
+                    job.number, job.status, job.elapsed, job.number, shorten_query(job.query)
+                )
+            )
+
+    def find_job(self, spec):
+        """Return the job of a `N` or `%N` argument, the latest one without an argument."""
+        spec = spec.strip().rstrip(";").strip().lstrip("%")
+        try:
+            job = self.jobs.get(int(spec) if spec else None)
+        except ValueError:
+            job = None
+        if job is None:
+            self.echo.error("Error: No such job.")
+        return job
+
+    def cancel_queries(self, query_ids=None):
+        """Cancel queries, all the running ones by default, and tell how many of them the server is killing."""
+        try:
+            killed = self.client.cancel(query_ids)
+        except (ConnectionError, DBException, QueryCancelled, TimeoutError) as e:
+            self.echo.error("Error: Failed to kill the queries on the server. ({})".format(getattr(e, "error", e)))
+            return
+
+        if killed:
+            noun = "query" if len(killed) == 1 else "queries"
+            self.echo.error("The server is killing {} {}.".format(len(killed), noun))
+
+    def wait_for_job(self, job):
+        """Show the progress of a job until it finishes, then return its response.
+
+        Ctrl-C leaves the job running in the background and returns None.
+        """
+        try:
+            while not job.done.wait(0.1):
+                if job.progress is not None:
+                    self.progress_bar.update(job.progress)
+        except KeyboardInterrupt:
+            self.progress_reset()
+            self.echo.info("\n[{}] Keeps running in the background.".format(job.number))
+            return None
+
+        self.jobs.remove(job)
+        if job.progress is not None:
+            # For the totals
+            self.progress_bar.update(job.progress)
+        return job.result()
+
+    def list_jobs(self):
+        rows = []
+        for job in list(self.jobs.jobs.values()):
+            progress = ""
+            if job.progress is not None:
+                progress = "{} rows, {}".format(
+                    numberunit_fmt(job.progress["read_rows"]), sizeof_fmt(job.progress["read_bytes"])
+                )
+                if job.progress["total_rows"]:
+                    progress += " ({}%)".format(job.progress["percents"])
+            elapsed = "{:.1f}s".format(job.elapsed)
+            rows.append([str(job.number), job.status, elapsed, progress, shorten_query(job.query)])
+        fmt = self.format if can_render(self.format) else "PrettyCompact"
+        return self.local_response(
+            r"\jobs", ("job", "status", "elapsed", "progress", "query"), rows, fmt, right_aligned=(0, 2)
+        )
+
+    def expand_udf(self, query):
+        for regex, replacement in self.udf.items():
+            query = re.sub(regex, replacement, query)
+        return query
+
+    def query_parameters(self, query):
+        """The values set with \\set for the parameters a query uses."""
+        return {name: self.parameters[name] for name in find_parameters(query) if name in self.parameters}
+
+    def set_parameter(self, args):
+        if not args:
+            rows = [[name, value] for name, value in sorted(self.parameters.items())]
+            fmt = self.format if can_render(self.format) else "PrettyCompact"
+            return self.local_response(r"\set", ["name", "value"], rows, fmt)
+
+        parts = args.split(None, 1)
+        if len(parts) != 2:
+            self.echo.error(r"Usage: \set name value, for the {name:Type} placeholders of the queries.")
+            return None
+
+        name, value = parts
+        if name.startswith("param_"):
+            name = name[len("param_") :]
+        if len(value) > 1 and value[0] == value[-1] == "'":
+            value = value[1:-1].replace("\\'", "'").replace("''", "'")
+        self.parameters[name] = value
+        self.echo.success("Ok. ", nl=False)
+        self.echo.print("Set the {} parameter.".format(name))
+        self.echo.print()
+        return None
 
     def handle_query(
         self,
@@ -347,8 +804,16 @@ class CLI:
         verbose=False,
         query_id=None,
         compress=False,
+        session_id=None,
         **kwargs,
     ):
+        # Set by the commands that can be answered without a query
+        response = None
+        # Set by \fg, whose response comes from a background job
+        job = None
+        # Set when the result is fetched in LOCAL_RENDER_FORMAT, to be rendered in this one
+        local_format = None
+
         if query.rstrip(";") == "":
             return
 
@@ -371,13 +836,28 @@ class CLI:
                 [r"\c", "Change the current database."],
                 [r"\d, \dt", "Show tables in the current database."],
                 [r"\d+", "Show table's schema."],
+                [r"\find", "Find columns by name (and type): exact, *glob* or /regex/."],
                 [r"\ps", "Show current queries."],
                 [r"\kill", "Kill query by its ID."],
+                [r"\history", "Search the query history (the latest queries if no term is given)."],
+                [r"\jobs", "Show the background jobs."],
+                [r"\fg", "Wait for a background job and show its result (the latest job if no number is given)."],
+                [r"\kill %N", "Kill background job N."],
+                [r"\set", "Set a query parameter, sent for the {name:Type} placeholders: \\set name value."],
+                [r"\unset", "Unset a query parameter."],
+                [r"\show", "Show a kept result again, e.g. in another format: \\show [N] [as FORMAT]."],
+                [r"\local", "Load a kept result into a local SQLite table: \\local [N] [as TABLE]."],
+                [r"\lq", "Query the local SQLite tables, e.g. \\lq SELECT * FROM result ORDER BY 2."],
+                ["", ""],
+                ["Command suffixes:", ""],
+                ["-----------------", ""],
+                ["!", r"Ask the server instead of the metadata cache (\l!, \d!, \d+! table)."],
                 ["", ""],
                 ["Query suffixes:", ""],
                 ["---------------", ""],
                 [r"\g, \G", "Use the Vertical format."],
                 [r"\p", "Enable the pager."],
+                ["&, \\bg", "Run the query in the background."],
             ]
 
             for row in rows:
@@ -386,12 +866,32 @@ class CLI:
             return
 
         elif query in (r"\d", r"\dt"):
+            response = self.show_tables_locally()
+            query = "SHOW TABLES"
+
+        elif query in (r"\d!", r"\dt!"):
+            self.request_metadata_refresh()
             query = "SHOW TABLES"
 
         elif query.startswith(r"\d+ "):
+            response = self.describe_table_locally(query[4:])
             query = "DESCRIBE TABLE " + query[4:]
 
+        elif query.startswith(r"\d+! "):
+            self.request_metadata_refresh()
+            query = "DESCRIBE TABLE " + query[5:]
+
+        elif query.split(" ", 1)[0] == r"\find":
+            response = self.find_columns(query[5:])
+            if response is None:
+                return
+
         elif query == r"\l":
+            response = self.show_databases_locally()
+            query = "SHOW DATABASES"
+
+        elif query == r"\l!":
+            self.request_metadata_refresh()
             query = "SHOW DATABASES"
 
         elif query.startswith(r"\c "):
@@ -403,148 +903,467 @@ class CLI:
                 "FROM system.processes WHERE query_id != '{}'"
             ).format(query_id)
 
-        elif query.startswith(r"\kill "):
-            self.client.kill_query(query[6:])
+        elif query.split(" ", 1)[0] == r"\history":
+            response = self.search_history(query[8:].strip().rstrip(";"))
+            if response is None:
+                return
+
+        elif query.split(" ", 1)[0] == r"\jobs":
+            response = self.list_jobs()
+
+        elif query.split(" ", 1)[0] == r"\fg":
+            job = self.find_job(query[3:])
+            if job is None:
+                return
+            query = job.query
+
+        elif query.split(" ", 1)[0] == r"\local":
+            self.load_result(query[6:].strip().rstrip(";"))
             return
 
-        response = ""
+        elif query.split(" ", 1)[0] == r"\lq":
+            response = self.query_locally(query[3:].strip().rstrip(";"))
+            if response is None:
+                return
 
-        self.progress_reset()
+        elif query.split(" ", 1)[0] == r"\set":
+            response = self.set_parameter(query[4:].strip().rstrip(";"))
+            if response is None:
+                return
 
-        if self.udf:
-            for regex, replacement in self.udf.items():
-                query = re.sub(regex, replacement, query)
+        elif query.split(" ", 1)[0] == r"\unset":
+            name = query[6:].strip().rstrip(";")
+            if self.parameters.pop(name[len("param_") :] if name.startswith("param_") else name, None) is None:
+                self.echo.error("The {} parameter isn't set.".format(name))
+            return
 
-        try:
-            response = self.client.query(
-                query,
-                fmt=self.format,
-                data=data,
-                stream=stream,
-                verbose=verbose,
-                query_id=query_id,
-                compress=compress,
-            )
-        except TimeoutError:
-            self.echo.error("Error: Connection timeout.")
+        elif query.split(" ", 1)[0] == r"\show":
+            response = self.show_result(query[5:].strip().rstrip(";"))
+            if response is None:
+                return
+
+        elif query.startswith(r"\kill %"):
+            job = self.find_job(query[6:])
+            if job is not None:
+                job.killed = True
+                self.cancel_queries([job.query_id])
             return
-        except ConnectionError as e:
-            self.echo.error("Error: Failed to connect. (%s)" % e)
+
+        elif query.startswith(r"\kill "):
+            self.client.kill_query(query[6:])
             return
-        except DBException as e:
-            self.progress_reset()
-            self.echo.error("\nQuery:")
-            self.echo.error(query)
-            self.echo.error("\n\nReceived exception from server:")
-            self.echo.error(e.error)
 
-            if self.stacktrace and e.stacktrace:
-                self.echo.print("\nStack trace:")
-                self.echo.print(e.stacktrace)
+        self.progress_reset()
+
+        if response is None:
+            try:
+                if job is not None:
+                    response = self.wait_for_job(job)
+                    if response is None:
+                        return
+                else:
+                    query = self.expand_udf(query)
+                    if verbose and data is None and not stream:
+                        query, local_format = self.local_render_format(query)
+                    fmt = self.format if local_format is None else LOCAL_RENDER_FORMAT
+                    parameters = self.query_parameters(query)
+                    ticket = None
+                    if self.result_cache is not None and data is None and not stream:
+                        settings = self.sessions.setup if self.sessions is not None else ()
+                        response, ticket = self.result_cache.lookup(query, fmt, settings, parameters)
+                    if response is None:
+                        response = self.client.query(
+                            query,
+                            fmt=fmt,
+                            data=data,
+                            stream=stream,
+                            verbose=verbose,
+                            query_id=query_id,
+                            compress=compress,
+                            session_id=session_id,
+                            parameters=parameters,
+                            on_upload=None if data is None else self.upload_update,
+                        )
+                        if ticket is not None:
+                            self.result_cache.store(ticket, response)
+                    if session_id is None and self.sessions is not None and SET_RE.match(query):
+                        # The sessions leased from now on catch up with it
+                        self.sessions.add_setup(query)
+                    match = PRETTY_MAX_ROWS_RE.search(query) if SET_RE.match(query) else None
+                    if match is not None:
+                        self.pretty_max_rows = int(match.group(1))
+                    if local_format is not None and response.format == LOCAL_RENDER_FORMAT:
+                        self.render_locally(response, local_format)
+            except QueryCancelled:
+                with self.output_lock:
+                    self.progress_reset()
+                    self.echo.error("Error: Query was cancelled.")
+                return False
+            except TimeoutError:
+                with self.output_lock:
+                    self.progress_reset()
+                    self.echo.error("Error: Connection timeout.")
+                return False
+            except ConnectionError as e:
+                with self.output_lock:
+                    self.progress_reset()
+                    self.echo.error("Error: Failed to connect. (%s)" % e)
+                return False
+            except DBException as e:
+                with self.output_lock:
+                    self.progress_reset()
+                    self.print_db_exception(query, e)
+                return False
+
+        with self.output_lock:
+            total_rows, total_bytes = self.progress_reset()
+            self.clear_status()
+
+            self.echo.print()
+
+            if stream:
+                try:
+                    if response.format in BINARY_FORMATS:
+                        sys.stdout.flush()
+                        for chunk in response.data:
+                            sys.stdout.buffer.write(chunk)
+                        sys.stdout.buffer.flush()
+                    else:
+                        for line in response.data:
+                            print(line.decode("utf-8", "ignore"))
+                except DBException as e:
+                    # Failed after a part of the result was sent
+                    self.print_db_exception(query, e)
+                    return False
+                finally:
+                    self.client.forget(query_id)
+
+            elif isinstance(response.data, bytes):
+                # Binary formats go out as they came
+                sys.stdout.flush()
+                sys.stdout.buffer.write(response.data)
+                sys.stdout.buffer.flush()
+
+            else:
+                if response.data != "":
+                    print_func = print
+
+                    if self.config.getboolean("main", "pager") or kwargs.pop("force_pager", False):
+                        print_func = self.echo.pager
+
+                    should_highlight_output = (
+                        verbose and self.highlight and self.highlight_output and response.format in PRETTY_FORMATS
+                    )
 
+                    formatter = TerminalFormatter()
+
+                    if self.highlight and self.highlight_output and self.highlight_truecolor:
+                        formatter = TerminalTrueColorFormatter(style=get_ch_pygments_style(self.highlight_theme))
+
+                    if should_highlight_output:
+                        print_func(pygments.highlight(response.data, CHPrettyFormatLexer(), formatter))
+                    else:
+                        print_func(response.data, end="")
+
+            if response.message != "":
+                self.echo.print(response.message)
+                self.echo.print()
+
+            self.echo.success("Ok. ", nl=False)
+
+            if response.origin:
+                self.echo.info("[{}] ".format(response.origin), nl=False)
+
+            if response.rows is not None:
+                self.echo.print(
+                    "{rows_count} row{rows_plural} in set.".format(
+                        rows_count=response.rows,
+                        rows_plural="s" if response.rows != 1 else "",
+                    ),
+                    end=" ",
+                )
+
+            if self.config.getboolean("main", "timing") and response.time_elapsed is not None:
+                if not total_rows:
+                    # No progress was reported, e.g. the query was too fast
+                    total_rows = response.summary.get("read_rows", 0)
+                    total_bytes = response.summary.get("read_bytes", 0)
+                self.echo.print(
+                    (
+                        "Elapsed: {elapsed:.3f} sec. Processed: {rows} rows, {bytes} "
+                        "({avg_rps} rows/s, {avg_bps}/s)"
+                    ).format(
+                        elapsed=response.time_elapsed,
+                        rows=numberunit_fmt(total_rows),
+                        bytes=sizeof_fmt(total_bytes),
+                        avg_rps=numberunit_fmt(total_rows / max(response.time_elapsed, 0.001)),
+                        avg_bps=sizeof_fmt(total_bytes / max(response.time_elapsed, 0.001)),
+                    ),
+                    end="",
+                )
+                self.echo.print(self.format_upload_summary(response), end="")
+
+            self.echo.print("\n")
+
+            if self.loading and self.config.getboolean("main", "timing") and response.time_elapsed is not None:
+                click.echo(self.format_upload_summary(response).strip(), err=True)
+
+        return response
+
+    def print_db_exception(self, query, e):
+        self.echo.error("\nQuery:")
+        self.echo.error(query)
+        self.echo.error("\n\nReceived exception from server:")
+        self.echo.error(e.error)
+
+        if self.stacktrace and e.stacktrace:
+            self.echo.print("\nStack trace:")
+            self.echo.print(e.stacktrace)
+
+        # Exceptions that came within a result (e.g. over the native protocol) have no response
+        if e.response is not None:
             self.echo.print("\nElapsed: {elapsed:.3f} sec.\n".format(elapsed=e.response.elapsed.total_seconds()))
+        else:
+            self.echo.print()
 
+    def local_response(self, query, columns, rows, fmt=None, right_aligned=()):
+        fmt = fmt or self.format
+        response = Response(
+            query, fmt, render(columns, rows, fmt, right_aligned=right_aligned, max_rows=self.pretty_max_rows)
+        )
+        response.rows = len(rows)
+        response.origin = "local"
+        return response
+
+    def local_render_format(self, query):
+        """Return the query to run and the format to render its result in locally, None if it can't be."""
+        # The rows of an INSERT aren't scanned, and it has no result anyway
+        if not self.local_render or statement_verb(query) == "INSERT":
+            return query, None
+        scanned = scan_query(query)
+        if scanned.verb not in FORMATTABLE_QUERIES or scanned.format is not None or scanned.outfile is not None:
+            return query, None
+        if len(scanned.text.split(None, 1)) < 2:
+            return query, None
+        if scanned.vertical:
+            # The client would ask the server for the Vertical format
+            return scanned.text, "Vertical"
+        return query, self.format if can_render(self.format) else None
+
+    def render_locally(self, response, fmt):
+        columns, types, rows = parse_tsv_with_names_and_types(response.data)
+        if len(response.data) <= MAX_KEPT_RESULT_SIZE:
+            self.results.appendleft(KeptResult(response.query, columns, types, rows))
+        response.data = render(columns, rows, fmt, right_aligned=numeric_columns(types), max_rows=self.pretty_max_rows)
+        response.format = fmt
+        response.rows = len(rows)
+
+    def find_result(self, number):
+        if 1 <= number <= len(self.results):
+            return self.results[number - 1]
+        if self.results:
+            self.echo.error("There's no result {}, the latest {} are kept.".format(number, len(self.results)))
+        else:
+            self.echo.error("No results are kept, enable the local_render option to keep them.")
+        return None
+
+    def show_result(self, args):
+        match = RESULT_ARGS_RE.match(args)
+        if match is None:
+            self.echo.error(r"Usage: \show [N] [as FORMAT], N = 1 being the latest result.")
+            return None
+
+        result = self.find_result(int(match.group(1) or 1))
+        if result is None:
+            return None
+
+        fmt = match.group(2) or (self.format if can_render(self.format) else "PrettyCompact")
+        if not can_render(fmt):
+            self.echo.error("Can't render {} locally, try one of: {}.".format(fmt, ", ".join(sorted(RENDERERS))))
+            return None
+
+        self.echo.info(result.query)
+        return self.local_response(result.query, result.columns, result.rows, fmt, numeric_columns(result.types))
+
+    def load_result(self, args):
+        match = RESULT_ARGS_RE.match(args)
+        if match is None:
+            self.echo.error(r"Usage: \local [N] [as TABLE], N = 1 being the latest result.")
             return
 
-        total_rows, total_bytes = self.progress_reset()
+        result = self.find_result(int(match.group(1) or 1))
+        if result is None:
+            return
 
+        table = match.group(2) or "result"
+        if self.local_db is None:
+            self.local_db = LocalDatabase()
+        try:
+            self.local_db.load(table, result.columns, result.types, result.rows)
+        except sqlite3.Error as e:
+            self.echo.error("Error: {}".format(e))
+            return
+
+        self.echo.success("Ok. ", nl=False)
+        self.echo.print(
+            "Loaded {} row{} into the local table {}, query it with \\lq SELECT ... FROM {}.".format(
+                len(result.rows), "s" if len(result.rows) != 1 else "", table, table
+            )
+        )
         self.echo.print()
 
-        if stream:
-            data = response.iter_lines() if hasattr(response, "iter_lines") else response.data
-            for line in data:
-                print(line.decode("utf-8", "ignore"))
+    def query_locally(self, query):
+        if not query:
+            self.echo.error(r"Usage: \lq SELECT ... FROM result, after loading a result with \local.")
+            return None
+        if self.local_db is None:
+            self.echo.error(r"No result is loaded, load one with \local first.")
+            return None
 
+        try:
+            columns, rows, numeric = self.local_db.query(query)
+        except sqlite3.Error as e:
+            self.echo.error("Error: {}".format(e))
+            return None
+
+        fmt = self.format if can_render(self.format) else "PrettyCompact"
+        if columns:
+            response = self.local_response(query, columns, rows, fmt, numeric)
         else:
-            if response.data != "":
-                print_func = print
+            response = Response(query, fmt)
+            response.origin = "local"
+        return response
+
+    def can_answer_locally(self):
+        return (
+            self.completer is not None
+            and can_render(self.format)
+            and self.completer.is_metadata_fresh(self.metadata_max_age)
+        )
 
-                if self.config.getboolean("main", "pager") or kwargs.pop("force_pager", False):
-                    print_func = self.echo.pager
+    def search_history(self, term):
+        if self.history is None:
+            self.echo.error("Error: The query history is only kept in the interactive mode.")
+            return None
+
+        rows = [
+            [
+                datetime.fromtimestamp(created_at).strftime("%Y-%m-%d %H:%M:%S"),
+                server or "",
+                "" if duration is None else "{:.3f}".format(duration),
+                "" if row_count is None else str(row_count),
+                " ".join(query.split()),
+            ]
+            for created_at, server, duration, row_count, query in reversed(self.history.search(term))
+        ]
+        fmt = self.format if can_render(self.format) else "PrettyCompact"
+        return self.local_response(
+            r"\history", ("time", "server", "duration", "rows", "query"), rows, fmt, right_aligned=(2, 3)
+        )
 
-                should_highlight_output = (
-                    verbose and self.highlight and self.highlight_output and response.format in PRETTY_FORMATS
-                )
+    def request_metadata_refresh(self):
+        if self.completer is not None:
+            self.completer.request_refresh()
 
-                formatter = TerminalFormatter()
+    def show_databases_locally(self):
+        if not self.can_answer_locally() or "databases" not in self.completer.metadata:
+            return None
 
-                if self.highlight and self.highlight_output and self.highlight_truecolor:
-                    formatter = TerminalTrueColorFormatter(style=get_ch_pygments_style(self.highlight_theme))
+        rows = [[name] for name in sorted(self.completer.metadata["databases"])]
+        return self.local_response("SHOW DATABASES", ("name",), rows)
 
-                if should_highlight_output:
-                    print_func(pygments.highlight(response.data, CHPrettyFormatLexer(), formatter))
-                else:
-                    print_func(response.data, end="")
+    def show_tables_locally(self):
+        if not self.can_answer_locally():
+            return None
 
-        if response.message != "":
-            self.echo.print(response.message)
-            self.echo.print()
+        tables = self.completer.list_tables(self.client.database)
+        if tables is None:
+            return None
 
-        self.echo.success("Ok. ", nl=False)
+        return self.local_response("SHOW TABLES", ("name",), [[name] for name in tables])
 
-        if response.rows is not None:
-            self.echo.print(
-                "{rows_count} row{rows_plural} in set.".format(
-                    rows_count=response.rows,
-                    rows_plural="s" if response.rows != 1 else "",
-                ),
-                end=" ",
-            )
+    def describe_table_locally(self, name):
+        if not self.can_answer_locally():
+            return None
 
-        if self.config.getboolean("main", "timing") and response.time_elapsed is not None:
-            self.echo.print(
-                "Elapsed: {elapsed:.3f} sec. Processed: {rows} rows, {bytes} ({avg_rps} rows/s, {avg_bps}/s)".format(
-                    elapsed=response.time_elapsed,
-                    rows=numberunit_fmt(total_rows),
-                    bytes=sizeof_fmt(total_bytes),
-                    avg_rps=numberunit_fmt(total_rows / max(response.time_elapsed, 0.001)),
-                    avg_bps=sizeof_fmt(total_bytes / max(response.time_elapsed, 0.001)),
-                ),
-                end="",
-            )
+        database, _, table = name.strip().rstrip(";").strip().rpartition(".")
+        database = unquote_identifier(database) or self.client.database
+        rows = self.completer.describe_table(unquote_identifier(table), database)
+        if rows is None:
+            return None
+
+        return self.local_response("DESCRIBE TABLE " + name, DESCRIBE_COLUMNS, rows)
+
+    def find_columns(self, args):
+        args = args.strip().rstrip(";").split()
+        if not args or len(args) > 2:
+            self.echo.error(r"Usage: \find <column pattern> [<type pattern>]")
+            return None
 
-        self.echo.print("\n")
+        if self.completer is None or self.completer.metadata_refreshed_at is None:
+            self.echo.error("Error: The metadata hasn't been loaded yet.")
+            return None
+
+        try:
+            found = self.completer.column_index.find(*args)
+        except re.error as e:
+            self.echo.error("Error: Invalid pattern ({}).".format(e))
+            return None
+
+        fmt = self.format if can_render(self.format) else "PrettyCompact"
+        return self.local_response(r"\find", ("database", "table", "name", "type"), [list(row) for row in found], fmt)
+
+    def format_upload_summary(self, response):
+        message = ""
+        elapsed = max(response.time_elapsed or 0, 0.001)
+        if response.sent_bytes is not None:
+            message += " Sent: {} ({}/s).".format(
+                sizeof_fmt(response.sent_bytes), sizeof_fmt(response.sent_bytes / elapsed)
+            )
+        if response.summary.get("written_rows"):
+            message += " Written: {} rows, {} ({} rows/s).".format(
+                numberunit_fmt(response.summary["written_rows"]),
+                sizeof_fmt(response.summary.get("written_bytes", 0)),
+                numberunit_fmt(response.summary["written_rows"] / elapsed),
+            )
+        return message
 
     def progress_update(self, line):
-        if not self.config.getboolean("main", "timing") and not self.echo.verbose:
+        # Runs for every X-ClickHouse-Progress header, in the thread reading the response
+        progress = parse_progress(line)
+
+        job = self.jobs.current()
+        if job is not None:
+            # Shown by \jobs and \fg
+            job.progress = progress
             return
-        # Parse X-ClickHouse-Progress header
-        now = datetime.now()
-        progress = json.loads(line[23:].decode().strip())
-        progress = {
-            "timestamp": now,
-            "read_rows": int(progress["read_rows"]),
-            "total_rows": int(progress["total_rows"] if "total_rows" in progress else progress["total_rows_to_read"]),
-            "read_bytes": int(progress["read_bytes"]),
-        }
-        # Calculate percentage completed and format initial message
-        progress["percents"] = (
-            int((progress["read_rows"] / progress["total_rows"]) * 100) if progress["total_rows"] > 0 else 0
-        )
-        message = "Progress: {} rows, {}".format(
-            numberunit_fmt(progress["read_rows"]), sizeof_fmt(progress["read_bytes"])
-        )
-        # Calculate row and byte read velocity
-        if self.progress:
-            delta = (now - self.progress["timestamp"]).total_seconds()
-            if delta > 0:
-                rps = (progress["read_rows"] - self.progress["read_rows"]) / delta
-                bps = (progress["read_bytes"] - self.progress["read_bytes"]) / delta
-                message += " ({} rows/s, {}/s)".format(numberunit_fmt(rps), sizeof_fmt(bps))
-        self.progress = progress
-        self.progress_print(message, progress["percents"])
+
+        if not self.config.getboolean("main", "timing") and not self.echo.verbose and not self.loading:
+            return
+        # Progress headers of background requests (e.g. metadata refreshes) must not draw over the prompt
+        if threading.current_thread() is not threading.main_thread():
+            return
+        # Drawn by the ticker of the progress bar
+        self.progress_bar.update(progress)
+
+    def upload_update(self, sent, total):
+        # Runs for each chunk of the request body, in the thread sending it
+        if (self.echo.verbose or self.loading) and threading.current_thread() is threading.main_thread():
+            self.progress_bar.update_upload(sent, total)
 
     def progress_reset(self):
-        if not self.echo.verbose:
+        if not self.echo.verbose and not self.loading:
             return (0, 0)
 
-        progress = self.progress
-        self.progress = None
         clickhouse_cli.helpers.trace_headers_stream = self.progress_update
-        # Clear printed progress (if any)
-        columns = shutil.get_terminal_size((80, 0)).columns
-        sys.stdout.write("\u001b[%dD" % columns + " " * columns)
-        sys.stdout.flush()
+        progress, drawn = self.progress_bar.stop()
+        if drawn and self.loading:
+            self.clear_status()
+        elif drawn:
+            # Clear printed progress
+            columns = shutil.get_terminal_size((80, 0)).columns
+            sys.stdout.write("\u001b[%dD" % columns + " " * columns)
+            sys.stdout.flush()
         # Report totals
         if progress:
             return (progress["read_rows"], progress["read_bytes"])
@@ -552,6 +1371,11 @@ class CLI:
 
     def progress_print(self, message, percents):
         suffix = "%3d%%" % percents
+        if self.loading:
+            # stdout may be redirected to a log; the status line only goes to a terminal
+            self.show_status("{} {}".format(message, suffix))
+            return
+
         columns = shutil.get_terminal_size((80, 0)).columns
         bars_max = columns - (len(message) + len(suffix) + 3)
         bars = int(percents * (bars_max / 100)) if (bars_max > 0) else 0
@@ -591,6 +1415,20 @@ class CLI:
 @click.option("--multiline", "-m", is_flag=True, help="Enable multiline shell")
 @click.option("--stacktrace", is_flag=True, help="Print stacktraces received from the server.")
 @click.option("--vi-mode", is_flag=True, help="Enable Vi input mode")
+@click.option("--stop-on-error", is_flag=True, help="Stop executing a file/stdin script at the first failed statement")
+@click.option(
+    "--parallel",
+    "-j",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Run up to N independent statements of a file/stdin script at once",
+)
+@click.option(
+    "--checkpoint",
+    type=click.Path(dir_okay=False),
+    help="Record the progress of a file/stdin script in this file (by default, in the cache directory)",
+)
+@click.option("--resume", is_flag=True, help="Skip the statements of the script completed by the previous run")
 @click.option("--version", is_flag=True, help="Show the version and exit.")
 @click.argument("files", nargs=-1, type=click.File("rb"))
 def run_cli(
@@ -612,6 +1450,10 @@ def run_cli(
     version,
     files,
     insecure,
+    stop_on_error,
+    parallel,
+    checkpoint,
+    resume,
 ):
     """
     A third-party client for the ClickHouse DBMS.
@@ -663,8 +1505,14 @@ def run_cli(
         cookie,
         insecure,
         headers=headers,
+        stop_on_error=stop_on_error,
+        parallel=parallel,
+        checkpoint=checkpoint,
+        resume=resume,
     )
-    cli.run(query, data_input)
+    if cli.run(query, data_input) is False and data_input and query is None:
+        # Some statements of the script failed
+        sys.exit(1)
     return 0
 
 
@@ -0,0 +1,225 @@
+"""An opt-in cache of query results, valid until the tables the query reads change.
+
+Only `SELECT`s reading MergeTree tables are cached: the active parts of those
+tables (their count, rows and latest modification time) change with every
+insert, merge, mutation or dropped partition, so a single query to
+`system.parts` tells whether a kept result is still what the server would return.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import uuid
+from collections import OrderedDict
+
+from clickhouse_cli.clickhouse.client import Response
+from clickhouse_cli.clickhouse.exceptions import ConnectionError, DBException, TimeoutError
+from clickhouse_cli.clickhouse.scanner import scan_query, strip_comments
+from clickhouse_cli.helpers import quote_string, unquote_identifier
+from clickhouse_cli.ui.parseutils.tables import extract_tables
+
+logger = logging.getLogger("main")
+
+CACHEABLE_VERBS = ("SELECT", "WITH")
+# Results bigger than this aren't worth keeping
+MAX_RESULT_SIZE = 16 << 20
+# Databases whose tables change all the time, or have no parts to tell it
+UNCACHEABLE_DATABASES = ("system", "information_schema", "INFORMATION_SCHEMA")
+# Functions that may return something else every time, or read dictionaries and Join tables the parts don't tell about
+NONDETERMINISTIC_RE = re.compile(
+    r"\b(?:now\w*|today|yesterday|rand\w*|generateUUID\w*|currentUser|currentDatabase|uptime|"
+    r"hostName|timezone|serverUUID|queryID|initialQueryID|rowNumberInAllBlocks|blockNumber|"
+    r"dictGet\w*|dictHas|dictIsIn|joinGet\w*)\s*\(",
+    re.IGNORECASE,
+)
+# Tables the parser may miss, e.g. in subqueries; `ARRAY JOIN` is left out, and a `(` after a name means a function
+NAME = r"(?:`(?:[^`\\]|\\.|``)+`|\"(?:[^\"\\]|\\.|\"\")+\"|\w+)"
+TABLE_RE = re.compile(r"\b(FROM|(?:ARRAY\s+)?JOIN)\s+({0})(?:\s*\.\s*({0}))?(\s*\()?".format(NAME), re.IGNORECASE)
+SPACES_RE = re.compile(r"\s+")
+# A table given as a query parameter can't be told from the text
+IDENTIFIER_PARAMETER_RE = re.compile(r"\{\s*\w+\s*:\s*Identifier\s*\}", re.IGNORECASE)
+
+
+def normalize_query(query):
+    """The text of a query without comments and with its whitespace squeezed, except inside the literals."""
+    text, literals = strip_comments(query)
+    pieces = []
+    pos = 0
+    for start, end in literals + [(len(text), len(text))]:
+        pieces.append(SPACES_RE.sub(" ", text[pos:start]))
+        pieces.append(text[start:end])
+        pos = end
+    return "".join(pieces).strip().rstrip(";").rstrip()
+
+
+def find_tables(query, database):
+    """Return the (database, table) pairs a query reads, or None when some of them can't be told."""
+    tables = set()
+    try:
+        references = extract_tables(query)
+    except Exception:
+        return None
+    for reference in references:
+        if reference.is_function:
+            return None
+        tables.add((reference.schema or database, reference.name))
+
+    text, _ = strip_comments(query)
+    for match in TABLE_RE.finditer(text):
+        if match.group(1).upper().startswith("ARRAY"):
+            continue
+        if match.group(4):
+            # A table function
+            return None
+        if match.group(3):
+            tables.add((unquote_identifier(match.group(2)), unquote_identifier(match.group(3))))
+        else:
+            tables.add((database, unquote_identifier(match.group(2))))
+    return tables
+
+
+class ResultCache(object):
+    """Results kept in memory (the latest `size` of them) and, if `disk_size` (in bytes) is set, in `path`."""
+
+    def __init__(self, client, size=100, path=None, disk_size=0):
+        self.client = client
+        self.size = size
+        self.path = path if disk_size else None
+        self.disk_size = disk_size
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, query, fmt, settings=(), parameters=None):
+        text = normalize_query(query)
+        parameters = tuple(sorted((parameters or {}).items()))
+        # The disk cache outlives the process, another run may have other settings
+        client_settings = tuple(sorted(self.client.settings.items()))
+        return (
+            self.client.url,
+            self.client.user,
+            self.client.database,
+            fmt,
+            client_settings,
+            tuple(settings),
+            parameters,
+            text,
+        )
+
+    def lookup(self, query, fmt, settings=(), parameters=None):
+        """Return the cached response for a query, if it's still valid, and a ticket to `store` its result.
+
+        Both are None when the query can't be cached.
+        """
+        scanned = scan_query(query)
+        if scanned.verb not in CACHEABLE_VERBS or scanned.outfile is not None or NONDETERMINISTIC_RE.search(query):
+            return None, None
+        if IDENTIFIER_PARAMETER_RE.search(query):
+            return None, None
+        tables = find_tables(scanned.text, self.client.database)
+        if not tables or any(database in UNCACHEABLE_DATABASES for database, _ in tables):
+            return None, None
+
+        signature = self.signature(tables)
+        if signature is None:
+            return None, None
+
+        key = self.key(query, fmt, settings, parameters)
+        entry = self.get(key)
+        if entry is None or entry["signature"] != signature:
+            return None, (key, signature)
+
+        response = Response(query, entry["format"], entry["data"])
+        response.rows = entry["rows"]
+        response.origin = "cache"
+        return response, None
+
+    def signature(self, tables):
+        """The state of the parts of the tables, or None if some aren't MergeTree tables (or don't exist)."""
+        pairs = ", ".join("({}, {})".format(quote_string(database), quote_string(table)) for database, table in tables)
+        query = (
+            "SELECT t.database, t.name, t.engine, t.metadata_modification_time, p.parts, p.rows, p.modified "
+            "FROM system.tables AS t LEFT JOIN ("
+            "SELECT database, table, count() AS parts, sum(rows) AS rows, max(modification_time) AS modified "
+            "FROM system.parts WHERE active AND (database, table) IN ({pairs}) GROUP BY database, table"
+            ") AS p ON t.database = p.database AND t.name = p.table "
+            "WHERE (t.database, t.name) IN ({pairs}) ORDER BY t.database, t.name"
+        ).format(pairs=pairs)
+        try:
+            # A session of its own: the main one may be busy with a parallel query
+            response = self.client.query(query, fmt="TabSeparated", session_id=str(uuid.uuid4()))
+        except (ConnectionError, DBException, TimeoutError) as e:
+            logger.debug("Failed to check the tables of a cached query: %s", e)
+            return None
+
+        rows = [line.split("\t") for line in response.data.splitlines()]
+        if len(rows) != len(tables) or not all(row[2].endswith("MergeTree") for row in rows):
+            return None
+        return response.data
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+
+        if self.path is None:
+            return None
+        filename = self.filename(key)
+        try:
+            with open(filename, encoding="utf-8") as f:
+                entry = json.load(f)
+            # The modification time orders the files for the eviction
+            os.utime(filename)
+        except (OSError, ValueError):
+            return None
+        self.remember(key, entry)
+        return entry
+
+    def store(self, ticket, response):
+        """Keep the response of a query `lookup` gave a ticket for."""
+        if ticket is None or not isinstance(response.data, str) or len(response.data) > MAX_RESULT_SIZE:
+            return
+        key, signature = ticket
+        entry = {"signature": signature, "format": response.format, "data": response.data, "rows": response.rows}
+        self.remember(key, entry)
+        if self.path is not None:
+            self.save(key, entry)
+
+    def remember(self, key, entry):
+        with self._lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def filename(self, key):
+        digest = hashlib.sha256(json.dumps(key).encode()).hexdigest()
+        return os.path.join(self.path, digest + ".json")
+
+    def save(self, key, entry):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            filename = self.filename(key)
+            with open(filename + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(filename + ".tmp", filename)
+            self.evict()
+        except OSError as e:
+            logger.debug("Failed to save a cached result: %s", e)
+
+    def evict(self):
+        """Remove the least recently used files until they fit in `disk_size`."""
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith(".json"):
+                stat = os.stat(os.path.join(self.path, name))
+                files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.disk_size:
+                break
+            os.remove(os.path.join(self.path, name))
+            total -= size
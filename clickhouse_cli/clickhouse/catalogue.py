@@ -0,0 +1,124 @@
+import json
+import os
+
+from clickhouse_cli.clickhouse.definitions import (
+    AGGREGATION_FUNCTIONS_BASE,
+    CASE_INSENSITIVE_FUNCTIONS,
+    DATATYPES,
+    FORMATS,
+    FUNCTIONS,
+)
+from clickhouse_cli.config import get_cache_path
+
+# Used when the server doesn't have `system.aggregate_function_combinators`
+AGGREGATION_COMBINATORS = ("If", "Array", "Merge", "State", "MergeState", "ForEach")
+
+CATALOGUE_QUERIES = (
+    ("functions", "SELECT name, is_aggregate, case_insensitive FROM system.functions"),
+    ("combinators", "SELECT name FROM system.aggregate_function_combinators"),
+    ("table_functions", "SELECT name FROM system.table_functions"),
+    ("settings", "SELECT name FROM system.settings"),
+    ("formats", "SELECT name FROM system.formats"),
+    ("datatypes", "SELECT name FROM system.data_type_families"),
+)
+
+
+class Catalogue(object):
+    """Names of the functions, settings, formats and data types known to the server.
+
+    The default instance is built from the static lists in `definitions`, which
+    remain the fallback when the server can't be introspected.
+    """
+
+    fields = (
+        "functions",
+        "aggregate_functions",
+        "case_insensitive_functions",
+        "combinators",
+        "table_functions",
+        "settings",
+        "formats",
+        "datatypes",
+    )
+
+    def __init__(
+        self,
+        functions=FUNCTIONS,
+        aggregate_functions=AGGREGATION_FUNCTIONS_BASE,
+        case_insensitive_functions=CASE_INSENSITIVE_FUNCTIONS,
+        combinators=AGGREGATION_COMBINATORS,
+        table_functions=(),
+        settings=(),
+        formats=FORMATS,
+        datatypes=DATATYPES,
+        source="builtin",
+    ):
+        self.functions = tuple(functions)
+        self.aggregate_functions = tuple(aggregate_functions)
+        self.case_insensitive_functions = tuple(case_insensitive_functions)
+        self.combinators = tuple(combinators)
+        self.table_functions = tuple(table_functions)
+        self.settings = tuple(settings)
+        self.formats = tuple(formats)
+        self.datatypes = tuple(datatypes)
+        self.source = source
+
+    @property
+    def combined_aggregate_functions(self):
+        """Aggregate functions along with every `<function><Combinator>` spelling."""
+        return self.aggregate_functions + tuple(
+            name + combinator for combinator in self.combinators for name in self.aggregate_functions
+        )
+
+    @classmethod
+    def fetch(cls, select):
+        """Introspect the server.
+
+        `select` runs a query and returns its rows as lists of strings.
+        Tables missing on older servers are skipped and keep the static defaults.
+        """
+        result = {}
+        for name, query in CATALOGUE_QUERIES:
+            try:
+                result[name] = [row for row in select(query) if row and row[0]]
+            except Exception:
+                continue
+
+        kwargs = {"source": "server"}
+        if result.get("functions"):
+            rows = result.pop("functions")
+            kwargs["functions"] = sorted(row[0] for row in rows if row[1] == "0")
+            kwargs["aggregate_functions"] = sorted(row[0] for row in rows if row[1] == "1")
+            kwargs["case_insensitive_functions"] = sorted(
+                row[0].upper() for row in rows if len(row) > 2 and row[2] == "1"
+            )
+        for name, rows in result.items():
+            if rows:
+                kwargs[name] = sorted(row[0] for row in rows)
+
+        return cls(**kwargs)
+
+    @staticmethod
+    def cache_path(server_version):
+        return get_cache_path("catalogue", "{}.json".format(".".join(str(part) for part in server_version)))
+
+    @classmethod
+    def load(cls, server_version):
+        """Load the catalogue cached for the given server version, if any."""
+        try:
+            with open(cls.cache_path(server_version)) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        return cls(source="cache", **{field: data[field] for field in cls.fields if field in data})
+
+    def save(self, server_version):
+        try:
+            path = self.cache_path(server_version)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({field: list(getattr(self, field)) for field in self.fields}, f)
+            os.replace(tmp_path, path)
+        except (IOError, OSError):
+            pass
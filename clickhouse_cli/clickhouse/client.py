@@ -1,26 +1,138 @@
+import functools
 import io
+import json
 import logging
+import re
+import threading
 import uuid
+from urllib.parse import urlparse
 
 import pygments
 import requests
 import sqlparse
 from pygments.formatters import TerminalFormatter, TerminalTrueColorFormatter
 from requests.packages.urllib3.util.retry import Retry
-from sqlparse.tokens import Keyword, Newline, Whitespace
 
 from clickhouse_cli import __version__
+from clickhouse_cli.clickhouse import native, tcp
 from clickhouse_cli.clickhouse.definitions import FORMATTABLE_QUERIES
-from clickhouse_cli.clickhouse.exceptions import ConnectionError, DBException, TimeoutError
-from clickhouse_cli.helpers import chain_streams
+from clickhouse_cli.clickhouse.exceptions import (
+    MAX_ERROR_SIZE,
+    ConnectionError,
+    DBException,
+    NativeFormatError,
+    QueryCancelled,
+    TimeoutError,
+)
+from clickhouse_cli.clickhouse.scanner import scan_query, statement_verb
+from clickhouse_cli.helpers import chain_streams, quote_string, stream_size
 from clickhouse_cli.ui.lexer import CHLexer
 from clickhouse_cli.ui.style import Echo, get_ch_pygments_style
 
 USER_AGENT = "clickhouse-cli/{0}".format(__version__)
+# Longer queries aren't echoed back reformatted, sqlparse is too slow for them
+MAX_FORMATTED_QUERY_SIZE = 20000
 
 logger = logging.getLogger("main")
 echo = Echo()
 
+# Formats with a row per line; the ones with names or types have header lines first
+LINE_FORMATS = {"TabSeparated", "TSV", "TabSeparatedRaw", "TSVRaw", "CSV", "TSKV", "LineAsString"}
+# Formats whose results are kept as bytes
+BINARY_FORMATS = {
+    "Native",
+    "RowBinary",
+    "RowBinaryWithNames",
+    "RowBinaryWithNamesAndTypes",
+    "Parquet",
+    "Arrow",
+    "ArrowStream",
+    "ORC",
+    "Avro",
+    "MsgPack",
+    "Protobuf",
+    "CapnProto",
+}
+# Streamed responses are read in chunks this large
+STREAM_CHUNK_SIZE = 65536
+# The blocks at the end of the JSON formats, e.g. `"rows": 3,` and `"statistics": {...}`
+JSON_ROWS_RE = re.compile(rb'\n\t"rows": (\d+)')
+JSON_STATISTICS_RE = re.compile(rb'"rows_read": (\d+),\s*"bytes_read": (\d+)')
+JSON_TAIL_SIZE = 1024
+# What a query over the native protocol can be given; the rest (sessions, query parameters, ...) needs HTTP
+NATIVE_ARGUMENTS = frozenset(["query_id", "settings", "on_progress"])
+# A query failing after a part of its result was sent ends the body with the exception
+EXCEPTION_MARKER = b"DB::Exception"
+TRAILING_EXCEPTION_RE = re.compile(rb"(?:^|\n)(Code: \d+[.,] (?:e\.displayText\(\) = )?DB::Exception)")
+
+
+def find_exception(data):
+    """Return where the exception ending `data` starts, or None.
+
+    The exception of a failing query is the last, newline-terminated segment of the body, and the only one:
+    results with exception texts among their rows (e.g. from system.query_log) are data.
+    """
+    if not data.endswith(b"\n"):
+        return None
+    matches = list(TRAILING_EXCEPTION_RE.finditer(data))
+    if len(matches) != 1:
+        return None
+    start = matches[-1].start(1)
+    # A row with more columns after the text isn't an exception either
+    if b"\t" in data[start : data.index(b"\n", start)]:
+        return None
+    return start
+
+
+def read_tail(response, size=MAX_ERROR_SIZE):
+    """Read a response to the end, keeping only its last `size` bytes."""
+    tail = b""
+    for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+        tail = (tail + chunk)[-size:]
+    return tail.decode("utf-8", "replace")
+
+
+class RowCounter(object):
+    """Counts the rows of a text result in raw chunks, without splitting it into lines.
+
+    Rows are the occurrences of `marker`: a newline, or a newline and the start
+    of a row, e.g. the `│` of the Pretty formats.
+    """
+
+    def __init__(self, marker, header_lines=0):
+        self.marker = marker
+        self.header_lines = header_lines
+        self.count = 0
+        # The end of the previous chunk, for the markers split between two; the first row follows a newline too
+        self.tail = b"\n" if len(marker) > 1 else b""
+
+    @classmethod
+    def for_format(cls, fmt):
+        """Return a counter for the rows of `fmt`, or None if they can't be told apart."""
+        if fmt.startswith("Pretty"):
+            return cls("\n│".encode())
+        if fmt == "Vertical":
+            return cls(b"\nRow ")
+
+        header_lines = 0
+        for suffix, lines in (("WithNamesAndTypes", 2), ("WithNames", 1)):
+            if fmt.endswith(suffix):
+                fmt, header_lines = fmt[: -len(suffix)], lines
+                break
+        if fmt in LINE_FORMATS or fmt.endswith("EachRow"):
+            return cls(b"\n", header_lines)
+        return None
+
+    def feed(self, chunk):
+        if self.tail:
+            chunk = self.tail + chunk
+            self.tail = chunk[1 - len(self.marker) :]
+        self.count += chunk.count(self.marker)
+
+    @property
+    def rows(self):
+        return max(0, self.count - self.header_lines)
+
 
 class Response(object):
     def __init__(self, query, fmt, response="", message="", stream=False):
@@ -31,33 +143,105 @@ class Response(object):
         self.time_elapsed = None
         self.rows = None
         self.status_code = None
+        # Set when the response didn't come from the server, e.g. "local"
+        self.origin = None
+        # The counters of the X-ClickHouse-Summary header, e.g. written_rows of an INSERT
+        self.summary = {}
+        # The size of the request body, when data was sent
+        self.sent_bytes = None
 
         if isinstance(response, requests.Response):
             self.time_elapsed = response.elapsed.total_seconds()
             self.status_code = response.status_code
-
+            try:
+                summary = json.loads(response.headers.get("X-ClickHouse-Summary", "{}"))
+                self.summary = {key: int(value) for key, value in summary.items()}
+            except (TypeError, ValueError):
+                pass
+
+            counter = RowCounter.for_format(fmt) if fmt else None
+            if stream and fmt in BINARY_FORMATS:
+                self.data = response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+                return
             if stream:
-                self.data = response.iter_lines()
-                self.rows = None
+                # The row count is known once the lines are read
+                self.data = self.read_lines(response, counter)
                 return
 
-            self.data = response.text
-
-            lines = self.data.split("\n")
+            content = response.content
+            # Decoding a binary result as text would mangle it
+            self.data = content if fmt in BINARY_FORMATS else response.text
 
-            if self.data == "" or not lines:
+            if not content:
                 self.rows = 0
-            elif fmt.startswith("Pretty"):
-                self.rows = sum(1 for line in lines if line.startswith("│"))
-            elif fmt in ("TabSeparated", "TSV", "CSV"):
-                self.rows = len(lines) - 1
-            elif fmt in ("TabSeparatedWithNames", "TSVWithNames", "CSVWithNames"):
-                self.rows = len(lines) - 2
-            elif fmt in ("TabSeparatedWithNamesAndTypes", "TSVWithNamesAndTypes"):
-                self.rows = len(lines) - 3
+            elif counter is not None:
+                counter.feed(content)
+                self.rows = counter.rows
+            elif fmt.startswith("JSON"):
+                self.read_json_tail(content[-JSON_TAIL_SIZE:])
+            elif "result_rows" in self.summary:
+                self.rows = self.summary["result_rows"]
         else:
             self.data = response
 
+    def read_lines(self, response, counter=None):
+        pending = b""
+        # From the first sign of an exception on, the output is held back until it's told whether the body ends
+        # with it; if it goes on for longer than an exception would, it was just data.
+        held = None
+        for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            if counter is not None:
+                counter.feed(chunk)
+            if held is not None:
+                held += chunk
+                if len(held) <= MAX_ERROR_SIZE:
+                    continue
+                chunk, held = held, None
+            else:
+                chunk = pending + chunk
+                if EXCEPTION_MARKER in chunk:
+                    held = chunk
+                    continue
+
+            lines = chunk.split(b"\n")
+            pending = lines.pop()
+            yield from lines
+
+        if held is not None:
+            start = find_exception(held)
+            if start is not None:
+                yield from held[:start].split(b"\n")[:-1]
+                raise DBException(response, self.query, text=held[start:].decode("utf-8", "replace"))
+            lines = held.split(b"\n")
+            pending = lines.pop()
+            yield from lines
+        if pending:
+            yield pending
+
+        if counter is not None:
+            self.rows = counter.rows
+
+    def read_json_tail(self, tail):
+        """Take the row counts from the blocks that end the JSON formats."""
+        match = None
+        for match in JSON_ROWS_RE.finditer(tail):
+            pass
+        if match is not None:
+            self.rows = int(match.group(1))
+
+        match = JSON_STATISTICS_RE.search(tail)
+        if match is not None:
+            # Final, unlike the summary header which may have been sent before the query ended
+            self.summary["read_rows"], self.summary["read_bytes"] = int(match.group(1)), int(match.group(2))
+
+
+def iter_batches(blocks, batch_size):
+    """Turn the blocks of a Native result into lists of up to `batch_size` row tuples."""
+    for block in blocks:
+        rows = list(zip(*[native.to_list(column) for _, _, column in block]))
+        for start in range(0, len(rows), batch_size):
+            yield rows[start : start + batch_size]
+
 
 class Client(object):
     def __init__(
@@ -73,6 +257,8 @@ class Client(object):
         timeout_retry_delay=0.0,
         verify=True,
         headers=None,
+        native_port=None,
+        compression=None,
     ):
         self.url = url
         self.user = user
@@ -81,11 +267,21 @@ class Client(object):
         self.cookie = cookie
         self.headers = headers or {}
         self.session_id = str(uuid.uuid4())
+        # The settings given to the CLI (--settings and the config), which it sets in the session
+        self.settings = {}
         self.cli_settings = {}
         self.stacktrace = stacktrace
         self.timeout = timeout
         self.session = requests.Session()
         self.verify = verify
+        # query id -> its HTTP response (None until the headers arrive), so the queries can be cancelled
+        self.active = {}
+        self.cancelled = set()
+        self._lock = threading.Lock()
+        # The native protocol is used for the columnar results when its port is set
+        self.native_port = native_port
+        self.compression = compression
+        self._native_idle = []
 
         retries = Retry(
             connect=timeout_retry,
@@ -103,9 +299,11 @@ class Client(object):
         stream,
         data=None,
         compress=False,
+        session_id=None,
+        on_upload=None,
         **kwargs,
     ):
-        params = {"session_id": self.session_id}
+        params = {"session_id": session_id or self.session_id}
         params.update(extra_params)
 
         headers = {"Accept-Encoding": "identity", "User-Agent": USER_AGENT}
@@ -123,35 +321,79 @@ class Client(object):
             query += "\n"
 
         streams = [io.BytesIO(query.encode())]
+        on_read = None
         if data is not None:
             streams.append(data)
-        data_stream = chain_streams(streams)
+            if on_upload is not None:
+                # Known for files, so the progress can tell how much is left
+                sizes = [stream_size(stream) for stream in streams]
+                total = None if None in sizes else sum(sizes)
+                on_read = functools.partial(self._report_upload, on_upload, total)
+
+        data_stream = chain_streams(streams, on_read=on_read)
+
+        query_id = params.get("query_id")
+        if query_id:
+            with self._lock:
+                self.active[query_id] = None
 
         try:
+            # Always streamed, so that the response can be closed by `cancel` while it's read
             response = self.session.request(
                 method,
                 self.url,
                 data=data_stream,
                 params=params,
                 auth=(self.user, self.password),
-                stream=stream,
+                stream=True,
                 headers=headers,
                 timeout=(self.timeout, None),
                 verify=self.verify,
                 **kwargs,
             )
+            if query_id:
+                with self._lock:
+                    if query_id in self.active:
+                        self.active[query_id] = response
+            error = None
+            # The code header tells about a failure even when the status couldn't
+            if response.status_code != 200 or "X-ClickHouse-Exception-Code" in response.headers:
+                error = read_tail(response)
+            elif not stream:
+                tail = response.content[-MAX_ERROR_SIZE:]
+                if EXCEPTION_MARKER in tail:
+                    start = find_exception(tail)
+                    if start is not None:
+                        error = tail[start:].decode("utf-8", "replace")
         except requests.exceptions.ConnectTimeout as e:
             raise TimeoutError(*e.args) from e
         except (
             requests.exceptions.ConnectionError,
             requests.packages.urllib3.exceptions.NewConnectionError,
         ) as e:
+            if query_id in self.cancelled:
+                raise QueryCancelled(query_id) from e
             raise ConnectionError(*e.args) from e
+        except Exception as e:
+            # Reading a response closed by `cancel` fails in all kinds of ways
+            if query_id in self.cancelled:
+                raise QueryCancelled(query_id) from e
+            raise
+        finally:
+            if query_id and not stream:
+                self.forget(query_id)
+
+        if error is not None:
+            raise DBException(response, query=query, text=error)
+
+        result = Response(query, fmt, response, stream=stream)
+        if data is not None:
+            result.sent_bytes = data_stream.raw.bytes_read
+        return result
 
-        if response is not None and response.status_code != 200:
-            raise DBException(response, query=query)
-
-        return Response(query, fmt, response, stream=stream)
+    @staticmethod
+    def _report_upload(on_upload, total, sent):
+        on_upload(sent, total)
 
     def test_query(self):
         params = {"database": self.database}
@@ -163,6 +405,46 @@ class Client(object):
             stream=False,
         )
 
+    def forget(self, query_id):
+        """Stop tracking a finished query."""
+        with self._lock:
+            self.active.pop(query_id, None)
+            self.cancelled.discard(query_id)
+
+    def cancel(self, query_ids=None):
+        """Cancel queries (all the running ones by default) and return the ids the server is killing.
+
+        The responses are closed right away, so no more data is read; then a single
+        asynchronous KILL QUERY stops them on the server.
+        """
+        with self._lock:
+            query_ids = list(self.active if query_ids is None else query_ids)
+            # Queries that already finished were forgotten, and would stay in `cancelled` for good
+            running = [query_id for query_id in query_ids if query_id in self.active]
+            self.cancelled.update(running)
+            responses = [self.active.pop(query_id) for query_id in running]
+
+        for response in responses:
+            if response is not None:
+                response.close()
+
+        if not query_ids:
+            return []
+
+        response = self._query(
+            "POST",
+            "KILL QUERY WHERE query_id IN ({}) ASYNC FORMAT TabSeparated".format(
+                ", ".join(quote_string(query_id) for query_id in query_ids)
+            ),
+            {},
+            fmt="TabSeparated",
+            stream=False,
+            # The sessions of the cancelled queries may still be locked
+            session_id=str(uuid.uuid4()),
+        )
+        # kill_status, query_id, user, query
+        return [line.split("\t")[1] for line in response.data.splitlines() if "\t" in line]
+
     def kill_query(self, query_id):
         return self._query(
             "GET",
@@ -181,14 +463,20 @@ class Client(object):
         verbose=False,
         query_id=None,
         compress=False,
+        session_id=None,
+        settings=None,
+        parameters=None,
         **kwargs,
     ):
-        if query.lstrip()[:6].upper().startswith("INSERT"):
-            query_split = query.split()
-        else:
-            query = sqlparse.format(query, strip_comments=True).rstrip(";")
+        """Run a query; `parameters` are the values of its `{name:Type}` placeholders, substituted by the server."""
+        outfile = None
+
+        # The data of an INSERT may follow the statement, so it's sent as is (and never gets a FORMAT)
+        if statement_verb(query) != "INSERT":
+            scanned = scan_query(query)
+            query = scanned.text
 
-            if verbose and self.cli_settings.get("show_formatted_query"):
+            if verbose and self.cli_settings.get("show_formatted_query") and len(query) <= MAX_FORMATTED_QUERY_SIZE:
                 # Highlight & reformat the SQL query
                 formatted_query = sqlparse.format(
                     query,
@@ -206,67 +494,46 @@ class Client(object):
 
                 print("\n" + pygments.highlight(formatted_query, CHLexer(), formatter))
 
-            # TODO: use sqlparse's parser instead
-            query_split = query.split()
-
-            if not query_split:
+            if not query:
                 return Response(query, fmt)
 
             # Since sessions aren't supported over HTTP, we have to make some quirks:
             # USE database;
-            if query_split[0].upper() == "USE" and len(query_split) == 2:
-                old_database = self.database
-                self.database = query_split[1]
-                try:
-                    self.test_query()
-                except DBException as e:
-                    self.database = old_database
-                    raise e
-
-                return Response(
-                    query,
-                    fmt,
-                    message="Changed the current database to {0}.".format(self.database),
-                )
+            if scanned.verb == "USE":
+                query_split = query.split()
+                if len(query_split) == 2:
+                    old_database = self.database
+                    self.database = query_split[1]
+                    try:
+                        self.test_query()
+                    except DBException as e:
+                        self.database = old_database
+                        raise e
+
+                    return Response(
+                        query,
+                        fmt,
+                        message="Changed the current database to {0}.".format(self.database),
+                    )
 
             # Set response format
-            if query_split[0].upper() in FORMATTABLE_QUERIES and len(query_split) >= 2:
-                if query_split[-2].upper() == "FORMAT":
-                    fmt = query_split[-1]
-                elif query_split[-2].upper() != "FORMAT":
-                    if query_split[0].upper() != "INSERT" or data is not None:
-                        if query[-2:] in (r"\g", r"\G"):
-                            query = query[:-2] + " FORMAT Vertical"
-                        else:
-                            query = query + " FORMAT {fmt}".format(fmt=fmt)
+            if scanned.verb in FORMATTABLE_QUERIES and len(query.split(None, 1)) == 2:
+                if scanned.format is not None:
+                    fmt = scanned.format
+                elif scanned.vertical:
+                    query = query + " FORMAT Vertical"
+                else:
+                    query = query + " FORMAT {fmt}".format(fmt=fmt)
+
+            outfile = scanned.outfile
 
         params = {"database": self.database, "stacktrace": int(self.stacktrace)}
         if query_id:
             params["query_id"] = query_id
-
-        has_outfile = False
-        if query_split[0].upper() == "SELECT":
-            # Detect INTO OUTFILE at the end of the query
-            t_query = [
-                t.value.upper() if t.ttype == Keyword else t.value
-                for t in sqlparse.parse(query)[0]
-                if t.ttype not in (Whitespace, Newline)
-            ]
-
-            try:
-                last_tokens = t_query[-5:]
-                into_pos = last_tokens.index("INTO")
-                has_outfile = into_pos >= 0 and last_tokens.index("OUTFILE") == into_pos + 1
-
-                if has_outfile:
-                    path = last_tokens[into_pos + 2].strip("'")
-                    # Remove `INTO OUTFILE '/path/to/file.out'`
-                    last_tokens.pop(into_pos)
-                    last_tokens.pop(into_pos)
-                    last_tokens.pop(into_pos)
-                    query = " ".join(t_query[:-5] + last_tokens)
-            except ValueError:
-                has_outfile = False
+        if settings:
+            params.update(settings)
+        for name, value in (parameters or {}).items():
+            params["param_" + name] = value
 
         method = "POST"
         response = self._query(
@@ -277,21 +544,107 @@ class Client(object):
             stream=stream,
             data=data,
             compress=compress,
+            session_id=session_id,
             **kwargs,
         )
 
-        if has_outfile:
+        if outfile is not None:
             try:
-                with open(path, "wb") as f:
+                with open(outfile, "wb") as f:
                     if not f:
                         return response
 
                     if stream:
-                        for line in response.iter_lines():
-                            f.write(line)
+                        for line in response.data:
+                            f.write(line if response.format in BINARY_FORMATS else line + b"\n")
+                    elif isinstance(response.data, bytes):
+                        f.write(response.data)
                     else:
                         f.write(response.data.encode())
             except Exception as e:
                 echo.warning("Caught an exception when writing to file: {0}".format(e))
 
         return response
+
+    def query_columns(self, query, **kwargs):
+        """Run a query and return its result as a dict of columns, decoded from the Native format.
+
+        Numbers come as NumPy arrays when NumPy is installed, `array.array`s
+        otherwise; see `native` for the other types.
+        """
+        if self.can_use_native(kwargs):
+            return native.join_blocks(self.native_blocks(query, **kwargs))
+
+        response = self.query(query, fmt="Native", **kwargs)
+        if response.format != "Native":
+            raise NativeFormatError("The result is in the {} format.".format(response.format))
+        return native.decode(response.data or b"")
+
+    def can_use_native(self, kwargs):
+        """Tell whether a query given these arguments can run over the native protocol."""
+        if self.native_port is None:
+            return False
+        # e.g. the revision of the protocol spoken doesn't have query parameters, and there are no HTTP sessions
+        return all(name in NATIVE_ARGUMENTS for name, value in kwargs.items() if value is not None)
+
+    def native_blocks(self, query, query_id=None, settings=None, on_progress=None):
+        """Run a query over the native protocol, yielding the blocks of its result (see `tcp.Connection.execute`).
+
+        Idle connections are kept for the next queries; closing the generator early cancels the query.
+        """
+        with self._lock:
+            connection = self._native_idle.pop() if self._native_idle else None
+        if connection is None:
+            url = urlparse(self.url)
+            connection = tcp.Connection(
+                url.hostname,
+                self.native_port,
+                self.user,
+                self.password,
+                self.database,
+                secure=url.scheme == "https",
+                verify=self.verify,
+                timeout=self.timeout,
+                compression=self.compression,
+            )
+        elif connection.database != self.database:
+            # The database is set for the whole connection
+            connection.disconnect()
+            connection.database = self.database
+
+        try:
+            yield from connection.execute(query, query_id or "", settings, on_progress)
+        finally:
+            if connection.sock is not None:
+                with self._lock:
+                    self._native_idle.append(connection)
+
+    def iter_rows(self, query, batch_size=10000, query_id=None, **kwargs):
+        """Run a query and yield its rows as lists of up to `batch_size` tuples of Python values.
+
+        The result is streamed in the Native format and decoded a block at a
+        time, so memory use doesn't grow with its size. Leaving the loop early
+        cancels the query on the server.
+        """
+        if self.can_use_native(kwargs):
+            yield from iter_batches(self.native_blocks(query, query_id=query_id, **kwargs), batch_size)
+            return
+
+        query_id = query_id or str(uuid.uuid4())
+        response = self.query(query, fmt="Native", stream=True, query_id=query_id, **kwargs)
+        if response.format != "Native":
+            self.forget(query_id)
+            raise NativeFormatError("The result is in the {} format.".format(response.format))
+
+        try:
+            yield from iter_batches(native.iter_blocks(response.data or ()), batch_size)
+        except native.EmbeddedException as e:
+            raise DBException(None, query, text=e.text) from None
+        except GeneratorExit:
+            try:
+                self.cancel([query_id])
+            except (ConnectionError, DBException, TimeoutError) as e:
+                logger.warning("Failed to cancel query %s: %s", query_id, e)
+            raise
+        finally:
+            self.forget(query_id)
@@ -1,6 +1,6 @@
 from clickhouse_cli.clickhouse.sqlparse_patch import KEYWORDS as sqlparse_keywords
 
-# TODO: Run `SELECT name FROM system.functions` instead of this hardcoding
+# Fallback for servers that can't be introspected; see `clickhouse_cli.clickhouse.catalogue`
 FUNCTIONS = (
     "abs",
     "acos",
@@ -850,6 +850,16 @@ FORMATTABLE_QUERIES = (
 
 KEYWORDS = tuple(sqlparse_keywords.keys())
 
+DESCRIBE_COLUMNS = (
+    "name",
+    "type",
+    "default_type",
+    "default_expression",
+    "comment",
+    "codec_expression",
+    "ttl_expression",
+)
+
 EXIT_COMMANDS = (
     "exit",
     "quit",
@@ -897,10 +907,18 @@ REDIRECTION_COMMANDS = (
     r"\d",
     r"\d+",
     r"\dt",
+    r"\d!",
+    r"\d+!",
+    r"\dt!",
+    r"\l!",
     r"\c",
     r"\l",
     r"\ps",
     r"\kill",
+    r"\find",
+    r"\history",
+    r"\jobs",
+    r"\fg",
 )
 
 INTERNAL_COMMANDS = EXIT_COMMANDS + HELP_COMMANDS + REDIRECTION_COMMANDS
@@ -0,0 +1,214 @@
+import re
+from collections import defaultdict, namedtuple
+
+from clickhouse_cli.clickhouse.scanner import scan_query
+from clickhouse_cli.helpers import INSERT_VALUES_RE, unquote_identifier
+from clickhouse_cli.ui.parseutils.tables import extract_tables
+
+NAME = r"((?:`(?:[^`\\]|\\.)*`|\"(?:[^\"\\]|\\.)*\"|[\w$]+)(?:\.(?:`(?:[^`\\]|\\.)*`|\"(?:[^\"\\]|\\.)*\"|[\w$]+))?)"
+NAME_RE = re.compile(NAME)
+NAME_PART_RE = re.compile(r"`(?:[^`\\]|\\.)*`|\"(?:[^\"\\]|\\.)*\"|[\w$]+")
+
+# The objects each kind of statement changes
+WRITE_TARGET_RES = (
+    re.compile(r"INSERT\s+INTO\s+(?:TABLE\s+)?(?!FUNCTION\b)" + NAME, re.IGNORECASE),
+    re.compile(
+        r"(?:CREATE|ATTACH)\s+(?:OR\s+REPLACE\s+)?(?:TEMPORARY\s+)?(?:MATERIALIZED\s+|LIVE\s+|WINDOW\s+)?"
+        r"(?:TABLE|VIEW|DICTIONARY)\s+(?:IF\s+NOT\s+EXISTS\s+)?" + NAME,
+        re.IGNORECASE,
+    ),
+    re.compile(
+        r"(?:DROP|OPTIMIZE|DETACH|ALTER|CHECK)\s+(?:TEMPORARY\s+)?(?:TABLE|VIEW|DICTIONARY)\s+"
+        r"(?:IF\s+EXISTS\s+)?" + NAME,
+        re.IGNORECASE,
+    ),
+    # The only one where TABLE may be left out; TRUNCATE DATABASE and TRUNCATE ALL TABLES are barriers
+    re.compile(
+        r"TRUNCATE\s+(?:TEMPORARY\s+)?(?:TABLE\s+)?(?!(?:DATABASE|ALL)\b)(?:IF\s+EXISTS\s+)?" + NAME,
+        re.IGNORECASE,
+    ),
+    re.compile(r"DELETE\s+FROM\s+" + NAME, re.IGNORECASE),
+)
+MV_TARGET_RE = re.compile(r"\bTO\s+" + NAME, re.IGNORECASE)
+RENAME_RE = re.compile(r"(?:RENAME|EXCHANGE)\s+(?:TABLES?|DICTIONARY|DICTIONARIES)\s+(.*)", re.IGNORECASE | re.DOTALL)
+INSPECT_RE = re.compile(
+    r"(?:DESC|DESCRIBE|EXISTS)\s+(?:TABLE\s+|VIEW\s+|DICTIONARY\s+)?(?!SELECT\b)" + NAME, re.IGNORECASE
+)
+# Anything a statement may read: tables and table functions after FROM/JOIN (subqueries included)...
+SOURCE_RE = re.compile(r"\b(?:FROM|JOIN)\s+" + NAME + r"(\s*\()?", re.IGNORECASE)
+# ...`x IN table` and `CREATE TABLE ... AS table`
+REFERENCE_RE = re.compile(r"\b(?:IN|AS)\s+" + NAME + r"(?![\w$.`\"]|\s*\()", re.IGNORECASE)
+# Temporary tables only exist in the session that created them
+TEMPORARY_RE = re.compile(r"\bTEMPORARY\b", re.IGNORECASE)
+# Objects read behind the scenes, which can't be tracked
+HIDDEN_READ_RE = re.compile(r"\b(?:dictGet\w*|dictHas|joinGet\w*)\s*\(", re.IGNORECASE)
+
+READ_VERBS = ("SELECT", "WITH", "DESC", "DESCRIBE", "EXISTS")
+WRITE_VERBS = ("INSERT", "CREATE", "ATTACH", "DROP", "TRUNCATE", "OPTIMIZE", "DETACH", "ALTER", "CHECK", "DELETE")
+RENAME_VERBS = ("RENAME", "EXCHANGE")
+# Table functions that don't touch other tables
+PURE_TABLE_FUNCTIONS = frozenset(["numbers", "numbers_mt", "zeros", "zeros_mt", "generaterandom", "values", "null"])
+# Words that follow FROM/IN/AS without being a table
+NOT_TABLES = frozenset(["select", "with", "partition", "cluster", "final", "infile", "outfile", "format", "settings"])
+# sqlparse is slow, huge statements are only matched with regexes
+MAX_PARSED_SIZE = 65536
+
+Access = namedtuple("Access", ["reads", "writes", "barrier"])
+
+
+def normalize_name(name, database):
+    """`db.table` or `table` -> (db, table), without quotes."""
+    parts = [unquote_identifier(part) for part in NAME_PART_RE.findall(name)]
+    if len(parts) == 1:
+        return (database, parts[0])
+    return (parts[0], parts[1])
+
+
+def statement_access(statement, database):
+    """Find the tables a statement reads and writes.
+
+    Returns an `Access`; `barrier` is set when the statement must not run
+    concurrently with anything (USE, SET, and whatever can't be analyzed).
+    """
+    barrier = Access(frozenset(), frozenset(), True)
+
+    # Don't scan the rows of an INSERT
+    match = INSERT_VALUES_RE.match(statement[:MAX_PARSED_SIZE])
+    scanned = scan_query(match.group(1) if match else statement)
+    text, verb = scanned.text, scanned.verb
+
+    if verb not in READ_VERBS + WRITE_VERBS + RENAME_VERBS or HIDDEN_READ_RE.search(text):
+        return barrier
+
+    writes = set()
+    if verb in RENAME_VERBS:
+        match = RENAME_RE.match(text)
+        if match is None:
+            return barrier
+        for name in NAME_RE.findall(match.group(1)):
+            if name.upper() not in ("TO", "AND", "ON", "CLUSTER"):
+                writes.add(normalize_name(name, database))
+    elif verb in WRITE_VERBS:
+        for regex in WRITE_TARGET_RES:
+            match = regex.match(text)
+            if match is not None:
+                writes.add(normalize_name(match.group(1), database))
+                break
+        else:
+            # e.g. CREATE DATABASE, DROP USER
+            return barrier
+
+        if verb == "CREATE":
+            match = MV_TARGET_RE.search(text)
+            if match is not None:
+                writes.add(normalize_name(match.group(1), database))
+
+    reads = set()
+    match = INSPECT_RE.match(text)
+    if match is not None:
+        reads.add(normalize_name(match.group(1), database))
+    for name, call in SOURCE_RE.findall(text):
+        if call:
+            if name.lower() not in PURE_TABLE_FUNCTIONS:
+                return barrier
+        elif name.lower() not in NOT_TABLES:
+            reads.add(normalize_name(name, database))
+    for name in REFERENCE_RE.findall(text):
+        if name.lower() not in NOT_TABLES:
+            reads.add(normalize_name(name, database))
+
+    if len(text) <= MAX_PARSED_SIZE:
+        try:
+            tables = extract_tables(text)
+        except Exception:
+            return barrier
+        for table in tables:
+            if table.is_function:
+                if table.name.lower() not in PURE_TABLE_FUNCTIONS:
+                    return barrier
+            else:
+                schema = unquote_identifier(table.schema) if table.schema else database
+                reads.add((schema, unquote_identifier(table.name)))
+
+    return Access(frozenset(reads - writes), frozenset(writes), False)
+
+
+class DependencyGraph(object):
+    """Orders the statements of a script by the tables they touch.
+
+    A statement depends on the previous writer of every table it reads, and on
+    the previous readers and writer of every table it writes; a barrier depends
+    on everything before it and everything after it depends on the barrier.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.count = 0
+        self.last_barrier = None
+        self.since_barrier = []
+        self.writer = {}
+        self.readers = defaultdict(list)
+        # Tables written through materialized views created in the script
+        self.triggers = defaultdict(set)
+        # Set once the script uses temporary tables, which tie it to a single session
+        self.session_bound = False
+
+    def add(self, statement):
+        """Register the next statement.
+
+        Returns the indexes of the statements it depends on, and whether it's a barrier.
+        """
+        index = self.count
+        self.count += 1
+
+        scanned = scan_query(statement[:MAX_PARSED_SIZE])
+        if TEMPORARY_RE.search(scanned.text):
+            self.session_bound = True
+
+        if scanned.verb == "USE":
+            parts = scanned.text.split()
+            if len(parts) == 2:
+                self.database = unquote_identifier(parts[1])
+            access = Access(frozenset(), frozenset(), True)
+        else:
+            access = statement_access(statement, self.database)
+
+        if access.barrier:
+            deps = set(self.since_barrier)
+            if self.last_barrier is not None:
+                deps.add(self.last_barrier)
+            self.last_barrier = index
+            self.since_barrier = []
+            self.writer.clear()
+            self.readers.clear()
+            return deps, True
+
+        # An INSERT also writes the targets of the materialized views over the table
+        writes = set(access.writes)
+        queue = list(access.writes)
+        while queue:
+            for table in self.triggers.get(queue.pop(), ()):
+                if table not in writes:
+                    writes.add(table)
+                    queue.append(table)
+        if scanned.verb == "CREATE" and "MATERIALIZED" in scanned.text[:64].upper():
+            for table in access.reads:
+                self.triggers[table].update(access.writes)
+
+        deps = set()
+        if self.last_barrier is not None:
+            deps.add(self.last_barrier)
+        for table in access.reads:
+            if table in self.writer:
+                deps.add(self.writer[table])
+        for table in writes:
+            if table in self.writer:
+                deps.add(self.writer[table])
+            deps.update(self.readers.pop(table, ()))
+
+        for table in access.reads:
+            self.readers[table].append(index)
+        for table in writes:
+            self.writer[table] = index
+        self.since_barrier.append(index)
+        return deps, False
@@ -1,5 +1,13 @@
 import re
 
+# Only this much of the end of an error body is read and parsed
+MAX_ERROR_SIZE = 65536
+
+# Where the exception starts, e.g. after the partial output of a query failing while it's streamed
+EXCEPTION_START_RE = re.compile(r"(?:^|\n)(Code: (\d+)[.,] )")
+# Newer servers: `Code: 60. DB::Exception: ... (UNKNOWN_TABLE)[, Stack trace ...:\n\n...] (version ...)`
+STACK_TRACE_RE = re.compile(r", Stack trace \([^)]*\):\s*")
+
 
 class DBException(Exception):
     regex = (
@@ -8,23 +16,36 @@ class DBException(Exception):
         r"(Stack trace:\n\n(?P<stacktrace>[\w\W]*)\n)?"
     )
 
-    def __init__(self, response, query):
+    def __init__(self, response, query, text=None):
         self.response = response
         self.query = query
         self.error_code = 0
         self.error = ""
         self.stacktrace = ""
 
+        if text is None:
+            text = response.text[-MAX_ERROR_SIZE:]
+        match = EXCEPTION_START_RE.search(text)
+        self.text = text[match.start(1) :] if match else text
+
         try:
-            info = re.search(self.regex, response.text).groupdict()
+            info = re.search(self.regex, self.text).groupdict()
             self.error_code = info["code"]
             self.error = info["text"]
             self.stacktrace = info["stacktrace"] or ""
         except Exception:
-            self.error = self.response.text
+            parts = STACK_TRACE_RE.split(self.text.strip(), maxsplit=1)
+            self.error = parts[0]
+            self.stacktrace = parts[1] if len(parts) > 1 else ""
+            if match:
+                self.error_code = match.group(2)
+
+        # Sent by the server unless the failure came after the response headers
+        headers = getattr(response, "headers", None) or {}
+        self.error_code = headers.get("X-ClickHouse-Exception-Code", self.error_code)
 
     def __str__(self):
-        return "Query:\n{0}\n\nResponse:\n{1}".format(self.query, self.response.text)
+        return "Query:\n{0}\n\nResponse:\n{1}".format(self.query, self.text)
 
 
 class TimeoutError(Exception):
@@ -33,3 +54,11 @@ class TimeoutError(Exception):
 
 class ConnectionError(Exception):
     pass
+
+
+class QueryCancelled(Exception):
+    pass
+
+
+class NativeFormatError(Exception):
+    pass
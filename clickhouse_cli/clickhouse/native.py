@@ -0,0 +1,468 @@
+"""Decoding of results in the Native format, ClickHouse's own columnar one, straight into columns.
+
+Numbers come as NumPy arrays when NumPy is installed, `array.array`s otherwise;
+dates and times as `datetime64` arrays or lists of `date`/`datetime` (naive, in
+UTC), and the other types as lists of Python objects.
+"""
+import array
+import datetime
+import decimal
+import ipaddress
+import re
+import struct
+import sys
+import uuid
+
+from clickhouse_cli.clickhouse.exceptions import NativeFormatError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Fixed-size numbers, by the typecodes of `array`, which NumPy understands too
+NUMBER_TYPECODES = {
+    "UInt8": "B",
+    "UInt16": "H",
+    "UInt32": "I",
+    "UInt64": "Q",
+    "Int8": "b",
+    "Int16": "h",
+    "Int32": "i",
+    "Int64": "q",
+    "Float32": "f",
+    "Float64": "d",
+}
+ITEM_SIZES = {typecode: array.array(typecode).itemsize for typecode in NUMBER_TYPECODES.values()}
+# Integers too wide for arrays: size in bytes, signed
+WIDE_INTEGERS = {"UInt128": (16, False), "UInt256": (32, False), "Int128": (16, True), "Int256": (32, True)}
+DECIMAL_SIZES = {"Decimal32": 4, "Decimal64": 8, "Decimal128": 16, "Decimal256": 32}
+# Enough for the 76 digits of Decimal256, the default context rounds to 28
+DECIMAL_CONTEXT = decimal.Context(prec=80)
+# Types that only tell how the values are computed or stored
+WRAPPER_TYPES = ("SimpleAggregateFunction",)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+EPOCH_DATE = datetime.date(1970, 1, 1)
+DATETIME64_UNITS = {0: "s", 3: "ms", 6: "us", 9: "ns"}
+
+NAMED_ELEMENT_RE = re.compile(r"(\w+|`[^`]*`)\s+(\S.*)", re.DOTALL)
+ENUM_VALUE_RE = re.compile(r"'((?:[^'\\]|\\.)*)'\s*=\s*(-?\d+)")
+
+# The serialization of LowCardinality columns: the version of the keys, and the flags of the index granules
+LOW_CARDINALITY_VERSION = 1
+NEED_GLOBAL_DICTIONARY = 1 << 8
+HAS_ADDITIONAL_KEYS = 1 << 9
+INDEX_TYPECODES = ("B", "H", "I", "Q")
+
+# A query failing after a part of its result was sent ends it with the text of the exception, between two blocks
+EXCEPTION_RE = re.compile(rb"Code: \d+[.,] (?:e\.displayText\(\) = )?DB::Exception")
+MAX_EXCEPTION_SIZE = 65536
+
+
+class Truncated(NativeFormatError):
+    """The data ends in the middle of a block."""
+
+
+class EmbeddedException(NativeFormatError):
+    """The server failed after a part of the result was sent; `text` is its exception."""
+
+    def __init__(self, text):
+        super().__init__(text)
+        self.text = text
+
+
+def parse_type(name):
+    """Split a type into its name and arguments, e.g. `Map(String, UInt8)` into `("Map", ["String", "UInt8"])`."""
+    name = name.strip()
+    start = name.find("(")
+    if start == -1 or not name.endswith(")"):
+        return name, []
+    return name[:start], split_arguments(name[start + 1 : -1])
+
+
+def split_arguments(text):
+    arguments = []
+    depth = 0
+    quote = None
+    start = 0
+    escaped = False
+    for i, char in enumerate(text):
+        if quote:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char in "'`\"":
+            quote = char
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            arguments.append(text[start:i].strip())
+            start = i + 1
+    arguments.append(text[start:].strip())
+    return arguments
+
+
+def element_types(arguments):
+    """The types of the elements of a Tuple, which may be named: `Tuple(a UInt8, b String)`."""
+    types = []
+    for argument in arguments:
+        match = NAMED_ELEMENT_RE.fullmatch(argument)
+        types.append(match.group(2) if match else argument)
+    return types
+
+
+def to_list(values):
+    return values.tolist() if hasattr(values, "tolist") else list(values)
+
+
+class Reader(object):
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.position = 0
+
+    def at_end(self):
+        return self.position >= len(self.data)
+
+    def read(self, size):
+        end = self.position + size
+        if end > len(self.data):
+            raise Truncated("Unexpected end of data at byte {}.".format(self.position))
+        chunk = self.data[self.position : end]
+        self.position = end
+        return chunk
+
+    def read_varint(self):
+        data, position = self.data, self.position
+        result = shift = 0
+        while True:
+            if position >= len(data):
+                raise Truncated("Unexpected end of data at byte {}.".format(position))
+            byte = data[position]
+            position += 1
+            result |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        self.position = position
+        return result
+
+    def read_string(self):
+        return bytes(self.read(self.read_varint()))
+
+    def read_uint64(self):
+        return struct.unpack("<Q", self.read(8))[0]
+
+    def read_numbers(self, typecode, rows):
+        buffer = self.read(rows * ITEM_SIZES[typecode])
+        if numpy is not None:
+            return numpy.frombuffer(buffer, dtype=numpy.dtype(typecode).newbyteorder("<"))
+        values = array.array(typecode)
+        values.frombytes(buffer)
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values
+
+    def read_integers(self, size, signed, rows):
+        buffer = self.read(rows * size)
+        return [int.from_bytes(buffer[i : i + size], "little", signed=signed) for i in range(0, rows * size, size)]
+
+    def read_strings(self, rows):
+        # The loop over the rows can't be avoided, so it's kept tight
+        data, position, end = self.data, self.position, len(self.data)
+        values = []
+        for _ in range(rows):
+            length = shift = 0
+            while True:
+                if position >= end:
+                    raise Truncated("Unexpected end of data at byte {}.".format(position))
+                byte = data[position]
+                position += 1
+                length |= (byte & 0x7F) << shift
+                if byte < 0x80:
+                    break
+                shift += 7
+            if position + length > end:
+                raise Truncated("Unexpected end of data at byte {}.".format(position))
+            values.append(str(data[position : position + length], "utf-8", "replace"))
+            position += length
+        self.position = position
+        return values
+
+    def read_block(self, info=False):
+        """Read a block, as a list of (name, type, column).
+
+        Blocks sent over the native protocol start with `info` fields, which are skipped.
+        """
+        while info:
+            field = self.read_varint()
+            if field == 1:
+                # is_overflows
+                self.read(1)
+            elif field == 2:
+                # bucket_num
+                self.read(4)
+            elif field != 0:
+                raise NativeFormatError("Unknown block info field {}.".format(field))
+            info = field != 0
+
+        columns = self.read_varint()
+        rows = self.read_varint()
+        block = []
+        for _ in range(columns):
+            name = self.read_string().decode("utf-8", "replace")
+            type_name = self.read_string().decode()
+            # Empty columns have no data at all
+            if rows:
+                self.read_prefix(type_name)
+            block.append((name, type_name, self.read_column(type_name, rows)))
+        return block
+
+    def read_prefix(self, type_name):
+        """Read what precedes the data of a column, which only LowCardinality columns have."""
+        name, arguments = parse_type(type_name)
+        if name == "LowCardinality":
+            version = self.read_uint64()
+            if version != LOW_CARDINALITY_VERSION:
+                raise NativeFormatError("Unsupported LowCardinality serialization version {}.".format(version))
+        elif name == "Tuple":
+            for element in element_types(arguments):
+                self.read_prefix(element)
+        elif name in ("Array", "Nullable", "Map"):
+            for argument in arguments:
+                self.read_prefix(argument)
+        elif name in WRAPPER_TYPES:
+            self.read_prefix(arguments[-1])
+
+    def read_column(self, type_name, rows):
+        name, arguments = parse_type(type_name)
+
+        if name in NUMBER_TYPECODES:
+            return self.read_numbers(NUMBER_TYPECODES[name], rows)
+        if name == "String":
+            return self.read_strings(rows)
+        if name in WIDE_INTEGERS:
+            return self.read_integers(*WIDE_INTEGERS[name], rows)
+        if name == "Bool":
+            values = self.read_numbers("B", rows)
+            return values.astype(bool) if numpy is not None else [bool(value) for value in values]
+        if name == "Date":
+            return self.read_dates(self.read_numbers("H", rows))
+        if name == "Date32":
+            return self.read_dates(self.read_numbers("i", rows))
+        if name == "DateTime":
+            seconds = self.read_numbers("I", rows)
+            if numpy is not None:
+                return seconds.astype("datetime64[s]")
+            return [EPOCH + datetime.timedelta(seconds=value) for value in seconds]
+        if name == "DateTime64":
+            return self.read_datetimes64(int(arguments[0]), rows)
+        if name in DECIMAL_SIZES or name == "Decimal":
+            return self.read_decimals(name, arguments, rows)
+        if name in ("Enum8", "Enum16"):
+            names = {
+                int(value): label.replace("\\'", "'")
+                for label, value in (ENUM_VALUE_RE.fullmatch(argument).groups() for argument in arguments)
+            }
+            codes = self.read_numbers("b" if name == "Enum8" else "h", rows)
+            return [names.get(value, value) for value in to_list(codes)]
+        if name == "FixedString":
+            size = int(arguments[0])
+            buffer = self.read(rows * size)
+            return [bytes(buffer[i : i + size]) for i in range(0, rows * size, size)]
+        if name == "UUID":
+            buffer = self.read(rows * 16)
+            return [uuid.UUID(int=high << 64 | low) for high, low in struct.iter_unpack("<QQ", buffer)]
+        if name == "IPv4":
+            return [ipaddress.IPv4Address(value) for value in to_list(self.read_numbers("I", rows))]
+        if name == "IPv6":
+            buffer = self.read(rows * 16)
+            return [ipaddress.IPv6Address(bytes(buffer[i : i + 16])) for i in range(0, rows * 16, 16)]
+        if name == "Nothing":
+            self.read(rows)
+            return [None] * rows
+        if name == "Nullable":
+            nulls = self.read(rows)
+            values = to_list(self.read_column(arguments[0], rows))
+            return [None if null else value for null, value in zip(nulls, values)]
+        if name == "Array":
+            offsets = to_list(self.read_numbers("Q", rows))
+            values = self.read_column(arguments[0], offsets[-1] if offsets else 0)
+            return [values[start:end] for start, end in zip([0] + offsets[:-1], offsets)]
+        if name == "Map":
+            offsets = to_list(self.read_numbers("Q", rows))
+            size = offsets[-1] if offsets else 0
+            keys = to_list(self.read_column(arguments[0], size))
+            values = to_list(self.read_column(arguments[1], size))
+            return [dict(zip(keys[start:end], values[start:end])) for start, end in zip([0] + offsets[:-1], offsets)]
+        if name == "Tuple":
+            elements = [to_list(self.read_column(element, rows)) for element in element_types(arguments)]
+            return list(zip(*elements)) if elements else [()] * rows
+        if name == "LowCardinality":
+            return self.read_low_cardinality(arguments[0], rows)
+        if name in WRAPPER_TYPES:
+            return self.read_column(arguments[-1], rows)
+
+        raise NativeFormatError("Unsupported type: {}.".format(type_name))
+
+    def read_dates(self, days):
+        if numpy is not None:
+            return days.astype("datetime64[D]")
+        return [EPOCH_DATE + datetime.timedelta(days=value) for value in days]
+
+    def read_datetimes64(self, precision, rows):
+        ticks = self.read_numbers("q", rows)
+        if numpy is not None:
+            if precision in DATETIME64_UNITS:
+                return ticks.astype("datetime64[{}]".format(DATETIME64_UNITS[precision]))
+            return (ticks * 10 ** (9 - precision)).astype("datetime64[ns]")
+        if precision <= 6:
+            return [EPOCH + datetime.timedelta(microseconds=value * 10 ** (6 - precision)) for value in ticks]
+        return [EPOCH + datetime.timedelta(microseconds=value // 10 ** (precision - 6)) for value in ticks]
+
+    def read_decimals(self, name, arguments, rows):
+        if name == "Decimal":
+            precision, scale = int(arguments[0]), int(arguments[1])
+            size = 4 if precision <= 9 else 8 if precision <= 18 else 16 if precision <= 38 else 32
+        else:
+            size, scale = DECIMAL_SIZES[name], int(arguments[0])
+        values = self.read_integers(size, True, rows)
+        return [decimal.Decimal(value).scaleb(-scale, DECIMAL_CONTEXT) for value in values]
+
+    def read_low_cardinality(self, type_name, rows):
+        name, arguments = parse_type(type_name)
+        nullable = name == "Nullable"
+        if nullable:
+            # The dictionary has the values of the nested type, and NULL is its first key
+            type_name = arguments[0]
+
+        values = []
+        dictionary = []
+        while len(values) < rows:
+            flags = self.read_uint64()
+            if flags & NEED_GLOBAL_DICTIONARY:
+                raise NativeFormatError("Unsupported LowCardinality serialization with a global dictionary.")
+            if flags & HAS_ADDITIONAL_KEYS:
+                dictionary = to_list(self.read_column(type_name, self.read_uint64()))
+                if nullable and dictionary:
+                    dictionary[0] = None
+            indexes = self.read_numbers(INDEX_TYPECODES[flags & 0xFF], self.read_uint64())
+            values.extend(dictionary[index] for index in to_list(indexes))
+        return values
+
+
+class StreamReader(Reader):
+    """A Reader pulling its data as it's needed, e.g. from a socket.
+
+    `read_some(size)` returns the next bytes, as many as it can up to `size` and
+    at least one, or nothing at the end of the data.
+    """
+
+    def __init__(self, read_some):
+        super().__init__(b"")
+        self.read_some = read_some
+
+    def fill(self, size):
+        """Make `size` bytes available from the position on."""
+        chunks = [self.data[self.position :]]
+        available = len(chunks[0])
+        while available < size:
+            chunk = self.read_some(size - available)
+            if not chunk:
+                raise Truncated("Unexpected end of data.")
+            chunks.append(chunk)
+            available += len(chunk)
+        self.data = memoryview(b"".join(chunks))
+        self.position = 0
+
+    def read(self, size):
+        if self.position + size > len(self.data):
+            self.fill(size)
+        return super().read(size)
+
+    def read_varint(self):
+        result = shift = 0
+        while True:
+            if self.position >= len(self.data):
+                self.fill(1)
+            byte = self.data[self.position]
+            self.position += 1
+            result |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def read_strings(self, rows):
+        return [str(self.read(self.read_varint()), "utf-8", "replace") for _ in range(rows)]
+
+
+def concatenate(parts):
+    if numpy is not None and isinstance(parts[0], numpy.ndarray):
+        return numpy.concatenate(parts)
+    column = parts[0][:]
+    for part in parts[1:]:
+        column.extend(part)
+    return column
+
+
+def decode(data):
+    """Decode a result in the Native format into a dict of its columns, by name."""
+    reader = Reader(data)
+    blocks = []
+    while not reader.at_end():
+        blocks.append(reader.read_block())
+    return join_blocks(blocks)
+
+
+def join_blocks(blocks):
+    """Join the columns of a result's blocks into a dict of columns, by name."""
+    parts = {}
+    for block in blocks:
+        for name, _, column in block:
+            parts.setdefault(name, []).append(column)
+    return {name: concatenate(columns) for name, columns in parts.items()}
+
+
+def iter_blocks(chunks):
+    """Decode a Native result as its `chunks` arrive, yielding a block at a time as a list of (name, type, column).
+
+    A block is decoded again once at least twice as much data is held, so
+    blocks much larger than the chunks are decoded in a few attempts.
+    """
+    chunks = iter(chunks)
+    buffer = bytearray()
+    wanted = 1
+    ended = False
+    while True:
+        while not ended and len(buffer) < wanted:
+            chunk = next(chunks, None)
+            if chunk is None:
+                ended = True
+            else:
+                buffer += chunk
+        if not buffer:
+            return
+
+        if EXCEPTION_RE.match(buffer):
+            for chunk in chunks:
+                buffer += chunk
+                del buffer[:-MAX_EXCEPTION_SIZE]
+            raise EmbeddedException(buffer.decode("utf-8", "replace"))
+
+        reader = Reader(bytes(buffer))
+        try:
+            block = reader.read_block()
+        except Truncated:
+            if ended:
+                raise
+            wanted = len(buffer) * 2
+            continue
+
+        yield block
+        del buffer[: reader.position]
+        wanted = 1
@@ -0,0 +1,276 @@
+import codecs
+import re
+from bisect import bisect_right
+from collections import namedtuple
+
+# Where a literal or a comment may start; the text in between is copied as is
+SPECIAL_RE = re.compile(r"['\"`]|--|/\*")
+BLOCK_COMMENT_RE = re.compile(r"/\*|\*/")
+# Quoted literals, with backslash escapes and doubled quotes ("unrolled" so that unterminated ones fail fast)
+LITERAL_END_RE = {
+    quote: re.compile(r"[^{0}\\]*(?:(?:\\.|{0}{0})[^{0}\\]*)*{0}".format(quote), re.DOTALL) for quote in "'\"`"
+}
+TOKEN_RE = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"|`(?:[^`\\]|\\.|``)*`|[(),;]|[^\s'\"`(),;]+")
+# What ends or escapes a quoted literal (a lone backslash or quote may continue in the next chunk)
+QUOTE_STOP_RE = {quote: re.compile(r"\\.?|{0}{0}?".format(quote), re.DOTALL) for quote in "'\"`"}
+# Skips everything but `;`, comments and unterminated literals in one go
+STATEMENT_SKIP_RE = re.compile(
+    r"(?:[^'\"`;/-]+|-(?!-)|/(?!\*)|"
+    + "|".join(r"{0}[^{0}\\]*(?:(?:\\.|{0}{0})[^{0}\\]*)*{0}".format(quote) for quote in "'\"`")
+    + ")*",
+    re.DOTALL,
+)
+VERB_RE = re.compile(r"[\s(]*([A-Za-z_]\w*)")
+SPACE_RE = re.compile(r"\s")
+
+# How much of the end of the query is split into tokens to find the trailing clauses
+TAIL_SIZE = 1024
+
+ScannedQuery = namedtuple("ScannedQuery", ["text", "verb", "format", "vertical", "outfile"])
+
+
+def strip_comments(query):
+    """Remove the comments from `query` in one pass.
+
+    Returns the text and the (start, end) spans of the quoted literals in it.
+    """
+    pieces = []
+    literals = []
+    length = 0
+    pos = 0
+
+    while True:
+        match = SPECIAL_RE.search(query, pos)
+        if match is None:
+            pieces.append(query[pos:])
+            break
+
+        start = match.start()
+        token = match.group()
+        pieces.append(query[pos:start])
+        length += start - pos
+
+        if token == "--":
+            end = query.find("\n", start)
+            pos = len(query) if end == -1 else end
+            continue
+
+        if token == "/*":
+            # Block comments can be nested
+            depth = 0
+            end = len(query)
+            for comment_match in BLOCK_COMMENT_RE.finditer(query, start):
+                depth += 1 if comment_match.group() == "/*" else -1
+                if depth == 0:
+                    end = comment_match.end()
+                    break
+            pieces.append(" ")
+            length += 1
+            pos = end
+            continue
+
+        literal_match = LITERAL_END_RE[token].match(query, start + 1)
+        end = len(query) if literal_match is None else literal_match.end()
+        pieces.append(query[start:end])
+        literals.append((length, length + end - start))
+        length += end - start
+        pos = end
+
+    return "".join(pieces), literals
+
+
+def tail_tokens(text, literals, count):
+    """Return the last `count` tokens of `text` as (value, start, end), looking at its end only."""
+    start = max(0, len(text) - TAIL_SIZE)
+    if start > 0 and not text[start - 1].isspace():
+        space = SPACE_RE.search(text, start)
+        start = len(text) if space is None else space.start()
+
+    # Don't start in the middle of a literal
+    i = bisect_right(literals, (start, float("inf"))) - 1
+    if i >= 0 and literals[i][0] < start < literals[i][1]:
+        start = literals[i][0]
+
+    return [(m.group(), m.start(), m.end()) for m in TOKEN_RE.finditer(text, start)][-count:]
+
+
+def scan_query(query):
+    """Preprocess a (non-INSERT) statement in a single linear pass.
+
+    Strips the comments and the trailing `;`, and finds the statement verb, a trailing
+    `FORMAT <name>`, the `\\G` suffix and `INTO OUTFILE '<path>'`. The last two are
+    removed from the text; the rest of the SQL is left untouched.
+    """
+    text, literals = strip_comments(query)
+    indent = len(text) - len(text.lstrip())
+    if indent:
+        literals = [(start - indent, end - indent) for start, end in literals]
+    text = text.strip().rstrip(";").rstrip()
+
+    match = VERB_RE.match(text)
+    verb = match.group(1).upper() if match else None
+
+    vertical = text[-2:] in (r"\g", r"\G")
+    if vertical:
+        text = text[:-2].rstrip()
+
+    tokens = tail_tokens(text, literals, 5)
+
+    fmt = None
+    if len(tokens) >= 2 and tokens[-2][0].upper() == "FORMAT" and tokens[-1][0] not in "(),;":
+        fmt = tokens[-1][0]
+
+    outfile = None
+    if verb == "SELECT":
+        values = [value.upper() for value, _, _ in tokens]
+        for i in range(len(values) - 2):
+            if values[i] == "INTO" and values[i + 1] == "OUTFILE":
+                path, path_end = tokens[i + 2][0], tokens[i + 2][2]
+                outfile = path.strip("'")
+                text = text[: tokens[i][1]].rstrip() + text[path_end:]
+                break
+
+    return ScannedQuery(text, verb, fmt, vertical, outfile)
+
+
+def skip_comments(text):
+    """Return where `text` starts past its leading comments and whitespace (its length if there's nothing else)."""
+    pos = 0
+    while True:
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+        if text.startswith("--", pos):
+            end = text.find("\n", pos)
+            pos = len(text) if end == -1 else end
+        elif text.startswith("/*", pos):
+            depth = 0
+            for match in BLOCK_COMMENT_RE.finditer(text, pos):
+                depth += 1 if match.group() == "/*" else -1
+                if depth == 0:
+                    pos = match.end()
+                    break
+            else:
+                return len(text)
+        else:
+            return pos
+
+
+def is_blank(text):
+    """Tell whether `text` has nothing but comments and whitespace."""
+    return skip_comments(text) == len(text)
+
+
+def statement_verb(query):
+    """The verb of a statement, looking past its leading comments only (e.g. not at the rows of an INSERT)."""
+    match = VERB_RE.match(query, skip_comments(query))
+    return match.group(1).upper() if match else None
+
+
+class StatementSplitter(object):
+    """Split SQL text fed in chunks into statements, minding literals and comments.
+
+    Keeps only the current statement in memory, so a script of any size can be
+    executed as it's read.
+    """
+
+    def __init__(self):
+        self.pieces = []
+        self.carry = ""
+        self.quote = None
+        self.comment_depth = 0
+        self.line_comment = False
+
+    def feed(self, chunk, final=False):
+        """Return the statements completed by `chunk`."""
+        text = self.carry + chunk
+        statements = []
+        start = pos = 0
+        limit = len(text)
+
+        while pos < limit:
+            if self.line_comment:
+                end = text.find("\n", pos)
+                if end == -1:
+                    break
+                self.line_comment = False
+                pos = end
+
+            elif self.comment_depth:
+                match = BLOCK_COMMENT_RE.search(text, pos)
+                if match is None:
+                    if not final and text[-1] in "/*":
+                        limit -= 1
+                    break
+                self.comment_depth += 1 if match.group() == "/*" else -1
+                pos = match.end()
+
+            elif self.quote:
+                match = QUOTE_STOP_RE[self.quote].search(text, pos)
+                if match is None:
+                    break
+                if not final and match.end() == limit and match.group() in ("\\", self.quote):
+                    # Wait for the next chunk to tell an escape from the end of the literal
+                    limit = match.start()
+                    break
+                if match.group() == self.quote:
+                    self.quote = None
+                pos = match.end()
+
+            else:
+                pos = STATEMENT_SKIP_RE.match(text, pos).end()
+                if pos == limit:
+                    if not final and text[-1] in "-/":
+                        # Might be the start of a comment
+                        limit -= 1
+                    break
+
+                if text[pos] == ";":
+                    self.pieces.append(text[start:pos])
+                    statements.append("".join(self.pieces))
+                    self.pieces = []
+                    start = pos + 1
+                    pos += 1
+                elif text.startswith("--", pos):
+                    self.line_comment = True
+                    pos += 2
+                elif text.startswith("/*", pos):
+                    self.comment_depth = 1
+                    pos += 2
+                else:
+                    # A literal that doesn't end in this chunk
+                    self.quote = text[pos]
+                    pos += 1
+
+        self.pieces.append(text[start:limit])
+        self.carry = text[limit:]
+
+        if final:
+            statements.append("".join(self.pieces) + self.carry)
+            self.pieces = []
+            self.carry = ""
+
+        return statements
+
+
+def iter_statements(stream, chunk_size=1 << 20, encoding="utf-8"):
+    """Read SQL statements from a binary stream incrementally.
+
+    Yields `(lineno, statement)` pairs with the line the statement starts on,
+    skipping the ones made of whitespace and comments only.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    splitter = StatementSplitter()
+    lineno = 1
+
+    while True:
+        chunk = stream.read(chunk_size)
+        final = not chunk
+        for statement in splitter.feed(decoder.decode(chunk or b"", final=final), final=final):
+            stripped = statement.lstrip()
+            statement_lineno = lineno + statement.count("\n", 0, len(statement) - len(stripped))
+            # Each statement but the last one was followed by a `;`
+            lineno += statement.count("\n")
+            if not is_blank(stripped):
+                yield statement_lineno, stripped.rstrip()
+        if final:
+            return
@@ -0,0 +1,51 @@
+import re
+import threading
+import uuid
+
+SET_RE = re.compile(r"\s*SET\s", re.IGNORECASE)
+
+
+class SessionPool(object):
+    """HTTP sessions for the queries that run alongside the main one.
+
+    ClickHouse locks a session while it serves a request, so concurrent queries
+    need sessions of their own. A leased session first catches up with the `SET`
+    statements applied to the main one.
+    """
+
+    def __init__(self, client, setup=()):
+        self.client = client
+        self.setup = list(setup)
+        self.idle = []
+        # session id -> how many of the setup statements it has executed
+        self.applied = {}
+        self._lock = threading.Lock()
+
+    def add_setup(self, statement):
+        """Remember a `SET` statement for the sessions leased from now on."""
+        with self._lock:
+            self.setup.append(statement)
+
+    def lease(self):
+        with self._lock:
+            session_id = self.idle.pop() if self.idle else str(uuid.uuid4())
+            applied = self.applied.get(session_id, 0)
+            statements = self.setup[applied:]
+
+        try:
+            for statement in statements:
+                self.client.query(statement, fmt="Null", session_id=session_id)
+        except Exception:
+            # The session may be half set up; forget it
+            with self._lock:
+                self.applied.pop(session_id, None)
+            raise
+
+        with self._lock:
+            self.applied[session_id] = applied + len(statements)
+        return session_id
+
+    def release(self, session_id):
+        with self._lock:
+            if session_id in self.applied:
+                self.idle.append(session_id)
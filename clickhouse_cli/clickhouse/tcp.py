@@ -0,0 +1,443 @@
+"""A transport speaking the native protocol of ClickHouse (port 9000), for block-based results.
+
+Results come as the blocks of the Native format, so they're decoded straight
+into columns. Blocks are compressed with LZ4 or ZSTD when the `lz4` or
+`zstandard` package is installed, along with `clickhouse-cityhash` for the
+checksums of the compressed frames.
+"""
+import getpass
+import re
+import socket
+import ssl
+import struct
+import threading
+import time
+
+from clickhouse_cli import __version__
+from clickhouse_cli.clickhouse.exceptions import ConnectionError, DBException, NativeFormatError, TimeoutError
+from clickhouse_cli.clickhouse.native import StreamReader
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from clickhouse_cityhash.cityhash import CityHash128
+except ImportError:
+    CityHash128 = None
+
+CLIENT_NAME = "clickhouse-cli"
+VERSION_MAJOR, VERSION_MINOR, VERSION_PATCH = (int(part) for part in (__version__.split(".") + ["0", "0"])[:3])
+
+# The protocol revision spoken; the features of later ones aren't supported
+CLIENT_REVISION = 54448
+# Revisions from which a field is sent
+REVISION_WITH_TIMEZONE = 54058
+REVISION_WITH_QUOTA_KEY = 54060
+REVISION_WITH_SERVER_DISPLAY_NAME = 54372
+REVISION_WITH_VERSION_PATCH = 54401
+REVISION_WITH_CLIENT_WRITE_INFO = 54420
+REVISION_WITH_SETTINGS_AS_STRINGS = 54429
+REVISION_WITH_INTERSERVER_SECRET = 54441
+REVISION_WITH_OPENTELEMETRY = 54442
+REVISION_WITH_DISTRIBUTED_DEPTH = 54448
+
+# Client packets
+CLIENT_HELLO = 0
+CLIENT_QUERY = 1
+CLIENT_DATA = 2
+CLIENT_CANCEL = 3
+CLIENT_PING = 4
+
+# Server packets
+SERVER_HELLO = 0
+SERVER_DATA = 1
+SERVER_EXCEPTION = 2
+SERVER_PROGRESS = 3
+SERVER_PONG = 4
+SERVER_END_OF_STREAM = 5
+SERVER_PROFILE_INFO = 6
+SERVER_TOTALS = 7
+SERVER_EXTREMES = 8
+SERVER_LOG = 10
+SERVER_TABLE_COLUMNS = 11
+
+QUERY_KIND_INITIAL = 1
+INTERFACE_TCP = 1
+STAGE_COMPLETE = 2
+
+# The methods of the compressed frames
+COMPRESSION_NONE = 0x02
+COMPRESSION_LZ4 = 0x82
+COMPRESSION_ZSTD = 0x90
+COMPRESSION_METHODS = {"lz4": COMPRESSION_LZ4, "zstd": COMPRESSION_ZSTD}
+# checksum (16 bytes), then method (1), compressed size with this header (4), uncompressed size (4)
+FRAME_HEADER = struct.Struct("<BII")
+
+INSERT_RE = re.compile(r"\s*INSERT\s", re.IGNORECASE)
+RECEIVE_SIZE = 65536
+MASK64 = (1 << 64) - 1
+
+
+def varint(value):
+    data = bytearray()
+    while value >= 0x80:
+        data.append(value & 0x7F | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def string(value):
+    if isinstance(value, str):
+        value = value.encode()
+    return varint(len(value)) + value
+
+
+def available_compression():
+    """The compression used when none is asked for: the first one whose packages are installed."""
+    if CityHash128 is None:
+        return None
+    if lz4 is not None:
+        return "lz4"
+    if zstandard is not None:
+        return "zstd"
+    return None
+
+
+def compress(data, method):
+    if method == COMPRESSION_LZ4:
+        payload = lz4.block.compress(data, store_size=False)
+    else:
+        payload = zstandard.ZstdCompressor().compress(data)
+    header = FRAME_HEADER.pack(method, FRAME_HEADER.size + len(payload), len(data))
+    # The two halves of the hash are in the high and the low bits, in the order they're sent
+    checksum = CityHash128(header + payload)
+    return struct.pack("<QQ", checksum >> 64, checksum & MASK64) + header + payload
+
+
+class CompressedSource(object):
+    """Reads the compressed frames of a block from `reader`, for a StreamReader over their data."""
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    def read_some(self, size):
+        # The checksum is left to TCP
+        self.reader.read(16)
+        method, compressed_size, size = FRAME_HEADER.unpack(self.reader.read(FRAME_HEADER.size))
+        payload = bytes(self.reader.read(compressed_size - FRAME_HEADER.size))
+        if method == COMPRESSION_NONE:
+            return payload
+        if method == COMPRESSION_LZ4 and lz4 is not None:
+            return lz4.block.decompress(payload, uncompressed_size=size)
+        if method == COMPRESSION_ZSTD and zstandard is not None:
+            return zstandard.ZstdDecompressor().decompress(payload, max_output_size=size)
+        raise NativeFormatError("Unsupported compression method 0x{:02x}.".format(method))
+
+
+class Connection(object):
+    """A connection to the native protocol port of a server. It runs a query at a time.
+
+    `compression` is "lz4", "zstd", False for none, or None for the first one available.
+    """
+
+    def __init__(
+        self,
+        host,
+        port=9000,
+        user="default",
+        password="",
+        database="default",
+        secure=False,
+        verify=True,
+        timeout=10.0,
+        compression=None,
+    ):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.database = database
+        self.secure = secure
+        self.verify = verify
+        self.timeout = timeout
+
+        if compression is None:
+            compression = available_compression()
+        if compression and (CityHash128 is None or compression not in COMPRESSION_METHODS):
+            raise ValueError("Unsupported compression: {}.".format(compression))
+        if compression == "lz4" and lz4 is None or compression == "zstd" and zstandard is None:
+            raise ValueError("The {} compression needs its package installed.".format(compression))
+        self.compression = COMPRESSION_METHODS[compression] if compression else None
+
+        self.sock = None
+        self.reader = None
+        self.revision = None
+        self.server_info = {}
+        # Totals of the last query
+        self.progress = {}
+        self.profile = {}
+        self._send_lock = threading.Lock()
+
+    def connect(self):
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            if self.secure:
+                context = ssl.create_default_context()
+                if not self.verify:
+                    context.check_hostname = False
+                    context.verify_mode = ssl.CERT_NONE
+                sock = context.wrap_socket(sock, server_hostname=self.host)
+        except socket.timeout as e:
+            raise TimeoutError(*e.args) from e
+        except OSError as e:
+            raise ConnectionError(*e.args) from e
+
+        # Queries may take long between two packets
+        sock.settimeout(None)
+        self.sock = sock
+        self.reader = StreamReader(self.receive)
+        try:
+            self.hello()
+        except BaseException:
+            self.disconnect()
+            raise
+
+    def disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = self.reader = None
+
+    def receive(self, size):
+        return self.sock.recv(max(size, RECEIVE_SIZE))
+
+    def send(self, *parts):
+        with self._send_lock:
+            self.sock.sendall(b"".join(parts))
+
+    def hello(self):
+        self.send(
+            varint(CLIENT_HELLO),
+            string(CLIENT_NAME),
+            varint(VERSION_MAJOR),
+            varint(VERSION_MINOR),
+            varint(CLIENT_REVISION),
+            string(self.database),
+            string(self.user),
+            string(self.password),
+        )
+
+        packet = self.reader.read_varint()
+        if packet == SERVER_EXCEPTION:
+            raise self.read_exception(None)
+        if packet != SERVER_HELLO:
+            raise ConnectionError("Unexpected packet {} in the greeting of the server.".format(packet))
+
+        info = {"name": self.reader.read_string().decode()}
+        info["version"] = [self.reader.read_varint(), self.reader.read_varint()]
+        self.revision = min(self.reader.read_varint(), CLIENT_REVISION)
+        if self.revision >= REVISION_WITH_TIMEZONE:
+            info["timezone"] = self.reader.read_string().decode()
+        if self.revision >= REVISION_WITH_SERVER_DISPLAY_NAME:
+            info["display_name"] = self.reader.read_string().decode()
+        if self.revision >= REVISION_WITH_VERSION_PATCH:
+            info["version"].append(self.reader.read_varint())
+        self.server_info = info
+
+    def client_info(self):
+        parts = [bytes([QUERY_KIND_INITIAL]), string(""), string(""), string("0.0.0.0:0")]
+        parts += [
+            bytes([INTERFACE_TCP]),
+            string(getpass.getuser()),
+            string(socket.gethostname()),
+            string(CLIENT_NAME),
+            varint(VERSION_MAJOR),
+            varint(VERSION_MINOR),
+            varint(CLIENT_REVISION),
+        ]
+        if self.revision >= REVISION_WITH_QUOTA_KEY:
+            parts.append(string(""))
+        if self.revision >= REVISION_WITH_DISTRIBUTED_DEPTH:
+            parts.append(varint(0))
+        if self.revision >= REVISION_WITH_VERSION_PATCH:
+            parts.append(varint(VERSION_PATCH))
+        if self.revision >= REVISION_WITH_OPENTELEMETRY:
+            parts.append(b"\x00")
+        return b"".join(parts)
+
+    def send_query(self, query, query_id="", settings=None):
+        settings = dict(settings or {})
+        if self.compression == COMPRESSION_ZSTD:
+            # The server compresses with LZ4 otherwise
+            settings.setdefault("network_compression_method", "zstd")
+        if settings and self.revision < REVISION_WITH_SETTINGS_AS_STRINGS:
+            raise NativeFormatError("The server is too old to be sent settings over the native protocol.")
+
+        parts = [varint(CLIENT_QUERY), string(query_id), self.client_info()]
+        for name, value in settings.items():
+            # No flags: the setting isn't "important", the server may ignore it if it's unknown
+            parts += [string(name), varint(0), string(str(value))]
+        parts.append(string(""))
+        if self.revision >= REVISION_WITH_INTERSERVER_SECRET:
+            parts.append(string(""))
+        parts += [varint(STAGE_COMPLETE), varint(1 if self.compression else 0), string(query)]
+        self.send(*parts)
+
+    def send_empty_block(self):
+        # Block info (is_overflows = 0, bucket_num = -1), no columns, no rows
+        block = varint(1) + b"\x00" + varint(2) + struct.pack("<i", -1) + varint(0) + varint(0) + varint(0)
+        if self.compression:
+            block = compress(block, self.compression)
+        self.send(varint(CLIENT_DATA), string(""), block)
+
+    def cancel(self):
+        """Ask the server to stop the running query; safe to call from another thread."""
+        if self.sock is not None:
+            self.send(varint(CLIENT_CANCEL))
+
+    def read_block(self, compressed):
+        self.reader.read_string()  # the name of the table, for external tables
+        if compressed and self.compression:
+            return StreamReader(CompressedSource(self.reader).read_some).read_block(info=True)
+        return self.reader.read_block(info=True)
+
+    def read_exception(self, query):
+        code = struct.unpack("<i", self.reader.read(4))[0]
+        name = self.reader.read_string().decode("utf-8", "replace")
+        message = self.reader.read_string().decode("utf-8", "replace")
+        stacktrace = self.reader.read_string().decode("utf-8", "replace")
+        if self.reader.read(1)[0]:
+            # The nested exceptions are already part of the message
+            self.read_exception(query)
+
+        error = DBException(None, query, text="Code: {}. {}: {}".format(code, name, message))
+        error.stacktrace = stacktrace
+        return error
+
+    def read_progress(self):
+        increments = [self.reader.read_varint() for _ in range(3)]
+        if self.revision >= REVISION_WITH_CLIENT_WRITE_INFO:
+            increments += [self.reader.read_varint() for _ in range(2)]
+        # Packets carry the progress since the previous one
+        for key, value in zip(("read_rows", "read_bytes", "total_rows", "written_rows", "written_bytes"), increments):
+            self.progress[key] = self.progress.get(key, 0) + value
+
+        progress = dict(self.progress, timestamp=time.monotonic())
+        total_rows = progress.get("total_rows", 0)
+        progress["percents"] = min(100, int(progress["read_rows"] * 100 / total_rows)) if total_rows > 0 else 0
+        return progress
+
+    def read_profile_info(self):
+        read = self.reader
+        return {
+            "rows": read.read_varint(),
+            "blocks": read.read_varint(),
+            "bytes": read.read_varint(),
+            "applied_limit": bool(read.read(1)[0]),
+            "rows_before_limit": read.read_varint(),
+            "calculated_rows_before_limit": bool(read.read(1)[0]),
+        }
+
+    def execute(self, query, query_id="", settings=None, on_progress=None):
+        """Run a query, yielding the blocks of its result as lists of (name, type, column).
+
+        `on_progress` is called with the accumulated progress of the query, and
+        the profile info ends up in `profile`. Closing the generator before the
+        end cancels the query.
+        """
+        if self.sock is None:
+            self.connect()
+
+        self.progress = {}
+        self.profile = {}
+        finished = False
+        try:
+            self.send_query(query, query_id, settings)
+            # No external tables
+            self.send_empty_block()
+
+            while True:
+                packet = self.reader.read_varint()
+                if packet == SERVER_DATA:
+                    block = self.read_block(compressed=True)
+                    if INSERT_RE.match(query):
+                        # The server waits for the data to insert, there's none
+                        self.send_empty_block()
+                    else:
+                        yield block
+                elif packet == SERVER_PROGRESS:
+                    progress = self.read_progress()
+                    if on_progress is not None:
+                        on_progress(progress)
+                elif packet == SERVER_PROFILE_INFO:
+                    self.profile = self.read_profile_info()
+                elif packet in (SERVER_TOTALS, SERVER_EXTREMES):
+                    self.read_block(compressed=True)
+                elif packet == SERVER_LOG:
+                    self.read_block(compressed=False)
+                elif packet == SERVER_TABLE_COLUMNS:
+                    self.reader.read_string()
+                    self.reader.read_string()
+                elif packet == SERVER_PONG:
+                    pass
+                elif packet == SERVER_EXCEPTION:
+                    finished = True
+                    raise self.read_exception(query)
+                elif packet == SERVER_END_OF_STREAM:
+                    finished = True
+                    return
+                else:
+                    raise NativeFormatError("Unexpected packet {}.".format(packet))
+        except GeneratorExit:
+            if not finished:
+                self.stop()
+            raise
+        except DBException:
+            raise
+        except BaseException:
+            # The connection is somewhere in the middle of a packet
+            self.disconnect()
+            raise
+
+    def stop(self):
+        """Cancel the running query and skip what the server still sends for it."""
+        try:
+            self.cancel()
+            for _ in self.execute_rest():
+                pass
+        except BaseException:
+            self.disconnect()
+            raise
+
+    def execute_rest(self):
+        while True:
+            packet = self.reader.read_varint()
+            if packet in (SERVER_DATA, SERVER_TOTALS, SERVER_EXTREMES):
+                yield self.read_block(compressed=True)
+            elif packet == SERVER_LOG:
+                self.read_block(compressed=False)
+            elif packet == SERVER_PROGRESS:
+                self.read_progress()
+            elif packet == SERVER_PROFILE_INFO:
+                self.read_profile_info()
+            elif packet == SERVER_TABLE_COLUMNS:
+                self.reader.read_string()
+                self.reader.read_string()
+            elif packet == SERVER_EXCEPTION:
+                # Most likely, that the query was cancelled
+                self.read_exception(None)
+                return
+            elif packet == SERVER_END_OF_STREAM:
+                return
+            elif packet != SERVER_PONG:
+                raise NativeFormatError("Unexpected packet {}.".format(packet))
@@ -7,6 +7,7 @@ from clickhouse_cli.ui.style import Echo
 PACKAGE_ROOT = os.path.dirname(__file__)
 DEFAULT_CONFIG = os.path.join(PACKAGE_ROOT, "clickhouse-cli.rc.sample")
 USER_CONFIG = "~/.clickhouse-cli.rc"
+USER_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or "~/.cache", "clickhouse-cli")
 
 
 echo = Echo()
@@ -30,3 +31,10 @@ def write_default_config(source, destination, overwrite=False):
         return
 
     shutil.copyfile(source, destination)
+
+
+def get_cache_path(*parts):
+    """Return a path inside the user's cache directory, creating the directory if needed."""
+    path = os.path.join(os.path.expanduser(USER_CACHE_DIR), *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
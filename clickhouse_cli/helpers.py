@@ -1,6 +1,9 @@
 import email.parser
 import http.client
 import io
+import os
+import re
+import stat
 
 
 def sizeof_fmt(num, suffix="B"):
@@ -22,6 +25,67 @@ def numberunit_fmt(num):
     return "%.1f %s" % (num, "quadrillion")
 
 
+TSV_ESCAPES = {"b": "\b", "f": "\f", "r": "\r", "n": "\n", "t": "\t", "0": "\0", "'": "'", "\\": "\\"}
+TSV_ESCAPE_RE = re.compile(r"\\(.)")
+
+
+def unescape_tsv(value):
+    """Decode a single value of the TabSeparated format."""
+    if "\\" not in value:
+        return value
+    return TSV_ESCAPE_RE.sub(lambda m: TSV_ESCAPES.get(m.group(1), m.group(1)), value)
+
+
+def shorten_query(query, width=60):
+    """Squeeze the whitespace of a query and cut it to `width` characters for a one-line listing."""
+    query = " ".join(query[: width * 4].split())
+    return query if len(query) <= width else query[: width - 3] + "..."
+
+
+def quote_string(value):
+    """Quote a Python string as a ClickHouse string literal."""
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def unquote_identifier(name):
+    """Strip the backticks or double quotes around an identifier."""
+    if len(name) > 1 and name[0] == name[-1] and name[0] in "`\"":
+        return name[1:-1].replace(name[0] * 2, name[0]).replace("\\" + name[0], name[0])
+    return name
+
+
+# The `{name:Type}` placeholders of server-side query parameters
+PARAMETER_RE = re.compile(r"\{\s*(\w+)\s*:[^{}]+\}")
+
+
+def find_parameters(query):
+    """Return the names of the query parameters used in a query."""
+    return {match.group(1) for match in PARAMETER_RE.finditer(query)}
+
+
+# The column list (or the arguments of a table function) is skipped whole, and an INSERT ... SELECT has no rows
+INSERT_VALUES_RE = re.compile(r"\s*(INSERT\s+INTO\s(?:\([^()]*\)|(?!\bSELECT\b)[^;()])*?\bVALUES\b)\s*", re.IGNORECASE)
+
+
+def split_insert_values(query, head_size=65536):
+    """Split `INSERT INTO ... VALUES <rows>` into the statement and the rows, without parsing the rows.
+
+    Returns None if the query isn't a single `INSERT ... VALUES` statement.
+    """
+    match = INSERT_VALUES_RE.match(query[:head_size])
+    if match is None:
+        return None
+
+    body = query[match.end() :].rstrip()
+    if body.endswith(";"):
+        body = body[:-1]
+    if not body or ";" in body:
+        # Might be a `;` inside a string, but also another statement
+        return None
+
+    return match.group(1), body
+
+
 def trace_headers_stream(*args):
     pass
 
@@ -48,7 +112,20 @@ def parse_headers_stream(fp, _class=http.client.HTTPMessage):
     return email.parser.Parser(_class=_class).parsestr(hstring)
 
 
-def chain_streams(streams, buffer_size=io.DEFAULT_BUFFER_SIZE):
+def stream_size(stream):
+    """Return how many bytes are left to read from `stream`, or None if it can't be told (e.g. a pipe)."""
+    if isinstance(stream, io.BytesIO):
+        return stream.getbuffer().nbytes - stream.tell()
+    try:
+        info = os.fstat(stream.fileno())
+        if not stat.S_ISREG(info.st_mode):
+            return None
+        return info.st_size - stream.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def chain_streams(streams, buffer_size=io.DEFAULT_BUFFER_SIZE, on_read=None):
     """
     https://stackoverflow.com/questions/24528278/stream-multiple-files-into-a-readable-object-in-python
 
@@ -59,10 +136,14 @@ def chain_streams(streams, buffer_size=io.DEFAULT_BUFFER_SIZE):
                 yield open(file, 'rb')
         f = chain_streams(generate_open_file_streams())
         f.read()
+
+    The number of bytes read so far is kept in `f.raw.bytes_read`, and passed to
+    `on_read` after each chunk.
     """
 
     class ChainStream(io.RawIOBase):
         def __init__(self):
+            self.bytes_read = 0
             self.leftover = b""
             self.stream_iter = iter(streams)
             try:
@@ -99,6 +180,9 @@ def chain_streams(streams, buffer_size=io.DEFAULT_BUFFER_SIZE):
                     return 0  # indicate EOF
             output, self.leftover = chunk[:buffer_length], chunk[buffer_length:]
             b[: len(output)] = output
+            self.bytes_read += len(output)
+            if on_read is not None:
+                on_read(self.bytes_read)
             return len(output)
 
     return io.BufferedReader(ChainStream(), buffer_size=buffer_size)
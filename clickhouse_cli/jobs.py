@@ -0,0 +1,97 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class Job(object):
+    """A query running in a background thread."""
+
+    def __init__(self, number, query, query_id):
+        self.number = number
+        self.query = query
+        self.query_id = query_id
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        # The latest X-ClickHouse-Progress of the query
+        self.progress = None
+        self.response = None
+        self.error = None
+        self.killed = False
+        self.reported = False
+        self.done = threading.Event()
+
+    @property
+    def status(self):
+        if not self.done.is_set():
+            return "Running"
+        if self.killed:
+            return "Killed"
+        return "Failed" if self.error is not None else "Done"
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    def result(self):
+        """Return the response of a finished job, or raise its error."""
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+class JobManager(object):
+    """Runs queries in the background and keeps them until their result is shown."""
+
+    def __init__(self):
+        self.jobs = OrderedDict()
+        self.next_number = 1
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def start(self, query, query_id, target):
+        """Run `target(job)` in a new thread; its return value becomes the job's response."""
+        with self._lock:
+            job = Job(self.next_number, query, query_id)
+            self.jobs[job.number] = job
+            self.next_number += 1
+
+        def run():
+            self._local.job = job
+            try:
+                job.response = target(job)
+            except Exception as e:
+                job.error = e
+            finally:
+                job.finished_at = time.monotonic()
+                job.done.set()
+
+        thread = threading.Thread(target=run, name="job-{}".format(job.number), daemon=True)
+        thread.start()
+        return job
+
+    def current(self):
+        """Return the job running in the current thread, if any."""
+        return getattr(self._local, "job", None)
+
+    def get(self, number=None):
+        """Return job `number`, or the latest one."""
+        with self._lock:
+            if number is None:
+                return list(self.jobs.values())[-1] if self.jobs else None
+            return self.jobs.get(number)
+
+    def remove(self, job):
+        with self._lock:
+            self.jobs.pop(job.number, None)
+
+    def running(self):
+        with self._lock:
+            return [job for job in self.jobs.values() if not job.done.is_set()]
+
+    def collect_finished(self):
+        """Return the jobs finished since the last call."""
+        with self._lock:
+            finished = [job for job in self.jobs.values() if job.done.is_set() and not job.reported]
+        for job in finished:
+            job.reported = True
+        return finished
@@ -0,0 +1,85 @@
+import re
+import sqlite3
+
+# SQLite has 64-bit signed integers; wider values become REAL, as SQLite would make them
+INT64_MIN, INT64_MAX = -(1 << 63), (1 << 63) - 1
+
+WRAPPER_TYPE_RE = re.compile(r"^(?:Nullable|LowCardinality)\((.*)\)$")
+INTEGER_TYPE_RE = re.compile(r"^(?:U?Int\d+|Bool)$")
+REAL_TYPE_RE = re.compile(r"^(?:Float\d+|Decimal(?:\d+)?\(.*\))$")
+
+
+def sqlite_type(type_name):
+    """The SQLite column type for a ClickHouse type: INTEGER, REAL, or TEXT for the rest (dates included)."""
+    match = WRAPPER_TYPE_RE.match(type_name)
+    while match:
+        type_name = match.group(1)
+        match = WRAPPER_TYPE_RE.match(type_name)
+    if INTEGER_TYPE_RE.match(type_name):
+        return "INTEGER"
+    if REAL_TYPE_RE.match(type_name):
+        return "REAL"
+    return "TEXT"
+
+
+def to_integer(value):
+    if value in ("true", "false"):
+        return int(value == "true")
+    number = int(value)
+    return number if INT64_MIN <= number <= INT64_MAX else float(number)
+
+
+CONVERTERS = {"INTEGER": to_integer, "REAL": float, "TEXT": None}
+
+
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+class LocalDatabase(object):
+    """An in-memory SQLite database, to query results that were already fetched without asking the server again."""
+
+    def __init__(self):
+        self.connection = sqlite3.connect(":memory:", check_same_thread=False)
+
+    def load(self, table, columns, types, rows):
+        """(Re)create `table` with the cells of a result, as parse_tsv_with_names_and_types gives them."""
+        sqlite_types = [sqlite_type(type_name) for type_name in types]
+        converters = [CONVERTERS[name] for name in sqlite_types]
+
+        def convert(row):
+            return [
+                value if value is None or converter is None else converter(value)
+                for value, converter in zip(row, converters)
+            ]
+
+        table = quote_identifier(table)
+        definitions = ", ".join(quote_identifier(name) + " " + kind for name, kind in zip(columns, sqlite_types))
+        with self.connection:
+            self.connection.execute("DROP TABLE IF EXISTS {}".format(table))
+            self.connection.execute("CREATE TABLE {} ({})".format(table, definitions))
+            self.connection.executemany(
+                "INSERT INTO {} VALUES ({})".format(table, ", ".join("?" * len(columns))),
+                (convert(row) for row in rows),
+            )
+
+    def query(self, query):
+        """Run a query, returning (columns, rows, numeric) with the cells as strings (None for NULL).
+
+        `numeric` holds the indexes of the columns with numbers only, to align them to the right.
+        """
+        cursor = self.connection.execute(query)
+        if cursor.description is None:
+            self.connection.commit()
+            return [], [], []
+
+        columns = [description[0] for description in cursor.description]
+        values = cursor.fetchall()
+        numeric = [
+            i
+            for i in range(len(columns))
+            if any(row[i] is not None for row in values)
+            and all(row[i] is None or isinstance(row[i], (int, float)) for row in values)
+        ]
+        rows = [[None if value is None else str(value) for value in row] for row in values]
+        return columns, rows, numeric
@@ -1,12 +1,18 @@
 import operator
 import re
+import threading
+import time
+import uuid
 from collections import OrderedDict, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from itertools import count
 
 from prompt_toolkit.completion import Completer, Completion, PathCompleter
 from prompt_toolkit.document import Document
 
-from clickhouse_cli.clickhouse.definitions import DATATYPES, FORMATS, FUNCTIONS, KEYWORDS
+from clickhouse_cli.clickhouse.catalogue import Catalogue
+from clickhouse_cli.clickhouse.definitions import FUNCTIONS, KEYWORDS
+from clickhouse_cli.helpers import quote_string, unescape_tsv
 from clickhouse_cli.ui.parseutils.helpers import (
     Alias,
     Candidate,
@@ -24,6 +30,7 @@ from clickhouse_cli.ui.parseutils.helpers import (
     PrevalenceCounter,
     Schema,
     SchemaObject,
+    Setting,
     Special,
     Table,
     View,
@@ -35,12 +42,131 @@ from clickhouse_cli.ui.parseutils.helpers import (
 from clickhouse_cli.ui.parseutils.meta import ColumnMetadata, ForeignKey
 from clickhouse_cli.ui.parseutils.tables import TableReference
 from clickhouse_cli.ui.parseutils.utils import last_word
+from clickhouse_cli.ui.schema_index import ColumnIndex
+
+
+class RefreshWorker(object):
+    """Runs `target` in a background thread, one run at a time.
+
+    Requests that arrive while a run is in progress are merged into a single
+    follow-up run, so a burst of queries triggers at most two refreshes.
+    """
+
+    def __init__(self, target, name="metadata-refresh"):
+        self.target = target
+        self.name = name
+        self._lock = threading.Lock()
+        self._pending = False
+        self._thread = None
+        self._idle = threading.Event()
+        self._idle.set()
+
+    def request(self):
+        with self._lock:
+            self._pending = True
+            self._idle.clear()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def wait(self, timeout=None):
+        """Block until there is no pending or running refresh."""
+        return self._idle.wait(timeout)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    self._idle.set()
+                    return
+                self._pending = False
+
+            try:
+                self.target()
+            except Exception:
+                pass
+
+
+class Col(object):
+    def __init__(self, name, datatype, default_kind="", default_expression="", comment="", compression_codec=""):
+        self.name = name
+        self.datatype = datatype
+        self.default_kind = default_kind
+        self.default_expression = default_expression
+        self.comment = comment
+        # system.columns has "CODEC(ZSTD(1))" where DESCRIBE shows "ZSTD(1)"
+        self.codec = compression_codec[6:-1] if compression_codec.startswith("CODEC(") else compression_codec
+
+    def values(self):
+        return [self]
+
+
+enum_value_regex = re.compile(r"'((?:[^'\\]|\\.)*)'\s*=\s*-?\d+")
+# Only columns with a small value set are worth sampling
+value_column_regex = re.compile(r"^(?:Nullable\()?(?:LowCardinality|Enum8|Enum16|Enum)\(")
+
+
+class ColumnValueCache(object):
+    """A bounded LRU of column values with a TTL, filled by background fetches.
+
+    `get` never blocks: on a miss or an expired entry it schedules `fetch(key)`
+    and returns whatever (possibly stale) values are at hand.
+    """
+
+    def __init__(self, fetch, size=256, ttl=300.0, workers=2):
+        self.fetch = fetch
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._inflight = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="column-values")
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if time.monotonic() - entry[0] < self.ttl:
+                    return entry[1]
+        self.prefetch(key)
+        return entry[1] if entry is not None else None
+
+    def put(self, key, values):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), values)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def prefetch(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if key in self._inflight or (entry is not None and time.monotonic() - entry[0] < self.ttl):
+                return
+            self._inflight.add(key)
+        self._executor.submit(self._fetch, key)
+
+    def _fetch(self, key):
+        try:
+            self.put(key, self.fetch(key))
+        except Exception:
+            pass  # The next lookup will try again
+        finally:
+            with self._lock:
+                self._inflight.discard(key)
 
 
 class CHCompleter(Completer):
-    def __init__(self, client, metadata):
+    def __init__(self, client, metadata, server_version=None):
         super(CHCompleter, self).__init__()
         self.client = client
+        self.server_version = server_version
+        # Metadata queries run from a background thread, so they must not share
+        # the interactive HTTP session: the server locks a session per request.
+        self.session_id = str(uuid.uuid4())
+        self.refresher = RefreshWorker(self.refresh_metadata)
         self.smart_completion = True
         self.prioritizer = PrevalenceCounter()
         self.qualify_columns = "always"  # 'if_more_than_one_table'
@@ -60,15 +186,28 @@ class CHCompleter(Completer):
         self.name_pattern = re.compile(r"^[_a-z][_a-z0-9\$]*$")
 
         self.metadata = metadata
-        self.metadata["all"] = set(KEYWORDS + FUNCTIONS)
         self.metadata["databases"] = {}
         self.metadata["tables"] = {}
         self.metadata["views"] = {}
         self.metadata["functions"] = {}
-        self.metadata["datatypes"] = DATATYPES
+
+        # Huge pastes aren't parsed for completion
+        self.max_text_size = None
+
+        self.complete_column_values = True
+        self.column_values_limit = 100
+        self.column_values = ColumnValueCache(self.fetch_column_values)
+
+        self.column_index = ColumnIndex()
+        self.metadata_refreshed_at = None
+
+        # Called with the new catalogue whenever it changes, e.g. to rebuild the lexer
+        self.on_catalogue = None
+        self.catalogue = None
+        self.set_catalogue((server_version and Catalogue.load(server_version)) or Catalogue())
 
     def _select(self, query, flatten=True, *args, **kwargs):
-        data = self.client.query(query, fmt="TabSeparated").data
+        data = self.client.query(query, fmt="TabSeparated", session_id=self.session_id).data
         if data is not None:
             return [row if flatten else row.split("\t") for row in data.rstrip("\n").split("\n")]
 
@@ -85,36 +224,90 @@ class CHCompleter(Completer):
     def get_single_match(self, word, match):
         return [Completion(match, -len(word))]
 
+    def request_refresh(self):
+        """Schedule a metadata refresh without waiting for it."""
+        self.refresher.request()
+
+    def set_catalogue(self, catalogue):
+        self.catalogue = catalogue
+        self.metadata["all"] = set(KEYWORDS + catalogue.functions + catalogue.aggregate_functions)
+        self.metadata["datatypes"] = catalogue.datatypes
+
+        if self.on_catalogue is not None:
+            self.on_catalogue(catalogue)
+
+    def refresh_catalogue(self):
+        """Introspect the server's functions, settings, formats & types once per session."""
+        if self.catalogue.source == "server":
+            return
+
+        catalogue = Catalogue.fetch(lambda query: self._select(query, flatten=False))
+        if catalogue.functions and self.server_version:
+            catalogue.save(self.server_version)
+        self.set_catalogue(catalogue)
+
     def refresh_metadata(self):
         try:
-            self.metadata["databases"] = self.get_databases()
-            self.metadata["tables"] = self.get_tables_and_columns()
+            databases = self.get_databases()
+            tables = self.get_tables_and_columns()
+            column_index = ColumnIndex.build(tables)
+
+            self.metadata["databases"] = databases
+            self.metadata["tables"] = tables
             self.metadata["views"] = {}
-            self.metadata["functions"] = {}
-            self.metadata["datatypes"] = DATATYPES
+            self.column_index = column_index
+            self.metadata_refreshed_at = time.monotonic()
         except Exception:
             pass  # We don't want to brag about the broken autocompletion
 
-    def get_tables_and_columns(self):
-        data = self._select("SELECT database, table, name, type FROM system.columns;", flatten=False)
-        result = defaultdict(dict)
+        try:
+            self.refresh_catalogue()
+        except Exception:
+            pass
 
-        class Col(object):
-            def __init__(self, name, datatype):
-                self.name = name
-                self.datatype = datatype
+    def is_metadata_fresh(self, max_age):
+        return self.metadata_refreshed_at is not None and time.monotonic() - self.metadata_refreshed_at < max_age
 
-            def values(self):
-                return [self]
+    def get_tables_and_columns(self):
+        try:
+            data = self._select(
+                "SELECT database, table, name, type, default_kind, default_expression, comment, compression_codec "
+                "FROM system.columns;",
+                flatten=False,
+            )
+        except Exception:
+            # Servers without column comments & codecs
+            data = self._select("SELECT database, table, name, type FROM system.columns;", flatten=False)
+        result = defaultdict(dict)
 
-        for database, table, name, datatype in data:
+        for row in data:
+            if len(row) < 4:
+                continue
+            database, table = row[:2]
             if table not in result[database]:
-                result[database][table] = {}
+                result[database][table] = OrderedDict()
 
-            result[database][table][name] = Col(name, datatype)
+            col = Col(*[unescape_tsv(value) for value in row[2:]])
+            result[database][table][col.name] = col
 
         return result
 
+    def list_tables(self, database):
+        """Sorted table names of `database` from the metadata, or None if the database isn't known."""
+        if database not in self.metadata.get("databases", ()):
+            return None
+        return sorted(self.metadata.get("tables", {}).get(database, {}))
+
+    def describe_table(self, table, database):
+        """Rows of `DESCRIBE TABLE` built from the metadata, or None if the table isn't known."""
+        columns = self.metadata["tables"].get(database, {}).get(table)
+        if not columns:
+            return None
+        return [
+            [col.name, col.datatype, col.default_kind, col.default_expression, col.comment, col.codec, ""]
+            for col in columns.values()
+        ]
+
     def get_tables(self, database=None):
         if database is None:
             return self._select("SHOW TABLES")
@@ -285,8 +478,7 @@ class CHCompleter(Completer):
         self.metadata["tables"] = {}
         self.metadata["views"] = {}
         self.metadata["functions"] = {}
-        self.metadata["datatypes"] = DATATYPES
-        self.metadata["all"] = set(KEYWORDS + FUNCTIONS)
+        self.set_catalogue(self.catalogue)
 
     def find_matches(self, text, collection, mode="fuzzy", meta=None):
         """Find completion matches for the given text.
@@ -425,6 +617,9 @@ class CHCompleter(Completer):
         return self.casing.get(word, word)
 
     def get_completions(self, document, complete_event, smart_completion=None):
+        if self.max_text_size is not None and len(document.text) > self.max_text_size:
+            return []
+
         word_before_cursor = document.get_word_before_cursor(WORD=True)
 
         if smart_completion is None:
@@ -454,6 +649,67 @@ class CHCompleter(Completer):
         # matches = sorted(matches, key=operator.attrgetter('priority'), reverse=True)
         return [m.completion for m in matches]
 
+    def fetch_column_values(self, key):
+        database, table, column, datatype = key
+        if "Enum" in datatype and "LowCardinality" not in datatype:
+            return [unescape_tsv(value) for value in enum_value_regex.findall(datatype)]
+
+        # A bounded sample rather than a full scan: the query breaks (instead of
+        # failing) on hitting either limit and keeps whatever it found so far.
+        query = (
+            "SELECT value FROM (SELECT {column} AS value FROM {database}.{table} LIMIT 1000000) "
+            "GROUP BY value ORDER BY count() DESC LIMIT {limit} "
+            "SETTINGS max_execution_time = 1, timeout_overflow_mode = 'break', "
+            "max_rows_to_read = 1000000, read_overflow_mode = 'break'"
+        ).format(
+            column=self.quote_identifier(column),
+            database=self.quote_identifier(database),
+            table=self.quote_identifier(table),
+            limit=self.column_values_limit,
+        )
+        return [unescape_tsv(value) for value in self._select(query) if value not in ("", "\\N")]
+
+    def quote_identifier(self, name):
+        name = self.unescape_name(name)
+        return name if self.name_pattern.match(name) else "`" + name.replace("`", "\\`") + "`"
+
+    def prefetch_column_values(self, scoped_cols):
+        if not self.complete_column_values:
+            return
+        for tbl, cols in scoped_cols.items():
+            if tbl.schema is None or tbl.is_function:
+                continue
+            for col in cols:
+                if value_column_regex.match(col.datatype or ""):
+                    self.column_values.prefetch((tbl.schema, tbl.name, col.name, col.datatype))
+
+    def get_column_value_matches(self, suggestion, scoped_cols):
+        if not self.complete_column_values:
+            return []
+
+        values = None
+        for tbl, cols in scoped_cols.items():
+            col = next((c for c in cols if c.name == suggestion.value_of), None)
+            if col is None or tbl.schema is None or not value_column_regex.match(col.datatype or ""):
+                continue
+            values = self.column_values.get((tbl.schema, tbl.name, col.name, col.datatype))
+            break
+
+        prefix = unescape_tsv(suggestion.value_prefix or "").lower()
+        return [
+            Match(
+                completion=Completion(
+                    quote_string(value)[1:],
+                    -len(suggestion.value_prefix or ""),
+                    display=value,
+                    display_meta="value",
+                ),
+                priority=(0,),
+            )
+            for value in values or ()
+            if value.lower().startswith(prefix)
+        ]
+
     def get_column_matches(self, suggestion, word_before_cursor):
         tables = suggestion.table_refs
         do_qualify = (
@@ -470,6 +726,12 @@ class CHCompleter(Completer):
 
         scoped_cols = self.populate_scoped_cols(tables, suggestion.local_tables)
 
+        if suggestion.value_of:
+            return self.get_column_value_matches(suggestion, scoped_cols)
+
+        # The user is likely about to filter on these, so warm up their values
+        self.prefetch_column_values(scoped_cols)
+
         colit = scoped_cols.items
 
         def make_cand(name, ref):
@@ -631,6 +893,8 @@ class CHCompleter(Completer):
                 return not f.is_aggregate and not f.is_window
 
             funcs = [_cand(f, alias) for f in self.populate_functions(suggestion.schema, filt)]
+            if not suggestion.schema:
+                funcs.extend(self.catalogue.table_functions)
         else:
             fs = self.populate_schema_objects(suggestion.schema, "functions")
             funcs = [_cand(f, alias=False) for f in fs]
@@ -643,7 +907,12 @@ class CHCompleter(Completer):
 
         if not suggestion.schema and not suggestion.filter:
             # also suggest hardcoded functions using startswith matching
-            predefined_funcs = self.find_matches(word_before_cursor, FUNCTIONS, mode="strict", meta="function")
+            predefined_funcs = self.find_matches(
+                word_before_cursor,
+                self.catalogue.functions + self.catalogue.aggregate_functions,
+                mode="strict",
+                meta="function",
+            )
             funcs.extend(predefined_funcs)
 
         return funcs
@@ -716,10 +985,13 @@ class CHCompleter(Completer):
         return []
 
     def get_datatype_matches(self, suggestion, word_before_cursor):
-        return self.find_matches(word_before_cursor, DATATYPES, mode="strict", meta="datatype")
+        return self.find_matches(word_before_cursor, self.catalogue.datatypes, mode="strict", meta="datatype")
 
     def get_format_matches(self, suggestion, word_before_cursor):
-        return self.find_matches(word_before_cursor, FORMATS, mode="strict", meta="format")
+        return self.find_matches(word_before_cursor, self.catalogue.formats, mode="strict", meta="format")
+
+    def get_setting_matches(self, suggestion, word_before_cursor):
+        return self.find_matches(word_before_cursor, self.catalogue.settings, mode="strict", meta="setting")
 
     suggestion_matchers = {
         FromClauseItem: get_from_clause_item_matches,
@@ -736,6 +1008,7 @@ class CHCompleter(Completer):
         Special: get_special_matches,
         Datatype: get_datatype_matches,
         Format: get_format_matches,
+        Setting: get_setting_matches,
         Path: get_path_matches,
     }
 
@@ -761,7 +1034,8 @@ class CHCompleter(Completer):
                 cols = ctes[normalize_ref(tbl.name)]
                 addcols(None, tbl.name, "CTE", tbl.alias, cols)
                 continue
-            schemas = [tbl.schema] if tbl.schema else self.search_path
+            # Unqualified tables are in the current database, whatever USE made it
+            schemas = [tbl.schema] if tbl.schema else self.search_path or [self.client.database]
             for schema in schemas:
                 relname = self.escape_name(tbl.name)
                 schema = self.escape_name(schema)
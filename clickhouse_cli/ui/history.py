@@ -0,0 +1,143 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from prompt_toolkit.history import History
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    query TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    server TEXT,
+    duration REAL,
+    rows INTEGER
+);
+CREATE INDEX IF NOT EXISTS history_server ON history (server, id);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(query, content='history', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS history_fts_insert AFTER INSERT ON history BEGIN
+    INSERT INTO history_fts (rowid, query) VALUES (new.id, new.query);
+END;
+CREATE TRIGGER IF NOT EXISTS history_fts_delete AFTER DELETE ON history BEGIN
+    INSERT INTO history_fts (history_fts, rowid, query) VALUES ('delete', old.id, old.query);
+END;
+"""
+
+
+def parse_file_history(path):
+    """Yield (created_at, query) pairs from a prompt_toolkit `FileHistory` file, oldest first."""
+    created_at = None
+    lines = []
+
+    with open(path, "rb") as f:
+        for raw_line in f:
+            line = raw_line.decode("utf-8", "replace")
+            if line.startswith("+"):
+                lines.append(line[1:])
+                continue
+
+            if lines:
+                yield created_at, "".join(lines)[:-1]
+                lines = []
+
+            if line.startswith("#"):
+                try:
+                    created_at = datetime.fromisoformat(line[1:].strip()).timestamp()
+                except ValueError:
+                    pass
+
+    if lines:
+        yield created_at, "".join(lines)[:-1]
+
+
+class SQLiteHistory(History):
+    """Query history kept in a SQLite database.
+
+    Only the latest `size` entries are loaded for the prompt; the rest stays on
+    disk and is reachable through `search`, which uses an FTS5 index when the
+    SQLite build has one.
+    """
+
+    def __init__(self, filename, server=None, size=10000):
+        super(SQLiteHistory, self).__init__()
+        self.filename = filename
+        self.server = server
+        self.size = size
+        self.last_id = None
+        self._lock = threading.Lock()
+
+        self.connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.connection.executescript(SCHEMA)
+        try:
+            self.connection.executescript(FTS_SCHEMA)
+            self.has_fts = True
+        except sqlite3.OperationalError:
+            self.has_fts = False
+
+    def load_history_strings(self):
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT query FROM history ORDER BY id DESC LIMIT ?", (self.size,)
+            ).fetchall()
+        for (query,) in rows:
+            yield query
+
+    def store_string(self, string):
+        with self._lock:
+            cursor = self.connection.execute(
+                "INSERT INTO history (query, created_at, server) VALUES (?, ?, ?)", (string, time.time(), self.server)
+            )
+            self.last_id = cursor.lastrowid
+
+    def record_result(self, duration=None, rows=None):
+        """Attach the execution time and the row count to the latest stored query."""
+        if self.last_id is None:
+            return
+        with self._lock:
+            self.connection.execute(
+                "UPDATE history SET duration = ?, rows = ? WHERE id = ?", (duration, rows, self.last_id)
+            )
+
+    def search(self, term=None, limit=20):
+        """Return the latest (created_at, server, duration, rows, query) entries that contain `term`."""
+        columns = "h.created_at, h.server, h.duration, h.rows, h.query"
+        if not term:
+            sql, args = "SELECT {} FROM history h ORDER BY h.id DESC LIMIT ?".format(columns), (limit,)
+        elif self.has_fts:
+            sql = (
+                "SELECT {} FROM history_fts JOIN history h ON h.id = history_fts.rowid "
+                "WHERE history_fts MATCH ? ORDER BY h.id DESC LIMIT ?"
+            ).format(columns)
+            # Every word is quoted, so the term is matched as plain text rather than FTS syntax
+            args = (" ".join('"{}"'.format(word.replace('"', '""')) for word in term.split()), limit)
+        else:
+            sql = "SELECT {} FROM history h WHERE h.query LIKE ? ESCAPE '\\' ORDER BY h.id DESC LIMIT ?".format(columns)
+            args = ("%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%", limit)
+
+        with self._lock:
+            return self.connection.execute(sql, args).fetchall()
+
+    def import_file(self, path):
+        """Copy the entries of a flat `FileHistory` file, once per file. Return the number of imported entries."""
+        path = os.path.abspath(path)
+        key = "imported:" + path
+
+        with self._lock:
+            if self.connection.execute("SELECT 1 FROM meta WHERE key = ?", (key,)).fetchone():
+                return 0
+            if not os.path.exists(path):
+                return 0
+
+            now = time.time()
+            entries = [(query, created_at or now, None) for created_at, query in parse_file_history(path) if query]
+            with self.connection:
+                self.connection.execute("BEGIN")
+                self.connection.executemany("INSERT INTO history (query, created_at, server) VALUES (?, ?, ?)", entries)
+                self.connection.execute("INSERT INTO meta (key, value) VALUES (?, ?)", (key, str(now)))
+            return len(entries)
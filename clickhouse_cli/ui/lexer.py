@@ -1,7 +1,22 @@
 import re
 
+from prompt_toolkit.lexers import Lexer
+from prompt_toolkit.styles.pygments import pygments_token_to_classname
 from pygments.lexer import RegexLexer, bygroups, words
-from pygments.token import Comment, Generic, Keyword, Name, Number, Operator, Punctuation, String, Text, Whitespace
+from pygments.token import (
+    Comment,
+    Error,
+    Generic,
+    Keyword,
+    Name,
+    Number,
+    Operator,
+    Punctuation,
+    String,
+    Text,
+    Whitespace,
+    _TokenType,
+)
 
 from clickhouse_cli.clickhouse.definitions import (
     AGGREGATION_FUNCTIONS,
@@ -15,14 +30,18 @@ from clickhouse_cli.clickhouse.definitions import (
 
 line_re = re.compile(".*?\n")
 
+QUOTES = ("'", '"', "`")
 
-class CHLexer(RegexLexer):
-    name = "Clickhouse"
-    aliases = ["clickhouse"]
-    filenames = ["*.sql"]
-    mimetypes = ["text/x-clickhouse-sql"]
 
-    tokens = {
+def get_lexer_tokens(
+    functions=FUNCTIONS,
+    aggregation_functions=AGGREGATION_FUNCTIONS,
+    case_insensitive_functions=CASE_INSENSITIVE_FUNCTIONS,
+    datatypes=DATATYPES,
+    formats=FORMATS,
+):
+    """Build the token definitions of `CHLexer` from the given word lists."""
+    return {
         "root": [
             (r"\s+", Text),
             (r"(--\s*).*?\n", Comment),
@@ -34,18 +53,18 @@ class CHLexer(RegexLexer):
             (r"`(\\\\|\\`|``|[^`])*`", String),
             (r"[+*/<>=~!@#%^&|`?-]", Operator),
             (words(OPERATORS, prefix=r"(?i)", suffix=r"\b"), Keyword),
-            (words(DATATYPES, suffix=r"\b"), Keyword.Type),
-            (words(FORMATS), Name.Label),
+            (words(datatypes, suffix=r"\b"), Keyword.Type),
+            (words(formats), Name.Label),
             (
-                words(AGGREGATION_FUNCTIONS, suffix=r"(\s*)(\()"),
+                words(aggregation_functions, suffix=r"(\s*)(\()"),
                 bygroups(Name.Function, Text, Punctuation),
             ),
             (
-                words(CASE_INSENSITIVE_FUNCTIONS, prefix=r"(?i)", suffix=r"\b"),
+                words(case_insensitive_functions, prefix=r"(?i)", suffix=r"\b"),
                 Name.Function,
             ),
             (
-                words(FUNCTIONS, suffix=r"(\s*)(\()"),
+                words(functions, suffix=r"(\s*)(\()"),
                 bygroups(Name.Function, Text, Punctuation),
             ),
             (words(KEYWORDS, prefix=r"(?i)", suffix=r"\b"), Keyword),
@@ -75,6 +94,268 @@ class CHLexer(RegexLexer):
     }
 
 
+class CHLexer(RegexLexer):
+    name = "Clickhouse"
+    aliases = ["clickhouse"]
+    filenames = ["*.sql"]
+    mimetypes = ["text/x-clickhouse-sql"]
+
+    tokens = get_lexer_tokens()
+
+
+def make_lexer(catalogue):
+    """Create a `CHLexer` subclass that highlights the names from a server catalogue."""
+    return type(
+        "CHLexer",
+        (CHLexer,),
+        {
+            "tokens": get_lexer_tokens(
+                functions=catalogue.functions,
+                aggregation_functions=catalogue.combined_aggregate_functions,
+                case_insensitive_functions=catalogue.case_insensitive_functions,
+                datatypes=catalogue.datatypes,
+                formats=catalogue.formats,
+            )
+        },
+    )
+
+
+class CHKeywordLexer(RegexLexer):
+    """A cheap highlighter for huge inputs: comments, literals and keywords only."""
+
+    name = "Clickhouse (keywords)"
+
+    tokens = {
+        "root": [
+            (r"\s+", Text),
+            (r"(--\s*).*?\n", Comment),
+            (r"/\*", Comment.Multiline, "multiline-comments"),
+            (r"[0-9]+", Number),
+            (r"'(\\\\|\\'|''|[^'])*'", String),
+            (r'"(\\\\|\\"|""|[^"])*"', String),
+            (r"`(\\\\|\\`|``|[^`])*`", String),
+            (words(KEYWORDS, prefix=r"(?i)", suffix=r"\b"), Keyword),
+            (r"\w+", Text),
+            (r".", Punctuation),
+        ],
+        "multiline-comments": get_lexer_tokens()["multiline-comments"],
+    }
+
+
+def iter_matches(lexer, text, pos, stack):
+    """Run a `RegexLexer` over `text` from `pos` with the given state stack.
+
+    Follows `RegexLexer.get_tokens_unprocessed`, but yields every match as
+    `(pos, stack, tokens)` with the state stack it started in, so the lexing
+    can later be resumed from that point.
+    """
+    tokendefs = lexer._tokens
+    stack = list(stack)
+    statetokens = tokendefs[stack[-1]]
+
+    while pos < len(text):
+        for rexmatch, action, new_state in statetokens:
+            m = rexmatch(text, pos)
+            if not m:
+                continue
+
+            if action is None:
+                tokens = []
+            elif type(action) is _TokenType:
+                tokens = [(pos, action, m.group())]
+            else:
+                tokens = list(action(lexer, m))
+            yield pos, tuple(stack), tokens
+
+            pos = m.end()
+            if new_state is not None:
+                if isinstance(new_state, tuple):
+                    for state in new_state:
+                        if state == "#pop":
+                            if len(stack) > 1:
+                                stack.pop()
+                        elif state == "#push":
+                            stack.append(stack[-1])
+                        else:
+                            stack.append(state)
+                elif isinstance(new_state, int):
+                    if abs(new_state) >= len(stack):
+                        del stack[1:]
+                    else:
+                        del stack[new_state:]
+                elif new_state == "#push":
+                    stack.append(stack[-1])
+                statetokens = tokendefs[stack[-1]]
+            break
+        else:
+            if text[pos] == "\n":
+                yield pos, tuple(stack), [(pos, Whitespace, "\n")]
+                stack = ["root"]
+                statetokens = tokendefs["root"]
+            else:
+                yield pos, tuple(stack), [(pos, Error, text[pos])]
+            pos += 1
+
+
+def split_fragments(fragments, column):
+    """Split a line's `(token, text)` fragments at `column`."""
+    before = []
+    for i, (token, value) in enumerate(fragments):
+        if column <= 0:
+            return before, fragments[i:]
+        if len(value) > column:
+            return before + [(token, value[:column])], [(token, value[column:])] + fragments[i + 1 :]
+        before.append((token, value))
+        column -= len(value)
+    return before, []
+
+
+class IncrementalLexer(Lexer):
+    """Highlight the prompt with a pygments `RegexLexer`, re-lexing only what changed.
+
+    The tokens are kept per line, along with the position and the state stack of
+    the first match that starts on the line. After an edit the lexing resumes from
+    the last such checkpoint before the first changed line, and stops as soon as
+    it reaches an unchanged line in the same state as before.
+
+    Documents longer than `max_size` are highlighted with `fallback_cls` instead,
+    and the ones longer than `plain_size` (e.g. huge pastes) aren't highlighted at all.
+    """
+
+    def __init__(self, lexer_cls, fallback_cls=CHKeywordLexer, max_size=100000, plain_size=None):
+        self.lexer = lexer_cls()
+        self.fallback = fallback_cls()
+        self.max_size = max_size
+        self.plain_size = plain_size
+        self.styles = {}
+
+        self._active = None
+        self._text = None
+        self._lines = []
+        self._fragments = []
+        self._checkpoints = []
+        self._first_lone_quote = 0
+
+    def lex_document(self, document):
+        text = document.text
+        if self.plain_size is not None and len(text) > self.plain_size:
+            # Drop the cached tokens, they would take more memory than the text itself
+            self._active = self._text = None
+            self._lines, self._fragments, self._checkpoints = [], [], []
+            lines = document.lines
+            return lambda lineno: [("", lines[lineno])] if lineno < len(lines) else []
+
+        if text != self._text:
+            self._update(self.fallback if len(text) > self.max_size else self.lexer, text, document.lines)
+
+        styles = self.styles
+        fragments = self._fragments
+
+        def get_line(lineno):
+            try:
+                line = fragments[lineno]
+            except IndexError:
+                return []
+
+            result = []
+            for token, value in line:
+                style = styles.get(token)
+                if style is None:
+                    style = styles[token] = "class:" + pygments_token_to_classname(token)
+                result.append((style, value))
+            return result
+
+        return get_line
+
+    def _update(self, lexer, text, lines):
+        if lexer is not self._active:
+            self._active = lexer
+            self._lines, self._fragments, self._checkpoints = [], [], []
+            self._first_lone_quote = 0
+
+        old_lines, old_fragments, old_checkpoints = self._lines, self._fragments, self._checkpoints
+
+        # The first changed line and the length of the unchanged tail
+        first = 0
+        common = min(len(old_lines), len(lines))
+        while first < common and old_lines[first] == lines[first]:
+            first += 1
+        tail = 0
+        while tail < common - first and old_lines[-1 - tail] == lines[-1 - tail]:
+            tail += 1
+        tail_start = len(lines) - tail
+        shift = len(old_lines) - len(lines)
+
+        # Resume from the last checkpoint on an unchanged line. A quote that didn't match as a literal depends on
+        # whether a closing quote follows anywhere later, so the lexing can't resume past it.
+        resume = min(first - 1, self._first_lone_quote)
+        while resume >= 0 and old_checkpoints[resume] is None:
+            resume -= 1
+
+        if resume < 0:
+            resume, column, stack = 0, 0, ("root",)
+            current = []
+        else:
+            column, stack = old_checkpoints[resume]
+            current = split_fragments(old_fragments[resume], column)[0]
+
+        fragments = old_fragments[:resume]
+        checkpoints = old_checkpoints[:resume] + [(column, stack)]
+
+        line_starts = [0] * len(lines)
+        for i in range(1, len(lines)):
+            line_starts[i] = line_starts[i - 1] + len(lines[i - 1]) + 1
+
+        lineno = resume
+        reused = False
+
+        for pos, stack, tokens in iter_matches(lexer, text, line_starts[resume] + column, stack):
+            while lineno + 1 < len(lines) and line_starts[lineno + 1] <= pos:
+                fragments.append(current)
+                current = []
+                lineno += 1
+
+            if len(checkpoints) <= lineno:
+                checkpoints.extend([None] * (lineno - len(checkpoints)))
+                checkpoint = (pos - line_starts[lineno], stack)
+                checkpoints.append(checkpoint)
+
+                old_lineno = lineno + shift
+                if lineno >= tail_start and lineno > first and old_checkpoints[old_lineno] == checkpoint:
+                    fragments.append(current + split_fragments(old_fragments[old_lineno], checkpoint[0])[1])
+                    fragments.extend(old_fragments[old_lineno + 1 :])
+                    checkpoints.extend(old_checkpoints[old_lineno + 1 :])
+                    reused = True
+                    break
+
+            for token_pos, token, value in tokens:
+                while lineno + 1 < len(lines) and line_starts[lineno + 1] <= token_pos:
+                    fragments.append(current)
+                    current = []
+                    lineno += 1
+
+                parts = value.split("\n")
+                if parts[0]:
+                    current.append((token, parts[0]))
+                for part in parts[1:]:
+                    fragments.append(current)
+                    current = [(token, part)] if part else []
+                    lineno += 1
+
+        if not reused:
+            fragments.append(current)
+            fragments.extend([] for _ in range(len(lines) - len(fragments)))
+            checkpoints.extend([None] * (len(lines) - len(checkpoints)))
+
+        self._text = text
+        self._lines = lines
+        self._fragments = fragments
+        self._checkpoints = checkpoints
+        self._first_lone_quote = next(
+            (i for i, line in enumerate(fragments) if any(value in QUOTES for _, value in line)), len(fragments)
+        )
+
+
 class CHPrettyFormatLexer(RegexLexer):
     tokens = {
         "root": [
@@ -7,7 +7,7 @@ from sqlparse.tokens import Name
 
 from clickhouse_cli.clickhouse.definitions import KEYWORDS
 from clickhouse_cli.ui.parseutils.ctes import isolate_query_ctes
-from clickhouse_cli.ui.parseutils.tables import TableReference, extract_tables
+from clickhouse_cli.ui.parseutils.tables import extract_tables
 from clickhouse_cli.ui.parseutils.utils import find_prev_keyword, last_word, parse_partial_identifier
 
 Special = namedtuple("Special", [])
@@ -31,12 +31,18 @@ Table.__new__.__defaults__ = (None, tuple(), tuple())
 View.__new__.__defaults__ = (None, tuple())
 FromClauseItem.__new__.__defaults__ = (None, tuple(), tuple())
 
-Column = namedtuple("Column", ["table_refs", "require_last_table", "local_tables", "qualifiable"])
-Column.__new__.__defaults__ = (None, None, tuple(), False)
+# `value_of` switches a column suggestion to suggesting values of that column,
+# e.g. "WHERE status = 'act" -> value_of="status", value_prefix="act"
+Column = namedtuple(
+    "Column",
+    ["table_refs", "require_last_table", "local_tables", "qualifiable", "value_of", "value_prefix"],
+)
+Column.__new__.__defaults__ = (None, None, tuple(), False, None, None)
 
 Keyword = namedtuple("Keyword", [])
 Datatype = namedtuple("Datatype", ["schema"])
 Format = namedtuple("Format", [])
+Setting = namedtuple("Setting", [])
 Alias = namedtuple("Alias", ["aliases"])
 
 Path = namedtuple("Path", [])
@@ -44,6 +50,17 @@ Path = namedtuple("Path", [])
 
 white_space_regex = re.compile("\\s+", re.MULTILINE)
 
+# A string literal left open right after a comparison with a column:
+#   status = 'act
+#   t.status != 'act
+#   status IN ('active', 'dis
+value_comparison_regex = re.compile(
+    r"(?:^|[\s(,])(?:(?P<parent>[\w$]+)\.)?(?P<column>[\w$]+)\s*"
+    r"(?:==?|!=|<>|(?:not\s+)?in\s*\((?:\s*'(?:[^'\\]|\\.)*'\s*,)*)\s*"
+    r"'(?P<prefix>(?:[^'\\]|\\.)*)$",
+    re.IGNORECASE,
+)
+
 
 def _compile_regex(keyword):
     # Surround the keyword with word boundaries and replace interior whitespace
@@ -168,6 +185,10 @@ def suggest_type(full_text, text_before_cursor):
     except (TypeError, AttributeError):
         return []
 
+    value_match = value_comparison_regex.search(stmt.text_before_cursor_including_last_word)
+    if value_match:
+        return suggest_column_values(value_match, stmt)
+
     # # Check for special commands and handle those separately
     # if stmt.parsed:
     #     # Be careful here because trivial whitespace is parsed as a
@@ -337,8 +358,9 @@ def suggest_based_on_last_token(token, stmt):
                 qualifiable=True,
             ),
         )
-    elif token_v == "set":
-        return (Column(table_refs=stmt.get_tables(), local_tables=stmt.local_tables),)
+    elif token_v in ("set", "settings"):
+        # "SET max_threads = 1", "SELECT ... SETTINGS max_threads = 1"
+        return (Setting(),)
     elif token_v in ("select", "where", "having", "by", "distinct"):
         # Check for a table alias or schema qualification
         parent = (stmt.identifier and stmt.identifier.get_parent_name()) or None
@@ -352,15 +374,6 @@ def suggest_based_on_last_token(token, stmt):
                 Function(schema=parent),
             )
         else:
-            tables = tuple(
-                TableReference(
-                    schema=table.schema or "default",
-                    name=table.name,
-                    alias=table.alias,
-                    is_function=table.is_function,
-                )
-                for table in tables
-            )
             return (
                 Column(table_refs=tables, local_tables=stmt.local_tables),
                 Function(schema=None),
@@ -477,6 +490,21 @@ def suggest_based_on_last_token(token, stmt):
         return (Keyword(),)
 
 
+def suggest_column_values(match, stmt):
+    parent = match.group("parent")
+    tables = stmt.get_tables()
+    if parent:
+        tables = tuple(t for t in tables if identifies(parent, t))
+    return (
+        Column(
+            table_refs=tables,
+            local_tables=stmt.local_tables,
+            value_of=match.group("column"),
+            value_prefix=match.group("prefix"),
+        ),
+    )
+
+
 def identifies(id, ref):
     """Returns true if string `id` matches TableReference `ref`"""
     return id == ref.alias or id == ref.name or (ref.schema and (id == ref.schema + "." + ref.name))
@@ -0,0 +1,174 @@
+import math
+import re
+import threading
+import time
+
+from clickhouse_cli.helpers import numberunit_fmt, sizeof_fmt
+
+# The counters of an `X-ClickHouse-Progress: {"read_rows":"1",...}` header; values are quoted strings
+PROGRESS_FIELD_RE = re.compile(rb'"(\w+)":"?(\d+)')
+
+
+def parse_progress(line):
+    """Parse a progress header line, cheaply enough to run for each of the thousands a query may send."""
+    fields = dict(PROGRESS_FIELD_RE.findall(line))
+    read_rows = int(fields.get(b"read_rows", 0))
+    total_rows = int(fields.get(b"total_rows_to_read", fields.get(b"total_rows", 0)))
+    return {
+        "timestamp": time.monotonic(),
+        "read_rows": read_rows,
+        "read_bytes": int(fields.get(b"read_bytes", 0)),
+        "written_rows": int(fields.get(b"written_rows", 0)),
+        "written_bytes": int(fields.get(b"written_bytes", 0)),
+        "total_rows": total_rows,
+        "percents": min(100, int(read_rows * 100 / total_rows)) if total_rows > 0 else 0,
+    }
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+    return "{}:{:02d}".format(seconds // 60, seconds % 60)
+
+
+def smooth(average, rate, delta, tau):
+    """Exponential moving average of `rate`, weighted by the `delta` seconds since the previous sample."""
+    if average is None:
+        return rate
+    return average + (1 - math.exp(-delta / tau)) * (rate - average)
+
+
+class ProgressBar(object):
+    """Draws the progress of the running query from a ticker thread.
+
+    `update` only keeps the latest counters, so the thread reading the response
+    never waits on the terminal; the ticker redraws at most every `interval`
+    seconds, with rates smoothed over `tau` seconds and an ETA.
+
+    While a request body is being sent, `update_upload` adds the bytes sent so
+    far to the line, next to the rows the server reports as written.
+    """
+
+    def __init__(self, draw, interval=0.1, tau=2.0):
+        self.draw = draw
+        self.interval = interval
+        self.tau = tau
+        self.latest = None
+        self.upload = None
+        self.drawn = False
+        self.sample = None
+        self.rows_rate = None
+        self.bytes_rate = None
+        self.upload_sample = None
+        self.upload_rate = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def update(self, progress):
+        self.latest = progress
+        self._start()
+
+    def update_upload(self, sent, total=None):
+        """Called for each chunk of a request body: `sent` bytes so far, out of `total` if known."""
+        self.upload = (time.monotonic(), sent, total)
+        self._start()
+
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._stopped.clear()
+                    self._thread = threading.Thread(target=self._run, name="progress", daemon=True)
+                    self._thread.start()
+
+    def stop(self):
+        """Stop the ticker and start over. Return the latest progress, and whether anything was drawn."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stopped.set()
+            thread.join()
+
+        progress, drawn = self.latest, self.drawn
+        self.latest = self.sample = self.rows_rate = self.bytes_rate = None
+        self.upload = self.upload_sample = self.upload_rate = None
+        self.drawn = False
+        return progress, drawn
+
+    def add_sample(self, progress):
+        previous, self.sample = self.sample, progress
+        if previous is None:
+            return
+        delta = progress["timestamp"] - previous["timestamp"]
+        if delta <= 0:
+            return
+
+        # Inserts read nothing; their rate is the one of the rows written
+        if progress.get("written_rows"):
+            rows_key, bytes_key = "written_rows", "written_bytes"
+        else:
+            rows_key, bytes_key = "read_rows", "read_bytes"
+        rows_rate = (progress[rows_key] - previous.get(rows_key, 0)) / delta
+        bytes_rate = (progress[bytes_key] - previous.get(bytes_key, 0)) / delta
+        self.rows_rate = smooth(self.rows_rate, rows_rate, delta, self.tau)
+        self.bytes_rate = smooth(self.bytes_rate, bytes_rate, delta, self.tau)
+
+    def add_upload_sample(self, upload):
+        previous, self.upload_sample = self.upload_sample, upload
+        if previous is None:
+            return
+        delta = upload[0] - previous[0]
+        if delta > 0:
+            self.upload_rate = smooth(self.upload_rate, (upload[1] - previous[1]) / delta, delta, self.tau)
+
+    def format(self, progress):
+        if progress.get("written_rows"):
+            message = "Progress: written {} rows, {}".format(
+                numberunit_fmt(progress["written_rows"]), sizeof_fmt(progress["written_bytes"])
+            )
+        else:
+            message = "Progress: {} rows, {}".format(
+                numberunit_fmt(progress["read_rows"]), sizeof_fmt(progress["read_bytes"])
+            )
+        if self.rows_rate is not None:
+            message += " ({} rows/s, {}/s)".format(numberunit_fmt(self.rows_rate), sizeof_fmt(self.bytes_rate))
+            remaining = progress["total_rows"] - progress["read_rows"]
+            if remaining > 0 and self.rows_rate > 0:
+                message += " ETA {}".format(format_duration(remaining / self.rows_rate))
+        return message
+
+    def format_upload(self, upload, progress=None):
+        _, sent, total = upload
+        message = "Sent: {}".format(sizeof_fmt(sent))
+        if total:
+            message += " of {}".format(sizeof_fmt(total))
+        if self.upload_rate is not None:
+            message += " ({}/s)".format(sizeof_fmt(self.upload_rate))
+            if total and total > sent and self.upload_rate > 0:
+                message += " ETA {}".format(format_duration((total - sent) / self.upload_rate))
+        if progress is not None and progress.get("written_rows"):
+            # A server writing much slower than we send is the bottleneck, and vice versa
+            message += ", server wrote {} rows".format(numberunit_fmt(progress["written_rows"]))
+            if self.rows_rate is not None:
+                message += " ({} rows/s)".format(numberunit_fmt(self.rows_rate))
+        return message
+
+    def _run(self):
+        shown = shown_upload = None
+        while not self._stopped.wait(self.interval):
+            progress, upload = self.latest, self.upload
+            if progress is shown and upload is shown_upload:
+                continue
+            if progress is not None and progress is not shown:
+                self.add_sample(progress)
+            shown, shown_upload = progress, upload
+
+            if upload is not None:
+                self.add_upload_sample(upload)
+                _, sent, total = upload
+                self.draw(self.format_upload(upload, progress), min(100, sent * 100 // total) if total else 0)
+            else:
+                self.draw(self.format(progress), progress["percents"])
+            self.drawn = True
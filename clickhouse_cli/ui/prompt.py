@@ -7,7 +7,6 @@ from prompt_toolkit.keys import Keys
 from pygments.token import Token
 
 from clickhouse_cli.clickhouse.definitions import INTERNAL_COMMANDS
-from clickhouse_cli.ui.completer import CHCompleter
 
 # from prompt_toolkit.formatted_text import PygmentsTokens
 
@@ -28,10 +27,10 @@ def is_multiline(multiline):
 
 
 class CLIBuffer(Buffer):
-    def __init__(self, client, multiline, metadata, *args, **kwargs):
+    def __init__(self, completer, multiline, *args, **kwargs):
         super(CLIBuffer, self).__init__(
             *args,
-            completer=CHCompleter(client, metadata),
+            completer=completer,
             enable_history_search=True,
             # doesn't seem to have any effect on prompt_toolkit 2.x's PromptSession
             # multiline=is_multiline(multiline),
@@ -39,9 +38,18 @@ class CLIBuffer(Buffer):
         )
 
 
+# `;` ends a query, `&` and `\bg` run it in the background
+QUERY_ENDINGS = (";", "&", r"\bg")
+
+
 def query_is_finished(text, multiline=False):
+    tail = text[-1024:]
+    if len(text) > len(tail) and not tail.isspace():
+        # Runs on every key press, so don't strip a (possibly multi-megabyte) paste as a whole
+        return tail.rstrip().endswith(QUERY_ENDINGS)
+
     text = text.strip()
-    return (not multiline and text == "") or text.endswith(";") or text in INTERNAL_COMMANDS
+    return (not multiline and text == "") or text.endswith(QUERY_ENDINGS) or text in INTERNAL_COMMANDS
 
 
 def get_prompt_tokens(*args):
@@ -0,0 +1,167 @@
+import re
+from collections import namedtuple
+from functools import partial
+
+from clickhouse_cli.helpers import unescape_tsv
+
+TSV_ESCAPE_TABLE = str.maketrans(
+    {"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r", "\0": "\\0", "\b": "\\b", "\f": "\\f"}
+)
+# A result kept to be rendered again, its cells as parse_tsv_with_names_and_types gives them
+KeptResult = namedtuple("KeptResult", ["query", "columns", "types", "rows"])
+# How NULL cells (None) look in the Pretty-like formats and in the text ones
+PRETTY_NULL = "ᴺᵁᴸᴸ"
+TSV_NULL = "\\N"
+# The types whose values the Pretty formats align to the right
+NUMERIC_TYPE_RE = re.compile(r"^(?:Nullable\()?(?:U?Int\d+|Float\d+|Decimal(?:\d+)?\b)")
+
+
+def escape_tsv(value):
+    return TSV_NULL if value is None else value.translate(TSV_ESCAPE_TABLE)
+
+
+def quote_csv(value):
+    return '"' + value.replace('"', '""') + '"'
+
+
+def show_nulls(rows):
+    return [[PRETTY_NULL if value is None else value for value in row] for row in rows]
+
+
+def parse_tsv_with_names_and_types(text):
+    """Parse a result in the TabSeparatedWithNamesAndTypes format into (columns, types, rows).
+
+    The cells stay in the text form the server gave them, with None for NULL.
+    """
+    lines = text.split("\n")
+    if lines and lines[-1] == "":
+        lines.pop()
+    if len(lines) < 2:
+        return [], [], []
+    columns = [unescape_tsv(name) for name in lines[0].split("\t")]
+    types = [unescape_tsv(name) for name in lines[1].split("\t")]
+    rows = [[None if value == TSV_NULL else unescape_tsv(value) for value in line.split("\t")] for line in lines[2:]]
+    return columns, types, rows
+
+
+def numeric_columns(types):
+    return [i for i, type_name in enumerate(types) if NUMERIC_TYPE_RE.match(type_name)]
+
+
+def render_pretty_compact(columns, rows, right_aligned=()):
+    rows = show_nulls(rows)
+    widths = [len(name) for name in columns]
+    for row in rows:
+        for i, value in enumerate(row):
+            widths[i] = max(widths[i], len(value))
+
+    def header_cell(i, name):
+        padding = "─" * (widths[i] - len(name))
+        return "─" + (padding + name if i in right_aligned else name + padding) + "─"
+
+    def cell(i, value):
+        return " " + (value.rjust(widths[i]) if i in right_aligned else value.ljust(widths[i])) + " "
+
+    lines = ["┌" + "┬".join(header_cell(i, name) for i, name in enumerate(columns)) + "┐"]
+    lines.extend("│" + "│".join(cell(i, value) for i, value in enumerate(row)) + "│" for row in rows)
+    lines.append("└" + "┴".join("─" * (width + 2) for width in widths) + "┘")
+    return "\n".join(lines) + "\n"
+
+
+def render_pretty(columns, rows, right_aligned=()):
+    rows = show_nulls(rows)
+    widths = [len(name) for name in columns]
+    for row in rows:
+        for i, value in enumerate(row):
+            widths[i] = max(widths[i], len(value))
+
+    def cell(i, value):
+        return " " + (value.rjust(widths[i]) if i in right_aligned else value.ljust(widths[i])) + " "
+
+    lines = [
+        "┏" + "┳".join("━" * (width + 2) for width in widths) + "┓",
+        "┃" + "┃".join(cell(i, name) for i, name in enumerate(columns)) + "┃",
+        "┡" + "╇".join("━" * (width + 2) for width in widths) + "┩",
+    ]
+    separator = "├" + "┼".join("─" * (width + 2) for width in widths) + "┤"
+    for number, row in enumerate(rows):
+        if number:
+            lines.append(separator)
+        lines.append("│" + "│".join(cell(i, value) for i, value in enumerate(row)) + "│")
+    lines.append("└" + "┴".join("─" * (width + 2) for width in widths) + "┘")
+    return "\n".join(lines) + "\n"
+
+
+def render_vertical(columns, rows, right_aligned=()):
+    width = max((len(name) for name in columns), default=0)
+    blocks = []
+    for number, row in enumerate(show_nulls(rows), 1):
+        title = "Row {}:".format(number)
+        lines = [title, "─" * len(title)]
+        lines.extend((name + ":").ljust(width + 2) + value for name, value in zip(columns, row))
+        blocks.append("\n".join(lines) + "\n")
+    return "\n".join(blocks)
+
+
+def render_markdown(columns, rows, right_aligned=()):
+    def line(values):
+        return "| " + " | ".join(value.replace("|", "\\|") for value in values) + " |"
+
+    lines = [line(columns), "|" + "|".join("-:" if i in right_aligned else ":-" for i in range(len(columns))) + "|"]
+    lines.extend(line(row) for row in show_nulls(rows))
+    return "\n".join(lines) + "\n"
+
+
+def render_tsv(columns, rows, with_names=False, right_aligned=()):
+    lines = ["\t".join(escape_tsv(name) for name in columns)] if with_names else []
+    lines.extend("\t".join(escape_tsv(value) for value in row) for row in rows)
+    return "".join(line + "\n" for line in lines)
+
+
+def render_csv(columns, rows, with_names=False, right_aligned=()):
+    # Like the server: numbers go unquoted, NULL is \N
+    def cell(i, value):
+        if value is None:
+            return TSV_NULL
+        return value if i in right_aligned else quote_csv(value)
+
+    lines = [",".join(quote_csv(name) for name in columns)] if with_names else []
+    lines.extend(",".join(cell(i, value) for i, value in enumerate(row)) for row in rows)
+    return "".join(line + "\n" for line in lines)
+
+
+RENDERERS = {
+    "Pretty": render_pretty,
+    "PrettyNoEscapes": render_pretty,
+    "PrettyCompact": render_pretty_compact,
+    "PrettyCompactMonoBlock": render_pretty_compact,
+    "PrettyCompactNoEscapes": render_pretty_compact,
+    "TabSeparated": render_tsv,
+    "TSV": render_tsv,
+    "TabSeparatedWithNames": partial(render_tsv, with_names=True),
+    "TSVWithNames": partial(render_tsv, with_names=True),
+    "CSV": render_csv,
+    "CSVWithNames": partial(render_csv, with_names=True),
+    "Vertical": render_vertical,
+    "Markdown": render_markdown,
+}
+
+
+# The formats the server cuts short after output_format_pretty_max_rows rows
+MAX_ROWS_FORMATS = frozenset(fmt for fmt in RENDERERS if fmt.startswith("Pretty") or fmt == "Vertical")
+
+
+def can_render(fmt):
+    return fmt in RENDERERS
+
+
+def render(columns, rows, fmt, right_aligned=(), max_rows=None):
+    """Render string cells (None for NULL) the way the server would in the `fmt` format.
+
+    `right_aligned` holds the indexes of the numeric columns, which Pretty formats align to the right.
+    Like the server, the Pretty formats and Vertical show the first `max_rows` rows only.
+    """
+    if max_rows is None or fmt not in MAX_ROWS_FORMATS or len(rows) <= max_rows:
+        return RENDERERS[fmt](columns, rows, right_aligned=frozenset(right_aligned))
+    text = RENDERERS[fmt](columns, rows[:max_rows], right_aligned=frozenset(right_aligned))
+    return text + "  Showed first {}.\n".format(max_rows)
@@ -0,0 +1,58 @@
+import fnmatch
+import re
+from collections import defaultdict
+
+
+def compile_pattern(pattern):
+    """Turn a `\\find` pattern into a predicate over names.
+
+    `/regex/` is a regular expression, anything with `*`, `?` or `[` is a glob,
+    and everything else must match exactly. Matching is case-insensitive.
+    """
+    if len(pattern) > 1 and pattern.startswith("/") and pattern.endswith("/"):
+        return re.compile(pattern[1:-1], re.IGNORECASE).search
+    if any(c in pattern for c in "*?["):
+        return re.compile(fnmatch.translate(pattern), re.IGNORECASE).match
+    pattern = pattern.lower()
+    return lambda name: name.lower() == pattern
+
+
+class ColumnIndex(object):
+    """An inverted index from column names and types to the tables that have them."""
+
+    def __init__(self):
+        self.by_name = defaultdict(list)
+        self.by_type = defaultdict(set)
+
+    @classmethod
+    def build(cls, tables):
+        """Index `tables` shaped like `metadata["tables"]`: {database: {table: {column: Col}}}."""
+        index = cls()
+        for database, database_tables in tables.items():
+            for table, columns in database_tables.items():
+                for column in columns.values():
+                    index.by_name[column.name].append((database, table, column.name, column.datatype))
+                    index.by_type[column.datatype].add(column.name)
+        return index
+
+    def find(self, name_pattern, type_pattern=None):
+        """Return sorted (database, table, column, type) tuples matching the patterns.
+
+        The patterns are tested against the distinct names and types only,
+        which are far fewer than the columns themselves.
+        """
+        match_name = compile_pattern(name_pattern)
+        names = [name for name in self.by_name if match_name(name)]
+
+        if type_pattern is not None:
+            match_type = compile_pattern(type_pattern)
+            allowed = set()
+            for datatype, type_names in self.by_type.items():
+                if match_type(datatype):
+                    allowed.update(type_names)
+            names = [name for name in names if name in allowed]
+
+        result = [entry for name in names for entry in self.by_name[name]]
+        if type_pattern is not None:
+            result = [entry for entry in result if match_type(entry[3])]
+        return sorted(result)
@@ -0,0 +1,75 @@
+from unittest.mock import MagicMock
+
+from clickhouse_cli.clickhouse.cache import ResultCache, find_tables, normalize_query
+from clickhouse_cli.clickhouse.client import Response
+
+
+def make_client(parts):
+    client = MagicMock(url="http://localhost:8123/", user="default", database="default", settings={})
+
+    def query(query, fmt, **kwargs):
+        return Response(query, fmt, "".join("{}\t{}\t{}\n".format(*row) for row in parts))
+
+    client.query = MagicMock(side_effect=query)
+    return client
+
+
+def test_find_tables():
+    query = "SELECT * FROM hits AS h JOIN `my db`.visits USING id WHERE id IN (SELECT id FROM users) ARRAY JOIN tags"
+    assert find_tables(query, "default") == {("default", "hits"), ("my db", "visits"), ("default", "users")}
+    assert find_tables("SELECT * FROM numbers(10)", "default") is None
+    assert find_tables("SELECT 1", "default") == set()
+
+    assert normalize_query("SELECT  a,\n 'x  y'  -- why\nFROM t;") == "SELECT a, 'x  y' FROM t"
+
+
+def test_result_cache(tmp_path):
+    parts = [("default", "hits", "MergeTree")]
+    client = make_client(parts)
+    cache = ResultCache(client, size=1, path=str(tmp_path), disk_size=1 << 20)
+
+    response, ticket = cache.lookup("SELECT count() FROM hits", "TabSeparated")
+    assert response is None and ticket is not None
+    cache.store(ticket, Response("SELECT count() FROM hits", "TabSeparated", "42\n"))
+
+    response, ticket = cache.lookup("SELECT count()\nFROM hits;", "TabSeparated")
+    assert (response.data, response.origin, ticket) == ("42\n", "cache", None)
+    assert "system.parts" in client.query.call_args.args[0]
+
+    # Another format, other parameters, or another database, is another result
+    assert cache.lookup("SELECT count() FROM hits", "CSV")[0] is None
+    assert cache.lookup("SELECT count() FROM hits", "TabSeparated", parameters={"id": "1"})[0] is None
+    client.database = "test"
+    assert cache.lookup("SELECT count() FROM hits", "TabSeparated")[0] is None
+    client.database = "default"
+    client.settings = {"join_use_nulls": "1"}
+    assert cache.lookup("SELECT count() FROM hits", "TabSeparated")[0] is None
+    client.settings = {}
+
+    # Evicted from the memory, still on disk
+    cache.store(cache.lookup("SELECT 2 FROM hits", "TabSeparated")[1], Response("", "TabSeparated", "2\n"))
+    assert list(cache.entries) == [cache.key("SELECT 2 FROM hits", "TabSeparated")]
+    assert cache.lookup("SELECT count() FROM hits", "TabSeparated")[0].data == "42\n"
+
+    # An insert changes the parts
+    parts[0] = ("default", "hits", "ReplicatedMergeTree")
+    response, ticket = cache.lookup("SELECT count() FROM hits", "TabSeparated")
+    assert response is None and ticket is not None
+
+
+def test_uncacheable_queries():
+    client = make_client([("default", "log", "Memory")])
+    cache = ResultCache(client)
+    for query in (
+        "SELECT now(), count() FROM hits",
+        "SELECT * FROM system.parts",
+        "INSERT INTO hits VALUES",
+        "SELECT * FROM hits JOIN {other:Identifier} USING id",
+        "SELECT dictGetString('users', 'name', id) FROM hits",
+        "SELECT joinGet(names, 'name', id) FROM hits",
+    ):
+        assert cache.lookup(query, "TabSeparated") == (None, None)
+    client.query.assert_not_called()
+
+    # Not a MergeTree table, its changes can't be told
+    assert cache.lookup("SELECT * FROM log", "TabSeparated") == (None, None)
@@ -0,0 +1,57 @@
+import io
+import json
+from unittest.mock import MagicMock
+
+from clickhouse_cli.checkpoint import Checkpoint
+from clickhouse_cli.cli import CLI
+from clickhouse_cli.clickhouse.sessions import SessionPool
+
+SCRIPT = b"""
+USE db;
+CREATE TABLE a (x UInt8) ENGINE = Memory;
+INSERT INTO a SELECT 1;
+INSERT INTO a SELECT 2;
+"""
+
+
+def run(path, script, resume=False, fail=(), **kwargs):
+    cli = CLI(*[None] * 13, **kwargs)
+    cli.client = MagicMock(database="default")
+    cli.sessions = SessionPool(cli.client)
+    cli.handle_query = MagicMock(side_effect=lambda statement, **kw: False if statement in fail else None)
+    cli.checkpoint = Checkpoint(str(path), resume=resume)
+    run_script = cli.run_script_parallel if cli.parallel > 1 else cli.run_script
+    run_script(io.BytesIO(script))
+    cli.checkpoint.close()
+    return [call.args[0] for call in cli.handle_query.call_args_list]
+
+
+def test_checkpoint_hashes_are_chained():
+    first, second = Checkpoint(), Checkpoint()
+    assert first.advance("SELECT 1") == second.advance("SELECT 1")
+    assert first.advance("SELECT 2") != second.advance("SELECT 3")
+    assert first.advance("SELECT 4") != second.advance("SELECT 4")
+
+
+def test_resume_skips_completed_statements(tmp_path):
+    path = tmp_path / "checkpoint.jsonl"
+    executed = run(path, SCRIPT, fail=["INSERT INTO a SELECT 1"], stop_on_error=True)
+    assert executed == ["USE db", "CREATE TABLE a (x UInt8) ENGINE = Memory", "INSERT INTO a SELECT 1"]
+    assert [json.loads(line)["status"] for line in path.read_text().splitlines()] == ["ok", "ok", "failed"]
+
+    # USE only changes the session, so it's executed again
+    assert run(path, SCRIPT, resume=True) == ["USE db", "INSERT INTO a SELECT 1", "INSERT INTO a SELECT 2"]
+    assert run(path, SCRIPT, resume=True) == ["USE db"]
+
+    # Changing a statement invalidates the checkpoint from there on
+    edited = SCRIPT.replace(b"SELECT 1", b"SELECT 10")
+    assert run(path, edited, resume=True) == ["USE db", "INSERT INTO a SELECT 10", "INSERT INTO a SELECT 2"]
+
+    # Without --resume, the checkpoint starts over
+    assert len(run(path, SCRIPT)) == 4
+
+
+def test_resume_parallel_run(tmp_path):
+    path = tmp_path / "checkpoint.jsonl"
+    run(path, SCRIPT, fail=["INSERT INTO a SELECT 2"], parallel=2)
+    assert run(path, SCRIPT, resume=True, parallel=2) == ["USE db", "INSERT INTO a SELECT 2"]
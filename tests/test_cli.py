@@ -1,10 +1,19 @@
+import datetime
+import threading
+import time
 import pytest
 from unittest.mock import MagicMock, patch
 
+import requests
 from click.testing import CliRunner
 
-from clickhouse_cli.cli import run_cli
-from clickhouse_cli.clickhouse.client import Client
+from clickhouse_cli.cli import CLI, run_cli
+from clickhouse_cli.clickhouse.client import Client, Response
+from clickhouse_cli.clickhouse.exceptions import DBException, QueryCancelled
+from clickhouse_cli.helpers import split_insert_values
+from clickhouse_cli.ui.completer import CHCompleter, Col
+from clickhouse_cli.ui.prompt import query_is_finished
+from clickhouse_cli.ui.render import KeptResult, parse_tsv_with_names_and_types
 
 
 def test_main_help():
@@ -97,3 +106,258 @@ def test_custom_headers_override_defaults():
         client._query("GET", "SELECT 1", {}, fmt="Null", stream=False)
 
     assert captured["headers"]["User-Agent"] == "my-custom-agent"
+
+
+def test_split_insert_values():
+    rows = "(1, 'a'),\n(2, 'b')"
+    assert split_insert_values("INSERT INTO t (id, name) VALUES\n" + rows + ";\n") == (
+        "INSERT INTO t (id, name) VALUES",
+        rows,
+    )
+    assert split_insert_values("insert into db.t_values values (1)") == ("insert into db.t_values values", "(1)")
+    assert split_insert_values("INSERT INTO t_select VALUES (1)") == ("INSERT INTO t_select VALUES", "(1)")
+    # Anything else goes through the regular statement splitting
+    assert split_insert_values("INSERT INTO t VALUES (1); SELECT 1") is None
+    assert split_insert_values("INSERT INTO t SELECT 1") is None
+    assert split_insert_values("INSERT INTO t SELECT * FROM values('x UInt8', 1)") is None
+    assert split_insert_values("INSERT INTO t (values_count, values) VALUES (1, 2)") == (
+        "INSERT INTO t (values_count, values) VALUES",
+        "(1, 2)",
+    )
+    assert split_insert_values("SELECT 1") is None
+
+
+def test_query_is_finished_looks_at_the_end_of_large_input():
+    text = "INSERT INTO t VALUES " + ", ".join(["(1)"] * 10000)
+    assert not query_is_finished(text)
+    assert query_is_finished(text + ";\n  ")
+    assert query_is_finished("\\d")
+    assert query_is_finished("   ")
+    assert not query_is_finished("SELECT 1")
+
+
+def test_cancel_closes_the_response_and_kills_the_queries_at_once():
+    client = Client(url="http://localhost:8123/", user="default", password="", database="default", cookie=None)
+    closed = threading.Event()
+    requests_sent = []
+
+    class SlowResponse(object):
+        status_code = 200
+        headers = {}
+
+        @property
+        def content(self):
+            closed.wait(5)
+            raise requests.exceptions.ChunkedEncodingError("closed")
+
+        def close(self):
+            closed.set()
+
+    kill_response = requests.Response()
+    kill_response.status_code = 200
+    kill_response._content = b"pending\tq1\tdefault\tSELECT sleep(10)\n"
+    kill_response.elapsed = datetime.timedelta()
+
+    def fake_request(method, url, **kwargs):
+        requests_sent.append(kwargs["data"].read().decode())
+        return SlowResponse() if len(requests_sent) == 1 else kill_response
+
+    errors = []
+
+    def run():
+        try:
+            client.query("SELECT sleep(10)", fmt="Null", query_id="q1")
+        except QueryCancelled as e:
+            errors.append(e)
+
+    with patch("requests.Session.request", side_effect=fake_request):
+        thread = threading.Thread(target=run)
+        thread.start()
+        while client.active.get("q1") is None:
+            time.sleep(0.01)
+        assert client.cancel() == ["q1"]
+        thread.join(5)
+
+    assert closed.is_set() and len(errors) == 1
+    assert requests_sent[1] == "KILL QUERY WHERE query_id IN ('q1') ASYNC FORMAT TabSeparated\n"
+    assert client.active == {} and client.cancelled == set()
+    # Nothing left to cancel
+    assert client.cancel() == []
+
+    # A query that finished before the cancel came isn't kept as cancelled
+    with patch("requests.Session.request", side_effect=fake_request):
+        client.cancel(["q2"])
+    assert client.cancelled == set()
+
+
+def test_exceptions_without_a_response_are_printed(capsys):
+    cli = CLI(*[None] * 13)
+    cli.load_config()
+    cli.highlight = False
+    cli.print_db_exception("SELECT 1", DBException(None, "SELECT 1", text="Code: 241. DB::Exception: Memory limit"))
+    assert "Code: 241. DB::Exception: Memory limit" in capsys.readouterr().out
+
+
+def test_insert_reports_the_upload_and_the_rows_written(tmp_path):
+    client = Client(url="http://localhost:8123/", user="default", password="", database="default", cookie=None)
+    path = tmp_path / "data.tsv"
+    path.write_bytes(b"1\n" * 50000)
+    uploads = []
+
+    response = requests.Response()
+    response.status_code = 200
+    response._content = b""
+    response.elapsed = datetime.timedelta(seconds=1)
+    response.headers["X-ClickHouse-Summary"] = '{"written_rows":"50000","written_bytes":"400000"}'
+
+    def fake_request(method, url, **kwargs):
+        while kwargs["data"].read(4096):
+            pass
+        return response
+
+    with patch("requests.Session.request", side_effect=fake_request), open(path, "rb") as data:
+        result = client.query("INSERT INTO t FORMAT TSV", data=data, on_upload=lambda *args: uploads.append(args))
+
+    size = len("INSERT INTO t FORMAT TSV\n") + 100000
+    assert result.sent_bytes == size and uploads[-1] == (size, size)
+    assert len(uploads) > 1 and all(total == size for _, total in uploads)
+    assert result.summary == {"written_rows": 50000, "written_bytes": 400000}
+
+
+def test_results_are_rendered_locally_and_shown_again(capsys):
+    cli = CLI(*[None] * 13)
+    cli.load_config()
+    cli.local_render, cli.highlight = True, False
+    cli.format = "PrettyCompact"
+    cli.client = MagicMock()
+
+    def query(query, fmt, **kwargs):
+        response = Response(query, fmt, "n\ts\nUInt8\tNullable(String)\n1\ta\\tb\n22\t\\N\n")
+        response.time_elapsed, response.sent_bytes = 0.1, None
+        return response
+
+    cli.client.query = MagicMock(side_effect=query)
+
+    cli.handle_query("SELECT n, s FROM t", verbose=True)
+    assert cli.client.query.call_args.kwargs["fmt"] == "TabSeparatedWithNamesAndTypes"
+    out = capsys.readouterr().out
+    assert "│  1 │ a\tb  │\n│ 22 │ ᴺᵁᴸᴸ │" in out and "2 rows in set." in out
+
+    cli.client.query.reset_mock()
+    cli.handle_query(r"\show 1 as CSV", verbose=True)
+    cli.handle_query(r"\show as Vertical", verbose=True)
+    cli.client.query.assert_not_called()
+    out = capsys.readouterr().out
+    assert '1,"a\tb"\n22,\\N\n' in out
+    assert "Row 2:\n──────\nn: 22\ns: ᴺᵁᴸᴸ\n" in out
+
+    cli.handle_query(r"\show 2", verbose=True)
+    cli.handle_query(r"\show 1 as XML", verbose=True)
+    out = capsys.readouterr().out
+    assert "There's no result 2" in out and "Can't render XML locally" in out
+
+    # \G asks for the Vertical format, rendered locally as well
+    cli.handle_query(r"SELECT n, s FROM t\G", verbose=True)
+    assert cli.client.query.call_args.args[0] == "SELECT n, s FROM t"
+    assert "Row 1:" in capsys.readouterr().out
+    assert len(cli.results) == 2
+
+    # Inserts are left alone, even behind a comment
+    for query in ("INSERT INTO t VALUES (1)", "-- load\nINSERT INTO t VALUES (1)", "/* load */ INSERT INTO t SELECT 1"):
+        assert cli.local_render_format(query) == (query, None)
+
+
+def test_local_rendering_is_capped(capsys):
+    cli = CLI(*[None] * 13)
+    cli.load_config()
+    cli.local_render, cli.highlight = True, False
+    cli.format = "PrettyCompact"
+    cli.client = MagicMock()
+    data = "n\nUInt32\n" + "".join("%d\n" % i for i in range(20))
+    cli.client.query.side_effect = lambda query, fmt, **kwargs: Response(query, fmt, data)
+
+    cli.handle_query("SET output_format_pretty_max_rows = 5", verbose=True)
+    cli.handle_query("SELECT number AS n FROM numbers(20)", verbose=True)
+    out = capsys.readouterr().out
+    assert "│ 4 │\n└───┘\n  Showed first 5.\n" in out and "20 rows in set." in out
+    # All of the rows are kept, for other formats
+    assert len(cli.results[0].rows) == 20
+    cli.handle_query(r"\show as TSV", verbose=True)
+    assert "19\n" in capsys.readouterr().out
+
+    with patch("clickhouse_cli.cli.MAX_KEPT_RESULT_SIZE", 10):
+        cli.handle_query("SELECT number AS n FROM numbers(20)", verbose=True)
+    assert len(cli.results) == 1
+
+
+def test_results_are_loaded_into_sqlite(capsys):
+    cli = CLI(*[None] * 13)
+    cli.load_config()
+    cli.highlight, cli.format = False, "TSV"
+    data = "n\tname\tscore\tday\nUInt64\tLowCardinality(String)\tNullable(Float64)\tDate\n"
+    data += "18446744073709551615\tb\t1.5\t2024-01-02\n2\ta\t\\N\t2024-01-01\n"
+    columns, types, rows = parse_tsv_with_names_and_types(data)
+    cli.results.appendleft(KeptResult("SELECT ...", columns, types, rows))
+
+    cli.handle_query(r"\local as agg", verbose=True)
+    assert "Loaded 2 rows into the local table agg" in capsys.readouterr().out
+
+    response = cli.handle_query(r"\lq SELECT name, n, score * 2, typeof(n) FROM agg ORDER BY day", verbose=True)
+    assert response.origin == "local"
+    assert response.data == "a\t2\t\\N\tinteger\nb\t1.8446744073709552e+19\t3.0\treal\n"
+
+    cli.handle_query(r"\lq SELECT * FROM nowhere", verbose=True)
+    cli.handle_query(r"\local 2", verbose=True)
+    out = capsys.readouterr().out
+    assert "no such table: nowhere" in out and "There's no result 2" in out
+
+
+def test_query_parameters_are_set_in_the_shell(capsys):
+    cli = CLI(*[None] * 13)
+    cli.load_config()
+    cli.highlight, cli.format = False, "TSV"
+    cli.client = MagicMock()
+    cli.client.query.return_value = Response("", "TSV", "1\n")
+
+    cli.handle_query(r"\set id 42")
+    cli.handle_query(r"\set param_name 'it''s'")
+    cli.handle_query(r"\set unused 1")
+    assert cli.parameters == {"id": "42", "name": "it's", "unused": "1"}
+    assert cli.handle_query(r"\set").data == "id\t42\nname\tit's\nunused\t1\n"
+    # Formats that can't be rendered here fall back to PrettyCompact
+    cli.format = "JSONEachRow"
+    assert cli.handle_query(r"\set").format == "PrettyCompact"
+    cli.format = "TSV"
+
+    cli.handle_query("SELECT * FROM t WHERE id = {id:UInt64} AND name = { name : String }")
+    assert cli.client.query.call_args.kwargs["parameters"] == {"id": "42", "name": "it's"}
+
+    cli.handle_query(r"\unset id")
+    cli.handle_query(r"\unset id")
+    assert cli.parameters == {"name": "it's", "unused": "1"}
+    assert "The id parameter isn't set." in capsys.readouterr().out
+
+
+def test_metadata_commands_are_answered_locally():
+    cli = CLI(*[None] * 13)
+    cli.load_config()
+    cli.highlight, cli.format = False, "TSV"
+    cli.client = MagicMock(database="default")
+    cli.client.query.return_value = Response("", "TSV", "from the server\n")
+    cli.completer = CHCompleter(cli.client, {})
+    cli.completer.metadata["databases"] = ["default", "system"]
+    cli.completer.metadata["tables"] = {"default": {"visits": {"id": Col("id", "UInt64")}, "hits": {}}}
+    cli.completer.metadata_refreshed_at = time.monotonic()
+    cli.completer.request_refresh = MagicMock()
+
+    assert cli.handle_query(r"\l").data == "default\nsystem\n"
+    assert cli.handle_query(r"\d").data == cli.handle_query(r"\dt").data == "hits\nvisits\n"
+    assert cli.handle_query(r"\d+ visits").data.startswith("id\tUInt64\t")
+    cli.client.query.assert_not_called()
+
+    # A trailing ! asks the server, and refreshes the metadata
+    commands = [(r"\l!", "SHOW DATABASES"), (r"\dt!", "SHOW TABLES"), (r"\d+! visits", "DESCRIBE TABLE visits")]
+    for command, query in commands:
+        assert cli.handle_query(command).data == "from the server\n"
+        assert cli.client.query.call_args.args[0] == query
+    assert cli.completer.request_refresh.call_count == 3
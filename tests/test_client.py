@@ -0,0 +1,182 @@
+import datetime
+import io
+from unittest.mock import patch
+
+import pytest
+import requests
+
+from clickhouse_cli.clickhouse.client import Client, Response, RowCounter
+from clickhouse_cli.clickhouse.exceptions import MAX_ERROR_SIZE, DBException
+
+PRETTY = """┏━━━┓
+┃ x ┃
+┡━━━┩
+│ 1 │
+├───┤
+│ 2 │
+└───┘
+"""
+
+JSON = b"""{
+\t"meta": [{"name": "rows", "type": "UInt8"}],
+\t"data":
+\t[
+\t\t{
+\t\t\t"rows": 7
+\t\t}
+\t],
+\t"rows": 1,
+\t"statistics":
+\t{
+\t\t"elapsed": 0.001,
+\t\t"rows_read": 100,
+\t\t"bytes_read": 800
+\t}
+}
+"""
+
+
+def make_response(content, summary=None, status_code=200):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = content
+    response.encoding = "utf-8"
+    response.elapsed = datetime.timedelta(seconds=0.1)
+    if summary is not None:
+        response.headers["X-ClickHouse-Summary"] = summary
+    return response
+
+
+def count(fmt, data, chunk_size):
+    counter = RowCounter.for_format(fmt)
+    for i in range(0, len(data), chunk_size):
+        counter.feed(data[i : i + chunk_size])
+    return counter.rows
+
+
+def test_row_counter_handles_markers_split_between_chunks():
+    for chunk_size in (1, 2, 5, 1000):
+        assert count("PrettyCompact", PRETTY.encode(), chunk_size) == 2
+        assert count("TSVWithNames", b"x\n1\n2\n3\n", chunk_size) == 3
+        assert count("CSVWithNamesAndTypes", b"x\nUInt8\n1\n", chunk_size) == 1
+        assert count("JSONEachRow", b'{"x":1}\n{"x":2}\n', chunk_size) == 2
+        assert count("Vertical", b"Row 1:\n\xe2\x94\x80\nx: 1\n\nRow 2:\n\xe2\x94\x80\nx: 2\n", chunk_size) == 2
+    assert RowCounter.for_format("XML") is None
+
+
+def test_response_rows():
+    assert Response("", "TSV", make_response(b"1\n2\n")).rows == 2
+    assert Response("", "Pretty", make_response(PRETTY.encode())).rows == 2
+    assert Response("", "TSV", make_response(b"")).rows == 0
+
+    # The data of the JSON formats is left alone, the counts come from their last blocks
+    response = Response("", "JSON", make_response(JSON, '{"read_rows":"10","read_bytes":"80"}'))
+    assert response.rows == 1
+    assert response.summary == {"read_rows": 100, "read_bytes": 800}
+
+    # Otherwise, from the summary header
+    assert Response("", "XML", make_response(b"<xml/>", '{"result_rows":"5"}')).rows == 5
+
+
+def test_streamed_response_counts_rows_as_it_goes():
+    content = b"x\n" + b"".join(b"%d\n" % i for i in range(100000))
+    raw = make_response(False)
+    raw.raw = io.BytesIO(content)
+    response = Response("", "TSVWithNames", raw, stream=True)
+    assert response.rows is None
+
+    lines = list(response.data)
+    assert len(lines) == 100001 and lines[-1] == b"99999"
+    assert response.rows == 100000
+
+
+def test_db_exception():
+    text = "Code: 60. DB::Exception: Table default.x does not exist. (UNKNOWN_TABLE) (version 23.3.1.1)\n"
+    response = make_response(b"", status_code=404)
+    response.headers["X-ClickHouse-Exception-Code"] = "60"
+    e = DBException(response, "SELECT 1", text=text)
+    assert (e.error_code, e.error, e.stacktrace) == ("60", text.strip(), "")
+
+    text = (
+        "Code: 62. DB::Exception: Syntax error. (SYNTAX_ERROR), Stack trace (when copying this message, "
+        "always include the lines below):\n\n0. DB::Exception::Exception() @ 0x1\n (version 23.3.1.1)\n"
+    )
+    e = DBException(make_response(b""), "SELEC 1", text=text)
+    assert (e.error_code, e.error) == ("62", "Code: 62. DB::Exception: Syntax error. (SYNTAX_ERROR)")
+    assert e.stacktrace.startswith("0. DB::Exception::Exception()")
+
+    # Older servers
+    text = "Code: 60, e.displayText() = DB::Exception: Table x doesn't exist., e.what() = DB::Exception\n"
+    e = DBException(make_response(text.encode()), "SELECT 1")
+    assert (e.error_code, e.error) == ("60", "Table x doesn't exist.")
+
+
+def streamed(content):
+    response = make_response(False)
+    response.raw = io.BytesIO(content)
+    return Response("SELECT number FROM numbers(1000000)", "TSV", response, stream=True)
+
+
+def test_exception_in_the_middle_of_a_streamed_result():
+    output = b"".join(b"%d\n" % i for i in range(100000))
+    exception = b"Code: 241. DB::Exception: Memory limit exceeded. (MEMORY_LIMIT_EXCEEDED) (version 23.3.1.1)\n"
+    response = streamed(output + exception)
+
+    lines = []
+    with pytest.raises(DBException) as e:
+        for line in response.data:
+            lines.append(line)
+    assert len(lines) == 100000
+    assert e.value.error_code == "241" and "MEMORY_LIMIT_EXCEEDED" in e.value.error
+
+    # Results that merely mention exceptions are data
+    output = b"Code: 60. DB::Exception: Table x does not exist.\t1\n" + output
+    assert len(list(streamed(output).data)) == 100001
+
+
+def test_exceptions_in_query_log_rows_are_data():
+    client = Client(url="http://localhost:8123/", user="default", password="", database="default", cookie=None)
+    rows = [
+        b"q1\tCode: 60. DB::Exception: Table default.x does not exist. (UNKNOWN_TABLE) (version 23.3.1.1)\n",
+        b"Code: 60. DB::Exception: Table default.x does not exist. (UNKNOWN_TABLE) (version 23.3.1.1)\n" * 2,
+    ]
+    for content in rows:
+        with patch("requests.Session.request", return_value=make_response(content)):
+            assert client.query("SELECT exception FROM system.query_log", fmt="TSV").data == content.decode()
+        assert b"".join(line + b"\n" for line in streamed(content).data) == content
+
+    # Unless the server tells about a failure
+    response = make_response(False)
+    response.raw = io.BytesIO(rows[1])
+    response.headers["X-ClickHouse-Exception-Code"] = "60"
+    with patch("requests.Session.request", return_value=response), pytest.raises(DBException):
+        client.query("SELECT 1", fmt="TSV")
+
+
+def test_error_bodies_are_read_up_to_a_bounded_tail():
+    client = Client(url="http://localhost:8123/", user="default", password="", database="default", cookie=None)
+    response = make_response(False, status_code=500)
+    response.raw = io.BytesIO(b"x" * 1000000 + b"\nCode: 1. DB::Exception: Unsupported. (UNSUPPORTED_METHOD)\n")
+    response.headers["X-ClickHouse-Exception-Code"] = "1"
+
+    with patch("requests.Session.request", return_value=response), pytest.raises(DBException) as e:
+        client.query("SELECT 1", fmt="TSV")
+    assert len(e.value.text) < MAX_ERROR_SIZE
+    assert (e.value.error_code, e.value.error) == ("1", "Code: 1. DB::Exception: Unsupported. (UNSUPPORTED_METHOD)")
+
+
+def test_query_parameters_are_sent_as_url_parameters():
+    client = Client(url="http://localhost:8123/", user="default", password="", database="default", cookie=None)
+    with patch("requests.Session.request", return_value=make_response(b"1\n")) as request:
+        client.query("SELECT * FROM t WHERE id = {id:UInt64}", fmt="TSV", parameters={"id": "42"})
+    assert request.call_args.kwargs["params"]["param_id"] == "42"
+    # The text stays the same, whatever the values
+    assert request.call_args.kwargs["data"].read() == b"SELECT * FROM t WHERE id = {id:UInt64} FORMAT TSV\n"
+
+
+def test_inserts_never_get_a_format():
+    client = Client(url="http://localhost:8123/", user="default", password="", database="default", cookie=None)
+    for query in ("-- load\nINSERT INTO t VALUES (1)", "/* load */ INSERT INTO t VALUES (1)", "INSERT INTO t SELECT 1"):
+        with patch("requests.Session.request", return_value=make_response(b"")) as request:
+            client.query(query)
+        assert request.call_args.kwargs["data"].read() == query.encode() + b"\n"
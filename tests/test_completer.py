@@ -0,0 +1,217 @@
+import threading
+import time
+from unittest.mock import MagicMock
+
+from prompt_toolkit.document import Document
+
+from clickhouse_cli.clickhouse.catalogue import Catalogue
+from clickhouse_cli.clickhouse.definitions import DESCRIBE_COLUMNS
+from clickhouse_cli.ui.completer import CHCompleter, RefreshWorker
+from clickhouse_cli.ui.completer import Col as SchemaCol
+from clickhouse_cli.ui.render import render
+from clickhouse_cli.ui.schema_index import ColumnIndex
+
+
+def test_refresh_worker_merges_pending_requests():
+    """requests made during a refresh collapse into a single follow-up run"""
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def target():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+
+    worker = RefreshWorker(target)
+    worker.request()
+    assert started.wait(5)
+
+    for _ in range(10):
+        worker.request()
+
+    release.set()
+    assert worker.wait(5)
+    assert len(calls) == 2
+
+
+def test_refresh_worker_survives_exceptions():
+    calls = []
+
+    def target():
+        calls.append(1)
+        raise RuntimeError("boom")
+
+    worker = RefreshWorker(target)
+    worker.request()
+    assert worker.wait(5)
+    worker.request()
+    assert worker.wait(5)
+    assert len(calls) == 2
+
+
+def test_completer_uses_its_own_session():
+    client = MagicMock()
+    client.query.return_value.data = "default\nsystem\n"
+
+    completer = CHCompleter(client, {})
+    assert completer.get_databases() == ["default", "system"]
+    assert client.query.call_args.kwargs["session_id"] == completer.session_id
+
+
+def fake_select(query, flatten=False):
+    return {
+        "SELECT name, is_aggregate, case_insensitive FROM system.functions": [
+            ["myUdf", "0", "0"],
+            ["uniqTheta", "1", "0"],
+            ["count", "1", "1"],
+        ],
+        "SELECT name FROM system.settings": [["max_threads"], ["max_memory_usage"]],
+        "SELECT name FROM system.formats": [["Npy"]],
+    }.get(query, [])
+
+
+def test_catalogue_fetch_keeps_static_fallbacks():
+    catalogue = Catalogue.fetch(fake_select)
+    assert catalogue.source == "server"
+    assert catalogue.functions == ("myUdf",)
+    assert catalogue.aggregate_functions == ("count", "uniqTheta")
+    assert catalogue.case_insensitive_functions == ("COUNT",)
+    assert catalogue.settings == ("max_memory_usage", "max_threads")
+    assert catalogue.formats == ("Npy",)
+    # system.data_type_families returned nothing, so the static list stays
+    assert "UInt8" in catalogue.datatypes
+
+
+def test_catalogue_cache_roundtrip(tmp_path, monkeypatch):
+    monkeypatch.setattr("clickhouse_cli.config.USER_CACHE_DIR", str(tmp_path))
+    assert Catalogue.load((23, 8, "1")) is None
+
+    Catalogue.fetch(fake_select).save((23, 8, "1"))
+    catalogue = Catalogue.load((23, 8, "1"))
+    assert catalogue.source == "cache"
+    assert catalogue.functions == ("myUdf",)
+    assert Catalogue.load((24, 1, "1")) is None
+
+
+def test_completer_suggests_server_settings_and_functions(tmp_path, monkeypatch):
+    monkeypatch.setattr("clickhouse_cli.config.USER_CACHE_DIR", str(tmp_path))
+    client = MagicMock()
+    client.query.return_value.data = ""
+    completer = CHCompleter(client, {}, server_version=(23, 8, "1"))
+    completer._select = fake_select
+    completer.refresh_catalogue()
+
+    text = "SET max_t"
+    completions = completer.get_completions(Document(text, len(text)), None)
+    assert [c.text for c in completions] == ["max_threads"]
+
+    text = "SELECT myU"
+    completions = completer.get_completions(Document(text, len(text)), None)
+    assert "myUdf" in [c.text for c in completions]
+    assert Catalogue.load((23, 8, "1")).functions == ("myUdf",)
+
+
+class Col(object):
+    def __init__(self, name, datatype):
+        self.name = name
+        self.datatype = datatype
+
+
+def test_column_value_completion_is_served_from_cache():
+    # After `USE shop`
+    completer = CHCompleter(MagicMock(database="shop"), {})
+    completer.metadata["tables"] = {
+        "shop": {
+            "visits": {
+                "status": Col("status", "LowCardinality(String)"),
+                "kind": Col("kind", "Enum8('click' = 1, 'view' = 2)"),
+                "payload": Col("payload", "String"),
+                "country": Col("country", "LowCardinality(String)"),
+            }
+        }
+    }
+
+    queries = []
+
+    def select(query, flatten=True):
+        queries.append(query)
+        return ["active", "archived", "deleted"]
+
+    completer._select = select
+
+    def complete(text):
+        return [c.text for c in completer.get_completions(Document(text, len(text)), None)]
+
+    # The keystroke only schedules the fetch, the values show up once it's done
+    assert complete("SELECT * FROM visits WHERE status = 'a") == []
+    for _ in range(500):
+        completions = complete("SELECT * FROM visits WHERE status = 'a")
+        if completions:
+            break
+        time.sleep(0.01)
+    assert completions == ["active'", "archived'"]
+    assert len(queries) == 1
+    assert "FROM shop.visits LIMIT 1000000" in queries[0]
+    assert "LIMIT 100 SETTINGS max_execution_time = 1" in queries[0]
+
+    # Enum values come from the type itself, plain strings are never sampled
+    assert completer.fetch_column_values(("shop", "visits", "kind", "Enum8('click' = 1, 'view' = 2)")) == [
+        "click",
+        "view",
+    ]
+    assert complete("SELECT * FROM visits WHERE payload = '") == []
+    assert len(queries) == 1
+
+    # Suggesting the columns of a table warms up their values
+    complete("SELECT * FROM visits WHERE ")
+    for _ in range(500):
+        if len(queries) == 2:
+            break
+        time.sleep(0.01)
+    assert "SELECT country AS value FROM shop.visits" in queries[1]
+
+
+def test_column_index_find():
+    tables = {
+        "default": {"visits": {"user_id": SchemaCol("user_id", "UInt64"), "url": SchemaCol("url", "String")}},
+        "archive": {"users": {"user_id": SchemaCol("user_id", "String")}},
+    }
+    index = ColumnIndex.build(tables)
+
+    assert index.find("USER_ID") == [
+        ("archive", "users", "user_id", "String"),
+        ("default", "visits", "user_id", "UInt64"),
+    ]
+    assert index.find("user_*", "UInt*") == [("default", "visits", "user_id", "UInt64")]
+    assert index.find("/^u.l$/") == [("default", "visits", "url", "String")]
+    assert index.find("missing") == []
+
+
+def test_describe_table_from_metadata():
+    completer = CHCompleter(MagicMock(), {})
+    completer.metadata["tables"] = {
+        "default": {"visits": {"id": SchemaCol("id", "UInt64", "DEFAULT", "0", "", "CODEC(Delta, ZSTD(1))")}}
+    }
+    assert completer.describe_table("visits", "default") == [["id", "UInt64", "DEFAULT", "0", "", "Delta, ZSTD(1)", ""]]
+    assert completer.describe_table("visits", "system") is None
+
+    text = render(DESCRIBE_COLUMNS[:2], [["id", "UInt64"]], "PrettyCompact")
+    assert text == "┌─name─┬─type───┐\n│ id   │ UInt64 │\n└──────┴────────┘\n"
+    assert render(("a", "b"), [["x\ty", "1"]], "TSVWithNames") == "a\tb\nx\\ty\t1\n"
+    assert render(("a", "b"), [["x", "1"], [None, "2"]], "Markdown", right_aligned=[1]) == (
+        "| a | b |\n|:-|-:|\n| x | 1 |\n| ᴺᵁᴸᴸ | 2 |\n"
+    )
+    assert render(("n",), [["1"], ["2"]], "Pretty", right_aligned=[0]) == (
+        "┏━━━┓\n┃ n ┃\n┡━━━┩\n│ 1 │\n├───┤\n│ 2 │\n└───┘\n"
+    )
+
+
+def test_list_tables_from_metadata():
+    completer = CHCompleter(MagicMock(), {})
+    completer.metadata["databases"] = ["default", "empty"]
+    completer.metadata["tables"] = {"default": {"visits": {}, "hits": {}}}
+
+    assert completer.list_tables("default") == ["hits", "visits"]
+    assert completer.list_tables("empty") == []
+    assert completer.list_tables("missing") is None
@@ -0,0 +1,113 @@
+import io
+import threading
+import time
+from unittest.mock import MagicMock
+
+from clickhouse_cli.cli import CLI
+from clickhouse_cli.clickhouse.dependencies import DependencyGraph, statement_access
+from clickhouse_cli.clickhouse.sessions import SessionPool
+
+
+def test_statement_access():
+    access = statement_access("INSERT INTO a SELECT * FROM b JOIN db.c USING x WHERE y IN (SELECT z FROM d)", "default")
+    assert access.writes == {("default", "a")}
+    assert access.reads == {("default", "b"), ("db", "c"), ("default", "d")}
+    assert not access.barrier
+
+    assert statement_access("CREATE TABLE IF NOT EXISTS `x` (a UInt8) ENGINE = Memory", "db").writes == {("db", "x")}
+    assert statement_access("RENAME TABLE a TO b", "db").writes == {("db", "a"), ("db", "b")}
+    assert statement_access("INSERT INTO t VALUES (1, 'FROM x')", "db") == (set(), {("db", "t")}, False)
+    assert statement_access("SELECT CAST(x AS Nullable(String)) FROM numbers(10)", "db").reads == set()
+
+    # Whatever can't be analyzed runs alone
+    assert statement_access("SET max_threads = 1", "db").barrier
+    assert statement_access("CREATE DATABASE x", "db").barrier
+    for statement in ("DROP DATABASE x", "DROP DATABASE IF EXISTS x", "DETACH DATABASE x", "DROP USER bob"):
+        assert statement_access(statement, "db").barrier, statement
+    assert statement_access("TRUNCATE ALL TABLES FROM x", "db").barrier
+    assert statement_access("DROP TABLE IF EXISTS x", "db").writes == {("db", "x")}
+    assert statement_access("TRUNCATE x", "db").writes == {("db", "x")}
+    assert statement_access("SELECT * FROM url('http://x/', CSV)", "db").barrier
+    assert statement_access("SELECT dictGet('d', 'a', 1)", "db").barrier
+
+
+def test_dependency_graph():
+    graph = DependencyGraph("default")
+    assert graph.add("CREATE TABLE a (x UInt8) ENGINE = Memory") == (set(), False)
+    assert graph.add("CREATE TABLE b (x UInt8) ENGINE = Memory") == (set(), False)
+    assert graph.add("INSERT INTO a SELECT 1") == ({0}, False)
+    assert graph.add("SELECT * FROM a") == ({2}, False)
+    assert graph.add("SELECT count() FROM a") == ({2}, False)
+    # A writer waits for the readers before it
+    assert graph.add("OPTIMIZE TABLE a FINAL") == ({2, 3, 4}, False)
+    assert graph.add("INSERT INTO b SELECT 1") == ({1}, False)
+
+    # An INSERT into the source of a materialized view writes its target too
+    assert graph.add("CREATE MATERIALIZED VIEW mv TO b AS SELECT * FROM a") == ({5, 6}, False)
+    assert graph.add("SELECT * FROM b") == ({7}, False)
+    assert graph.add("INSERT INTO a SELECT 2") == ({5, 7, 8}, False)
+
+    deps, barrier = graph.add("USE other")
+    assert barrier and deps == set(range(10))
+    assert graph.add("SELECT * FROM a") == ({10}, False)
+    assert graph.database == "other"
+
+
+SCRIPT = b"""
+CREATE TABLE a (x UInt8) ENGINE = Memory;
+CREATE TABLE b (x UInt8) ENGINE = Memory;
+INSERT INTO a SELECT 1;
+INSERT INTO b SELECT 1;
+SET max_threads = 1;
+SELECT * FROM a;
+SELECT * FROM b;
+"""
+
+
+def test_run_script_parallel_keeps_dependencies_in_order():
+    cli = CLI(*[None] * 13, parallel=4)
+    cli.client = MagicMock(database="default")
+    cli.sessions = SessionPool(cli.client, ["SET send_progress_in_http_headers = 1"])
+    lock = threading.Lock()
+    events = []
+
+    def handle_query(statement, session_id=None, **kwargs):
+        with lock:
+            events.append(("start", statement, session_id))
+        time.sleep(0.05)
+        with lock:
+            events.append(("end", statement, session_id))
+
+    cli.handle_query = MagicMock(side_effect=handle_query)
+    assert cli.run_script_parallel(io.BytesIO(SCRIPT)) is True
+
+    def position(kind, statement):
+        return next(i for i, event in enumerate(events) if event[:2] == (kind, statement))
+
+    # Independent statements overlap...
+    assert position("start", "CREATE TABLE b (x UInt8) ENGINE = Memory") < position(
+        "end", "CREATE TABLE a (x UInt8) ENGINE = Memory"
+    )
+    # ...dependent ones don't
+    assert position("end", "CREATE TABLE a (x UInt8) ENGINE = Memory") < position("start", "INSERT INTO a SELECT 1")
+    # SET runs alone on the main session
+    assert position("start", "SET max_threads = 1") > max(
+        position("end", "INSERT INTO a SELECT 1"), position("end", "INSERT INTO b SELECT 1")
+    )
+    assert [event[2] for event in events if event[1] == "SET max_threads = 1"] == [None, None]
+    assert position("start", "SELECT * FROM a") > position("end", "SET max_threads = 1")
+    # Concurrent statements never share a session, and every session gets the settings of the main one
+    sessions = {event[2] for event in events if event[0] == "start" and event[1] != "SET max_threads = 1"}
+    assert None not in sessions and len(sessions) > 1
+    assert cli.client.query.call_count == len(sessions)
+
+
+def test_run_script_parallel_stops_on_error():
+    cli = CLI(*[None] * 13, stop_on_error=True, parallel=2)
+    cli.client = MagicMock(database="default")
+    cli.sessions = SessionPool(cli.client)
+    cli.handle_query = MagicMock(side_effect=lambda statement, **kwargs: False if "INSERT" in statement else None)
+    assert cli.run_script_parallel(io.BytesIO(SCRIPT)) is False
+    executed = [call.args[0] for call in cli.handle_query.call_args_list]
+    assert "SET max_threads = 1" not in executed
+    assert cli.script_failures >= 1
@@ -0,0 +1,36 @@
+from clickhouse_cli.ui.history import SQLiteHistory
+
+
+def test_history_store_search_and_load(tmp_path):
+    history = SQLiteHistory(str(tmp_path / "history.sqlite"), server="default@localhost:8123", size=2)
+    history.store_string("SELECT 1")
+    history.store_string("SELECT count()\nFROM visits")
+    history.record_result(duration=0.5, rows=1)
+    history.store_string("SHOW TABLES")
+
+    # Only the latest `size` entries are loaded for the prompt, newest first
+    assert list(history.load_history_strings()) == ["SHOW TABLES", "SELECT count()\nFROM visits"]
+
+    created_at, server, duration, rows, query = history.search("visits")[0]
+    assert (server, duration, rows, query) == ("default@localhost:8123", 0.5, 1, "SELECT count()\nFROM visits")
+    assert [row[4] for row in history.search()] == ["SHOW TABLES", "SELECT count()\nFROM visits", "SELECT 1"]
+    assert history.search('"unbalanced') == []
+
+
+def test_history_like_fallback(tmp_path):
+    history = SQLiteHistory(str(tmp_path / "history.sqlite"))
+    history.has_fts = False
+    history.store_string("SELECT 100%")
+    history.store_string("SELECT 1")
+    assert [row[4] for row in history.search("0%")] == ["SELECT 100%"]
+
+
+def test_history_imports_flat_file_once(tmp_path):
+    flat = tmp_path / "history"
+    flat.write_text("\n# 2023-01-02 03:04:05.678901\n+SELECT 1\n\n# 2023-01-03 00:00:00\n+SELECT\n+    2\n")
+
+    history = SQLiteHistory(str(tmp_path / "history.sqlite"))
+    assert history.import_file(str(flat)) == 2
+    assert history.import_file(str(flat)) == 0
+    assert list(history.load_history_strings()) == ["SELECT\n    2", "SELECT 1"]
+    assert history.search("2")[0][0] > history.search("1")[0][0]
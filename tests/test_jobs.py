@@ -0,0 +1,86 @@
+import threading
+from unittest.mock import MagicMock
+
+from clickhouse_cli.cli import CLI
+from clickhouse_cli.clickhouse.sessions import SessionPool
+from clickhouse_cli.jobs import JobManager
+
+PROGRESS = b'X-ClickHouse-Progress: {"read_rows":"10","read_bytes":"100","total_rows_to_read":"20"}'
+
+
+def make_cli():
+    cli = CLI(*[None] * 13)
+    cli.load_config()
+    cli.client = MagicMock(database="default")
+    cli.sessions = SessionPool(cli.client, ["SET max_threads = 1"])
+    cli.completer = MagicMock()
+    return cli
+
+
+def test_job_manager():
+    jobs = JobManager()
+    first = jobs.start("SELECT 1", "id-1", lambda job: jobs.current())
+    second = jobs.start("SELECT 2", "id-2", lambda job: 1 / 0)
+    first.done.wait(1)
+    second.done.wait(1)
+
+    assert first.result() is first and first.status == "Done"
+    assert second.status == "Failed"
+    assert jobs.current() is None
+    assert jobs.get() is second and jobs.get(1) is first
+    assert jobs.collect_finished() == [first, second]
+    assert jobs.collect_finished() == []
+
+
+def test_background_query(capsys):
+    cli = make_cli()
+    release = threading.Event()
+    response = MagicMock(data="42\n", message="", rows=1, time_elapsed=0.1, origin=None, format="TabSeparated")
+    response.sent_bytes, response.summary = None, {}
+
+    def query(statement, session_id=None, **kwargs):
+        assert session_id != cli.client.session_id
+        if statement.startswith("SET"):
+            return None
+        # Progress headers of a job's request are routed to the job
+        cli.progress_update(PROGRESS)
+        release.wait(5)
+        return response
+
+    cli.client.query = MagicMock(side_effect=query)
+    cli.handle_input("SELECT sleep(3) &")
+    job = cli.jobs.get(1)
+    assert job.query == "SELECT sleep(3)"
+    assert job.status == "Running"
+    assert cli.progress_bar.latest is None
+
+    cli.handle_query(r"\jobs")
+    while job.progress is None:
+        job.done.wait(0.01)
+    listing = cli.list_jobs().data
+    assert "Running" in listing and "10.0 rows, 100.0B (50%)" in listing
+
+    release.set()
+    assert cli.handle_query(r"\fg 1") is response
+    assert "42" in capsys.readouterr().out
+    assert cli.jobs.get(1) is None
+    # The leased session got the settings of the main one first
+    assert cli.client.query.call_args_list[0].args == ("SET max_threads = 1",)
+
+
+def test_kill_background_query():
+    cli = make_cli()
+    release = threading.Event()
+    cli.client.query = MagicMock(side_effect=lambda *args, **kwargs: release.wait(5))
+    cli.handle_input("SELECT sleep(3)\n\\bg")
+
+    job = cli.jobs.get()
+    cli.handle_query(r"\kill %1")
+    cli.client.cancel.assert_called_once_with([job.query_id])
+    release.set()
+    job.done.wait(1)
+    assert job.status == "Killed"
+
+    # Only queries run in the background
+    cli.handle_input(r"\d &")
+    assert cli.jobs.get() is job
@@ -0,0 +1,45 @@
+from prompt_toolkit.document import Document
+from prompt_toolkit.lexers import PygmentsLexer
+
+from clickhouse_cli.ui.lexer import CHKeywordLexer, CHLexer, IncrementalLexer
+
+
+def lex(lexer, text):
+    document = Document(text)
+    get_line = lexer.lex_document(document)
+    lines = []
+    for lineno in range(len(document.lines)):
+        line = []
+        for style, value in get_line(lineno):
+            if line and line[-1][0] == style:
+                line[-1] = (style, line[-1][1] + value)
+            elif value:
+                line.append((style, value))
+        lines.append(line)
+    return lines
+
+
+def test_incremental_lexer_matches_full_lexing():
+    lexer = IncrementalLexer(CHLexer)
+    text = "SELECT count(*)\nFROM visits\nWHERE url = 'a'\n  AND id IN (1, 2)\n"
+    edits = [
+        # typing in the middle, opening and closing a string and a comment
+        text.replace("visits", "visits_all"),
+        text.replace("url = 'a'", "url = 'a"),
+        text.replace("FROM", "/* FROM"),
+        text.replace("FROM", "/* FROM").replace("(1, 2)", "(1, 2) */"),
+        # a backtick that only becomes an identifier once it's closed far below
+        "SELECT `x\nFROM t\nWHERE 1\n",
+        "SELECT `x\nFROM t\nWHERE 1`\n",
+        "",
+    ]
+
+    for text in [text] + edits:
+        assert lex(lexer, text) == lex(PygmentsLexer(CHLexer), text)
+
+
+def test_incremental_lexer_falls_back_to_keywords():
+    lexer = IncrementalLexer(CHLexer, max_size=20)
+    text = "SELECT count(*) FROM visits"
+    assert lex(lexer, text) == lex(PygmentsLexer(CHKeywordLexer), text)
+    assert lex(lexer, text[:10]) == lex(PygmentsLexer(CHLexer), text[:10])
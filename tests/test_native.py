@@ -0,0 +1,196 @@
+import array
+import datetime
+import decimal
+import io
+import struct
+import uuid
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+
+from clickhouse_cli.clickhouse import native
+from clickhouse_cli.clickhouse.client import Client
+from clickhouse_cli.clickhouse.exceptions import DBException, NativeFormatError
+
+
+def varint(value):
+    result = b""
+    while value >= 0x80:
+        result += bytes([value & 0x7F | 0x80])
+        value >>= 7
+    return result + bytes([value])
+
+
+def string(value):
+    value = value.encode() if isinstance(value, str) else value
+    return varint(len(value)) + value
+
+
+def block(rows, *columns):
+    data = varint(len(columns)) + varint(rows)
+    for name, type_name, column in columns:
+        data += string(name) + string(type_name) + column
+    return data
+
+
+def uint64(*values):
+    return struct.pack("<%dQ" % len(values), *values)
+
+
+FIRST = block(
+    2,
+    ("id", "UInt32", struct.pack("<2I", 1, 2)),
+    ("name", "String", string("one") + string("two")),
+    ("score", "Nullable(Int8)", b"\x00\x01" + struct.pack("<2b", -5, 0)),
+    ("tags", "Array(UInt16)", uint64(2, 3) + struct.pack("<3H", 10, 20, 30)),
+    (
+        "city",
+        "LowCardinality(Nullable(String))",
+        # Version; then a granule with additional keys and UInt8 indexes
+        uint64(1) + uint64(1 << 9) + uint64(2) + string("") + string("Paris") + uint64(2) + b"\x01\x00",
+    ),
+    ("attrs", "Map(String, UInt8)", uint64(1, 1) + string("k") + b"\x07"),
+    ("pair", "Tuple(a UInt8, b String)", b"\x01\x02" + string("x") + string("y")),
+    ("at", "DateTime('UTC')", struct.pack("<2I", 0, 86400)),
+    ("price", "Decimal(10, 2)", struct.pack("<2q", 1234, -5)),
+    ("kind", "Enum8('a' = 1, 'it\\'s' = 2)", b"\x01\x02"),
+    ("id2", "UUID", struct.pack("<QQ", 1, 2) * 2),
+)
+SECOND = block(
+    1,
+    ("id", "UInt32", struct.pack("<I", 3)),
+    ("name", "String", string("three")),
+    ("score", "Nullable(Int8)", b"\x00" + struct.pack("<b", 9)),
+    ("tags", "Array(UInt16)", uint64(0)),
+    (
+        "city",
+        "LowCardinality(Nullable(String))",
+        uint64(1) + uint64(1 << 9) + uint64(1) + string("") + uint64(1) + b"\x00",
+    ),
+    ("attrs", "Map(String, UInt8)", uint64(0)),
+    ("pair", "Tuple(a UInt8, b String)", b"\x03" + string("z")),
+    ("at", "DateTime('UTC')", struct.pack("<I", 60)),
+    ("price", "Decimal(10, 2)", struct.pack("<q", 0)),
+    ("kind", "Enum8('a' = 1, 'it\\'s' = 2)", b"\x01"),
+    ("id2", "UUID", struct.pack("<QQ", 0, 0)),
+)
+
+
+@patch.object(native, "numpy", None)
+def test_decode_without_numpy():
+    columns = native.decode(FIRST + SECOND)
+    assert list(columns) == ["id", "name", "score", "tags", "city", "attrs", "pair", "at", "price", "kind", "id2"]
+
+    assert columns["id"] == array.array("I", [1, 2, 3])
+    assert columns["name"] == ["one", "two", "three"]
+    assert columns["score"] == [-5, None, 9]
+    assert columns["tags"] == [array.array("H", [10, 20]), array.array("H", [30]), array.array("H")]
+    assert columns["city"] == ["Paris", None, None]
+    assert columns["attrs"] == [{"k": 7}, {}, {}]
+    assert columns["pair"] == [(1, "x"), (2, "y"), (3, "z")]
+    epoch = datetime.datetime(1970, 1, 1)
+    assert columns["at"] == [epoch, epoch + datetime.timedelta(days=1), epoch + datetime.timedelta(minutes=1)]
+    assert columns["price"] == [decimal.Decimal("12.34"), decimal.Decimal("-0.05"), decimal.Decimal(0)]
+    assert columns["kind"] == ["a", "it's", "a"]
+    assert columns["id2"][0] == uuid.UUID(int=1 << 64 | 2)
+
+
+@patch.object(native, "numpy", None)
+def test_decode_wide_decimals():
+    value = 10**75 + 1
+    column = value.to_bytes(32, "little", signed=True) + (-value).to_bytes(32, "little", signed=True)
+    columns = native.decode(block(2, ("x", "Decimal256(2)", column), ("y", "Decimal(76, 2)", column)))
+    expected = [decimal.Decimal("1" + "0" * 73 + ".01"), decimal.Decimal("-1" + "0" * 73 + ".01")]
+    assert columns["x"] == columns["y"] == expected
+
+
+@patch.object(native, "numpy", None)
+def test_decode_empty_and_broken_results():
+    assert native.decode(b"") == {}
+    # Blocks without rows carry no column data
+    assert native.decode(block(0, ("x", "Float64", b""), ("s", "String", b""))) == {"x": array.array("d"), "s": []}
+
+    with pytest.raises(NativeFormatError):
+        native.decode(FIRST[:-3])
+    with pytest.raises(NativeFormatError):
+        native.decode(block(1, ("x", "Object('json')", b"{}")))
+
+
+def test_decode_with_numpy():
+    numpy = pytest.importorskip("numpy")
+    columns = native.decode(FIRST + SECOND)
+    assert columns["id"].dtype == numpy.uint32 and columns["id"].tolist() == [1, 2, 3]
+    assert columns["at"].dtype == numpy.dtype("datetime64[s]")
+
+
+def test_parse_type():
+    assert native.parse_type("Map(String, Array(Tuple(a UInt8, b Decimal(10, 2))))") == (
+        "Map",
+        ["String", "Array(Tuple(a UInt8, b Decimal(10, 2)))"],
+    )
+    assert native.parse_type("Enum8('a,b' = 1, 'c)' = 2)") == ("Enum8", ["'a,b' = 1", "'c)' = 2"])
+    assert native.element_types(["a UInt8", "Decimal(10, 2)", "`x y` String"]) == ["UInt8", "Decimal(10, 2)", "String"]
+
+
+@patch.object(native, "numpy", None)
+def test_query_columns():
+    client = Client(url="http://localhost:8123/", user="default", password="", database="default", cookie=None)
+    client.query = MagicMock(return_value=MagicMock(format="Native", data=SECOND))
+    assert client.query_columns("SELECT 1")["name"] == ["three"]
+    assert client.query.call_args.kwargs["fmt"] == "Native"
+
+
+@patch.object(native, "numpy", None)
+def test_iter_blocks_decodes_blocks_split_into_chunks():
+    data = FIRST + SECOND
+    for size in (1, 7, 1000):
+        chunks = (data[i : i + size] for i in range(0, len(data), size))
+        blocks = list(native.iter_blocks(chunks))
+        assert [len(block[0][2]) for block in blocks] == [2, 1]
+        assert blocks[1][1] == ("name", "String", ["three"])
+
+    with pytest.raises(native.Truncated):
+        list(native.iter_blocks([FIRST[:-1]]))
+
+    exception = b"Code: 241. DB::Exception: Memory limit exceeded. (MEMORY_LIMIT_EXCEEDED)\n"
+    blocks = native.iter_blocks([FIRST, exception[:10], exception[10:]])
+    assert len(next(blocks)) == 11
+    with pytest.raises(native.EmbeddedException) as e:
+        next(blocks)
+    assert e.value.text == exception.decode()
+
+
+def make_client(content):
+    client = Client(url="http://localhost:8123/", user="default", password="", database="default", cookie=None)
+    response = requests.Response()
+    response.status_code = 200
+    response.raw = io.BytesIO(content)
+    response.elapsed = datetime.timedelta()
+    client.session.request = MagicMock(return_value=response)
+    client.cancel = MagicMock()
+    return client
+
+
+@patch.object(native, "numpy", None)
+def test_iter_rows():
+    client = make_client(FIRST + SECOND)
+    batches = list(client.iter_rows("SELECT * FROM t", batch_size=2))
+    assert [len(batch) for batch in batches] == [2, 1]
+    assert batches[0][1][:3] == (2, "two", None)
+    assert "FORMAT Native" in client.session.request.call_args.kwargs["data"].read().decode()
+    client.cancel.assert_not_called()
+    assert client.active == {}
+
+    # Leaving early cancels the query
+    client = make_client(FIRST + SECOND)
+    for batch in client.iter_rows("SELECT * FROM t", batch_size=1, query_id="q1"):
+        break
+    client.cancel.assert_called_once_with(["q1"])
+
+    client = make_client(FIRST + b"Code: 241. DB::Exception: Memory limit exceeded.\n")
+    rows = client.iter_rows("SELECT * FROM t")
+    assert len(next(rows)) == 2
+    with pytest.raises(DBException) as e:
+        next(rows)
+    assert e.value.error_code == "241"
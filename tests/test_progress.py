@@ -0,0 +1,79 @@
+import time
+
+from clickhouse_cli.ui.progress import ProgressBar, format_duration, parse_progress
+
+
+def test_parse_progress():
+    progress = parse_progress(
+        b'X-ClickHouse-Progress: {"read_rows":"250","read_bytes":"4096","written_rows":"0",'
+        b'"total_rows_to_read":"1000","result_rows":"0"}\r\n'
+    )
+    assert (progress["read_rows"], progress["read_bytes"], progress["total_rows"]) == (250, 4096, 1000)
+    assert progress["percents"] == 25
+
+    # Older servers
+    progress = parse_progress(b'X-ClickHouse-Progress: {"read_rows":"1","read_bytes":"2","total_rows":"0"}')
+    assert (progress["read_rows"], progress["total_rows"], progress["percents"]) == (1, 0, 0)
+
+
+def test_format_duration():
+    assert format_duration(5.7) == "0:05"
+    assert format_duration(605) == "10:05"
+    assert format_duration(3 * 3600 + 61) == "3:01:01"
+
+
+def sample(timestamp, read_rows, total_rows=1000):
+    return {
+        "timestamp": timestamp,
+        "read_rows": read_rows,
+        "read_bytes": read_rows * 10,
+        "total_rows": total_rows,
+        "percents": read_rows * 100 // total_rows,
+    }
+
+
+def test_progress_bar_coalesces_updates():
+    frames = []
+    bar = ProgressBar(lambda message, percents: frames.append((message, percents)), interval=0.05)
+    for i in range(10000):
+        bar.update(sample(time.monotonic(), i // 100))
+    time.sleep(0.2)
+
+    progress, drawn = bar.stop()
+    assert drawn and progress["read_rows"] == 99
+    assert 1 <= len(frames) <= 5
+    assert frames[-1][1] == 9
+
+    # Stopped for good, and the next query starts over
+    frames.clear()
+    time.sleep(0.1)
+    assert frames == [] and bar.stop() == (None, False)
+
+
+def test_progress_bar_rates_and_eta():
+    bar = ProgressBar(None, tau=1.0)
+    bar.add_sample(sample(0.0, 0))
+    assert bar.format(sample(0.0, 0)) == "Progress: 0 rows, 0.0B"
+
+    bar.add_sample(sample(1.0, 100))
+    assert bar.rows_rate == 100
+    assert bar.format(sample(1.0, 100)) == "Progress: 100.0 rows, 1000.0B (100.0 rows/s, 1000.0B/s) ETA 0:09"
+
+    # A burst moves the smoothed rate only part of the way
+    bar.add_sample(sample(1.1, 200))
+    assert 100 < bar.rows_rate < 1000
+
+
+def test_progress_bar_upload():
+    bar = ProgressBar(None, tau=1.0)
+    bar.add_upload_sample((0.0, 0, 4096))
+    assert bar.format_upload((0.0, 0, 4096)) == "Sent: 0.0B of 4.0KiB"
+
+    bar.add_upload_sample((1.0, 1024, 4096))
+    progress = dict(sample(1.0, 0), written_rows=500, written_bytes=5000)
+    assert bar.format_upload((1.0, 1024, 4096), progress) == (
+        "Sent: 1.0KiB of 4.0KiB (1.0KiB/s) ETA 0:03, server wrote 500.0 rows"
+    )
+
+    # Reading from a pipe, the size isn't known
+    assert bar.format_upload((1.0, 1024, None)) == "Sent: 1.0KiB (1.0KiB/s)"
@@ -0,0 +1,116 @@
+import datetime
+import io
+from unittest.mock import MagicMock, patch
+
+import requests
+
+from clickhouse_cli.cli import CLI
+from clickhouse_cli.clickhouse.client import Client
+from clickhouse_cli.clickhouse.scanner import iter_statements, scan_query, statement_verb, strip_comments
+
+
+def test_strip_comments_keeps_literals():
+    text, literals = strip_comments(
+        "SELECT '--x', \"/*y*/\" -- comment\nFROM t /* a /* nested */ one */ WHERE `a--b` = 1"
+    )
+    assert text == "SELECT '--x', \"/*y*/\" \nFROM t   WHERE `a--b` = 1"
+    assert [text[start:end] for start, end in literals] == ["'--x'", '"/*y*/"', "`a--b`"]
+
+
+def test_strip_comments_handles_escapes_and_unterminated_literals():
+    assert strip_comments(r"SELECT 'it''s \' -- no', 1 -- yes")[0] == r"SELECT 'it''s \' -- no', 1 "
+    assert strip_comments("SELECT 'open -- no")[0] == "SELECT 'open -- no"
+
+
+def test_scan_query():
+    scanned = scan_query("  -- header\n  (SELECT 1) FORMAT JSON;  ")
+    assert scanned.text == "(SELECT 1) FORMAT JSON"
+    assert (scanned.verb, scanned.format, scanned.vertical, scanned.outfile) == ("SELECT", "JSON", False, None)
+
+    scanned = scan_query("show tables\\G")
+    assert (scanned.text, scanned.verb, scanned.format, scanned.vertical) == ("show tables", "SHOW", None, True)
+
+    scanned = scan_query("SELECT 'FORMAT JSON' INTO OUTFILE '/tmp/my file.tsv' FORMAT TSV")
+    assert scanned.text == "SELECT 'FORMAT JSON' FORMAT TSV"
+    assert (scanned.format, scanned.outfile) == ("TSV", "/tmp/my file.tsv")
+
+    # Only the tail of a long query is tokenized, even when it begins inside a literal
+    scanned = scan_query("SELECT " + "1, " * 10000 + "'" + "x " * 1000 + "' INTO OUTFILE 'out.tsv'")
+    assert scanned.outfile == "out.tsv"
+    assert scanned.text.endswith("x '")
+    assert scan_query("SELECT '" + "FORMAT x " * 200 + "'").format is None
+
+
+def test_statement_verb():
+    assert statement_verb("-- load\n/* a /* nested */ one */ (INSERT INTO t VALUES ('--'))") == "INSERT"
+    assert statement_verb("  select 1") == "SELECT"
+    assert statement_verb("-- nothing else") is None
+
+
+def test_client_query_sends_preprocessed_statement(tmp_path):
+    client = Client(url="http://localhost:8123/", user="default", password="", database="default", cookie=None)
+    client._query = MagicMock()
+    client._query.return_value.data = "1\n"
+
+    client.query("SELECT 1 -- comment\n\\G;")
+    assert client._query.call_args[0][1] == "SELECT 1 FORMAT Vertical"
+
+    client.query("SHOW TABLES FORMAT JSON", fmt="TSV")
+    assert client._query.call_args[0][1] == "SHOW TABLES FORMAT JSON"
+    assert client._query.call_args.kwargs["fmt"] == "JSON"
+
+    outfile = tmp_path / "out.tsv"
+    client.query("SELECT 1 INTO OUTFILE '{}'".format(outfile), fmt="TSV")
+    assert client._query.call_args[0][1] == "SELECT 1 FORMAT TSV"
+    assert outfile.read_text() == "1\n"
+
+
+SCRIPT = b"""-- migration
+CREATE TABLE t (a String DEFAULT ';') ENGINE = Memory;
+
+INSERT INTO t VALUES ('a\\'; b'), ('it''s;'), ('\xd1\x8e;');
+/* c; /* nested; */ ; */ SELECT `x;` FROM t; -- trailing;
+"""
+
+
+def test_iter_statements_is_independent_of_chunking():
+    expected = [
+        (1, "-- migration\nCREATE TABLE t (a String DEFAULT ';') ENGINE = Memory"),
+        (4, "INSERT INTO t VALUES ('a\\'; b'), ('it''s;'), ('ю;')"),
+        (5, "/* c; /* nested; */ ; */ SELECT `x;` FROM t"),
+    ]
+    for chunk_size in (1, 2, 3, 7, 1 << 20):
+        assert list(iter_statements(io.BytesIO(SCRIPT), chunk_size=chunk_size)) == expected
+
+
+def test_run_script_stops_on_error():
+    cli = CLI(*[None] * 13, stop_on_error=True)
+    cli.handle_query = MagicMock(side_effect=[None, False, None])
+    assert cli.run_script(io.BytesIO(SCRIPT)) is False
+    assert cli.handle_query.call_count == 2
+
+    cli.stop_on_error = False
+    cli.handle_query = MagicMock(side_effect=[None, False, None])
+    assert cli.run_script(io.BytesIO(SCRIPT)) is False
+    assert cli.handle_query.call_count == 3
+    assert cli.script_failures == 2
+
+
+def test_run_script_sends_commented_inserts_as_they_are():
+    cli = CLI(*[None] * 13)
+    cli.load_config()
+    cli.client = Client(url="http://localhost:8123/", user="default", password="", database="default", cookie=None)
+    sent = []
+
+    def fake_request(method, url, **kwargs):
+        sent.append(kwargs["data"].read().decode())
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b""
+        response.elapsed = datetime.timedelta()
+        return response
+
+    script = b"-- seed\nINSERT INTO t VALUES (1);\n/* more */ INSERT INTO t VALUES (2);\n"
+    with patch("requests.Session.request", side_effect=fake_request):
+        assert cli.run_script(io.BytesIO(script)) is True
+    assert sent == ["-- seed\nINSERT INTO t VALUES (1)\n", "/* more */ INSERT INTO t VALUES (2)\n"]
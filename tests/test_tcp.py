@@ -0,0 +1,194 @@
+import socket
+import struct
+from unittest.mock import patch
+
+import pytest
+
+from clickhouse_cli.clickhouse import native, tcp
+from clickhouse_cli.clickhouse.client import Client
+from clickhouse_cli.clickhouse.exceptions import DBException
+from clickhouse_cli.clickhouse.tcp import string, varint
+from tests.test_native import FIRST, SECOND, block
+
+HELLO = varint(0) + string("ClickHouse") + varint(23) + varint(8) + varint(54465)
+HELLO += string("UTC") + string("server") + varint(1)
+INFO = varint(1) + b"\x00" + varint(2) + struct.pack("<i", -1) + varint(0)
+END = varint(5)
+
+
+def data(block):
+    return varint(1) + string("") + INFO + block
+
+
+def progress(read_rows, total_rows=0, written_rows=0):
+    increments = [read_rows, read_rows * 10, total_rows, written_rows, 0]
+    return varint(3) + b"".join(varint(value) for value in increments)
+
+
+def exception(code, message):
+    return varint(2) + struct.pack("<i", code) + string("DB::Exception") + string(message) + string("trace") + b"\x00"
+
+
+def connect(replies):
+    """A connection to a fake server, which has sent `replies` already."""
+    client_end, server_end = socket.socketpair()
+    server_end.sendall(HELLO + replies)
+    with patch("socket.create_connection", return_value=client_end):
+        connection = tcp.Connection("localhost", compression=False)
+        connection.connect()
+    return connection, server_end
+
+
+def received(server_end):
+    """Parse what the client sent: the hello, then (packet, ...) tuples."""
+    server_end.setblocking(False)
+    chunks = []
+    try:
+        while True:
+            chunks.append(server_end.recv(65536))
+    except BlockingIOError:
+        pass
+    reader = native.Reader(b"".join(chunks))
+
+    assert reader.read_varint() == tcp.CLIENT_HELLO
+    hello = [reader.read_string(), reader.read_varint(), reader.read_varint(), reader.read_varint()]
+    hello += [reader.read_string() for _ in range(3)]
+
+    packets = []
+    while not reader.at_end():
+        packet = reader.read_varint()
+        if packet == tcp.CLIENT_QUERY:
+            query_id = reader.read_string()
+            reader.read(1)
+            [reader.read_string() for _ in range(3)]
+            reader.read(1)
+            [reader.read_string() for _ in range(3)]
+            [reader.read_varint() for _ in range(3)]
+            reader.read_string()
+            reader.read_varint()
+            reader.read_varint()
+            reader.read(1)
+            settings = {}
+            while True:
+                name = reader.read_string()
+                if not name:
+                    break
+                reader.read_varint()
+                settings[name.decode()] = reader.read_string().decode()
+            reader.read_string()
+            stage, compression, query = reader.read_varint(), reader.read_varint(), reader.read_string()
+            packets.append((packet, query_id, settings, stage, compression, query))
+        elif packet == tcp.CLIENT_DATA:
+            reader.read_string()
+            packets.append((packet, reader.read_block(info=True)))
+        else:
+            packets.append((packet,))
+    return hello, packets
+
+
+@patch.object(native, "numpy", None)
+def test_execute():
+    updates = []
+    # The header of the result comes first, as a block without rows
+    replies = data(block(0, ("id", "UInt32", b""))) + progress(2, 3) + data(FIRST) + progress(1)
+    replies += data(SECOND) + varint(6) + varint(3) + varint(2) + varint(100) + b"\x00" + varint(0) + b"\x00" + END
+    connection, server_end = connect(replies)
+    assert connection.server_info == {
+        "name": "ClickHouse",
+        "version": [23, 8, 1],
+        "timezone": "UTC",
+        "display_name": "server",
+    }
+
+    blocks = list(connection.execute("SELECT 1", "q1", {"max_threads": 2}, on_progress=updates.append))
+    assert [len(block) for block in blocks] == [1, 11, 11]
+    assert native.join_blocks(blocks[1:])["name"] == ["one", "two", "three"]
+    assert [(update["read_rows"], update["percents"]) for update in updates] == [(2, 66), (3, 100)]
+    assert connection.profile["rows"] == 3
+
+    hello, packets = received(server_end)
+    assert hello[0] == b"clickhouse-cli" and hello[3] == tcp.CLIENT_REVISION
+    assert packets[0] == (tcp.CLIENT_QUERY, b"q1", {"max_threads": "2"}, tcp.STAGE_COMPLETE, 0, b"SELECT 1")
+    # An empty block: no external tables
+    assert packets[1] == (tcp.CLIENT_DATA, [])
+
+
+def test_execute_raises_server_exceptions():
+    connection, server_end = connect(progress(1) + exception(60, "Table default.t doesn't exist"))
+    with pytest.raises(DBException) as e:
+        list(connection.execute("SELECT * FROM t"))
+    assert e.value.error_code == "60"
+    assert e.value.error == "Code: 60. DB::Exception: Table default.t doesn't exist"
+    assert e.value.stacktrace == "trace"
+
+    # The connection is still usable
+    server_end.sendall(data(SECOND) + END)
+    assert len(list(connection.execute("SELECT 1"))) == 1
+
+
+def test_closing_execute_cancels_the_query():
+    connection, server_end = connect(data(FIRST) + data(SECOND) + exception(394, "Query was cancelled"))
+    blocks = connection.execute("SELECT * FROM t")
+    next(blocks)
+    blocks.close()
+
+    _, packets = received(server_end)
+    assert [packet[0] for packet in packets] == [tcp.CLIENT_QUERY, tcp.CLIENT_DATA, tcp.CLIENT_CANCEL]
+    assert connection.sock is not None
+
+
+def test_insert_sends_no_data():
+    connection, server_end = connect(data(block(0, ("x", "UInt8", b""))) + END)
+    assert list(connection.execute("INSERT INTO t VALUES")) == []
+    _, packets = received(server_end)
+    assert [packet[0] for packet in packets] == [tcp.CLIENT_QUERY, tcp.CLIENT_DATA, tcp.CLIENT_DATA]
+
+
+@patch.object(native, "numpy", None)
+def test_client_uses_the_native_port():
+    client = Client("http://localhost:8123/", "default", "", "default", None, native_port=9000, compression=False)
+    connection, server_end = connect(data(FIRST) + data(SECOND) + END)
+    with patch.object(tcp, "Connection", return_value=connection) as new_connection:
+        assert client.query_columns("SELECT * FROM t")["id"].tolist() == [1, 2, 3]
+        assert new_connection.call_args.args[:2] == ("localhost", 9000)
+
+        # The connection is reused
+        server_end.sendall(data(FIRST) + data(SECOND) + END)
+        batches = list(client.iter_rows("SELECT * FROM t", batch_size=2))
+        assert [len(batch) for batch in batches] == [2, 1]
+        assert new_connection.call_count == 1
+
+
+def test_http_only_arguments_keep_the_query_on_http():
+    client = Client("http://localhost:8123/", "default", "", "default", None, native_port=9000, compression=False)
+    with patch.object(tcp, "Connection") as new_connection, patch.object(Client, "query") as query:
+        query.return_value.format = "Native"
+        query.return_value.data = [block(1, ("id", "UInt8", b"\x07"))]
+        assert list(client.iter_rows("SELECT 7", session_id="s1")) == [[(7,)]]
+        assert query.call_args.kwargs["session_id"] == "s1"
+    new_connection.assert_not_called()
+
+
+@patch.object(native, "numpy", None)
+@pytest.mark.parametrize("method", ["lz4", "zstd"])
+def test_compressed_blocks(method):
+    pytest.importorskip("clickhouse_cityhash")
+    pytest.importorskip({"lz4": "lz4", "zstd": "zstandard"}[method])
+    code = tcp.COMPRESSION_METHODS[method]
+    # A block may span several frames
+    payload = INFO + FIRST
+    replies = varint(1) + string("") + tcp.compress(payload[:10], code) + tcp.compress(payload[10:], code)
+    replies += varint(1) + string("") + tcp.compress(INFO + SECOND, code) + END
+
+    client_end, server_end = socket.socketpair()
+    server_end.sendall(HELLO + replies)
+    with patch("socket.create_connection", return_value=client_end):
+        connection = tcp.Connection("localhost", compression=method)
+        blocks = list(connection.execute("SELECT * FROM t"))
+    assert native.join_blocks(blocks)["id"].tolist() == [1, 2, 3]
+
+    server_end.setblocking(False)
+    sent = server_end.recv(65536)
+    assert (b"network_compression_method" in sent) == (method == "zstd")
+    # The empty block is sent compressed as well
+    assert sent.endswith(tcp.compress(INFO + varint(0) + varint(0), code))